@@ -0,0 +1,212 @@
+########
+#
+# benchmark_postprocess_batch_results.py
+#
+# Times the ground truth evaluation in process_batch_results (the join of detector
+# results to ground truth and the classification confusion matrix) on a synthetic
+# evaluation set, against the per-file loops it replaced, and checks that both give
+# the same results.
+#
+# Sample invocation:
+#
+# python api/batch_processing/postprocessing/benchmark_postprocess_batch_results.py --n_images 1000000
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import collections
+import time
+
+import numpy as np
+import pandas as pd
+
+from api.batch_processing.postprocessing.postprocess_batch_results import (
+    DetectionStatus, get_classification_confusion, get_ground_truth_table,
+    mark_detection_status)
+from data_management.cct_json_utils import IndexedJsonDb
+
+
+#%% Functions
+
+def make_synthetic_evaluation(n_images, n_classes=20, seed=0):
+    """
+    Returns (ground truth database, detector results DataFrame in the format of
+    load_api_results, classification categories) for n_images images, with a mix
+    of empty, unknown, ambiguous and single- and multi-species images, and
+    detections that are mostly (but not always) classified as the right species.
+    """
+    rng = np.random.RandomState(seed)
+
+    species = ['species{:02d}'.format(i) for i in range(n_classes)]
+    categories = [{'id': 0, 'name': 'empty'}, {'id': 1, 'name': 'unknown'}] + \
+        [{'id': i + 2, 'name': name} for i, name in enumerate(species)]
+    classification_categories = {str(i): name for i, name in enumerate(species)}
+
+    # Category ID of each image's first annotation; some images get a second one
+    image_categories = rng.choice(
+        [0, 1, 2], size=n_images, p=[0.5, 0.05, 0.45])
+    b_species = image_categories == 2
+    image_categories[b_species] = rng.randint(2, n_classes + 2, size=b_species.sum())
+    b_second = rng.uniform(size=n_images) < 0.05
+    second_categories = rng.randint(0, n_classes + 2, size=n_images)
+
+    images = []
+    annotations = []
+    for i_image in range(n_images):
+        image_id = 'im{:07d}'.format(i_image)
+        images.append({'id': image_id, 'file_name': 'loc{:03d}/{}.jpg'.format(i_image % 500, image_id)})
+        annotations.append({'id': image_id + '_0', 'image_id': image_id,
+                            'category_id': int(image_categories[i_image])})
+        if b_second[i_image]:
+            annotations.append({'id': image_id + '_1', 'image_id': image_id,
+                                'category_id': int(second_categories[i_image])})
+    db = {'info': {}, 'images': images, 'annotations': annotations, 'categories': categories}
+
+    n_detections = rng.poisson(1.5, size=n_images)
+    rows = []
+    for i_image in range(n_images):
+        detections = []
+        for _ in range(n_detections[i_image]):
+            detection = {'category': '1', 'conf': round(float(rng.uniform()), 3),
+                         'bbox': [0.1, 0.1, 0.2, 0.2]}
+            if rng.uniform() < 0.8:
+                if image_categories[i_image] >= 2 and rng.uniform() < 0.8:
+                    class_id = image_categories[i_image] - 2
+                else:
+                    class_id = rng.randint(0, n_classes)
+                detection['classifications'] = [[str(class_id), round(float(rng.uniform()), 3)]]
+            detections.append(detection)
+        rows.append({'file': images[i_image]['file_name'],
+                     'max_detection_conf': max([d['conf'] for d in detections], default=0.0),
+                     'detections': detections})
+
+    return db, pd.DataFrame(rows), classification_categories
+
+
+def evaluate_with_loops(detections_df, ground_truth_indexed_db, classification_categories):
+    """
+    The per-file evaluation that process_batch_results used before
+    get_ground_truth_table and get_classification_confusion, for comparison.
+
+    Returns (gt_detections, list of accuracies, classnames, confusion matrix counts).
+    """
+    detector_files = detections_df['file'].tolist()
+
+    gt_detections = np.zeros(len(detector_files), dtype=float)
+    for i_detection, fn in enumerate(detector_files):
+        image_id = ground_truth_indexed_db.filename_to_id[fn]
+        image = ground_truth_indexed_db.image_id_to_image[image_id]
+        detection_status = image['_detection_status']
+        if detection_status == DetectionStatus.DS_NEGATIVE:
+            gt_detections[i_detection] = 0.0
+        elif detection_status == DetectionStatus.DS_POSITIVE:
+            gt_detections[i_detection] = 1.0
+        else:
+            gt_detections[i_detection] = -1.0
+
+    classifier_accuracies = []
+    classname_to_idx = collections.defaultdict(lambda: len(classname_to_idx))
+    classifier_cm = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+    for i_detection, fn in enumerate(detector_files):
+        image_id = ground_truth_indexed_db.filename_to_id[fn]
+        image = ground_truth_indexed_db.image_id_to_image[image_id]
+        detections = detections_df['detections'].iloc[i_detection]
+        pred_class_ids = [det['classifications'][0][0]
+                          for det in detections if 'classifications' in det.keys()]
+        pred_classnames = [classification_categories[c] for c in pred_class_ids]
+        if len(pred_classnames) > 0 \
+                and '_unambiguous_category' in image.keys() \
+                and image['_detection_status'] == DetectionStatus.DS_POSITIVE:
+            gt_categories = set([image['_unambiguous_category']])
+            pred_categories = set(pred_classnames)
+            classifier_accuracies.append(
+                len(gt_categories & pred_categories) / len(gt_categories | pred_categories))
+            gt_class_idx = classname_to_idx[list(gt_categories)[0]]
+            for pred_category in pred_categories:
+                classifier_cm[gt_class_idx][classname_to_idx[pred_category]] += 1
+
+    classnames = sorted(classname_to_idx.keys())
+    cm = np.array([[classifier_cm[classname_to_idx[r]][classname_to_idx[c]] for c in classnames]
+                   for r in classnames], dtype=int)
+
+    return gt_detections, classifier_accuracies, classnames, cm
+
+
+def evaluate_vectorized(detections_df, ground_truth_indexed_db, classification_categories):
+    """
+    The evaluation in process_batch_results; returns the same values as
+    evaluate_with_loops.
+    """
+    ground_truth_df = detections_df[['file']].merge(
+        get_ground_truth_table(ground_truth_indexed_db), on='file', how='left')
+    gt_status = ground_truth_df['gt_detection_status'].values
+
+    gt_detections = np.full(len(detections_df), -1.0)
+    gt_detections[gt_status == DetectionStatus.DS_NEGATIVE] = 0.0
+    gt_detections[gt_status == DetectionStatus.DS_POSITIVE] = 1.0
+
+    _, accuracies, classnames, cm = get_classification_confusion(
+        detections_df['detections'].values,
+        ground_truth_df['gt_unambiguous_category'].values,
+        gt_status == DetectionStatus.DS_POSITIVE,
+        classification_categories)
+
+    return gt_detections, list(accuracies), classnames, cm
+
+
+def run_benchmark(n_images):
+    start_time = time.time()
+    db, detections_df, classification_categories = make_synthetic_evaluation(n_images)
+    ground_truth_indexed_db = IndexedJsonDb(db, b_normalize_paths=True)
+    mark_detection_status(ground_truth_indexed_db)
+    print('Built {} images with {} annotations in {:.2f} s'.format(
+        len(db['images']), len(db['annotations']), time.time() - start_time))
+
+    start_time = time.time()
+    results_loops = evaluate_with_loops(
+        detections_df, ground_truth_indexed_db, classification_categories)
+    time_loops = time.time() - start_time
+
+    start_time = time.time()
+    results_vectorized = evaluate_vectorized(
+        detections_df, ground_truth_indexed_db, classification_categories)
+    time_vectorized = time.time() - start_time
+
+    gt_loops, accuracies_loops, classnames_loops, cm_loops = results_loops
+    gt_vectorized, accuracies_vectorized, classnames_vectorized, cm_vectorized = results_vectorized
+    identical = np.array_equal(gt_loops, gt_vectorized) and \
+        np.allclose(sorted(accuracies_loops), sorted(accuracies_vectorized)) and \
+        classnames_loops == classnames_vectorized and \
+        np.array_equal(cm_loops, cm_vectorized)
+
+    print('{} classification results, mean accuracy {:.4f}'.format(
+        len(accuracies_vectorized), np.mean(accuracies_vectorized)))
+    print('Per-file loops: {:.2f} s'.format(time_loops))
+    print('Vectorized:     {:.2f} s'.format(time_vectorized))
+    print('Speedup: {:.1f}x; identical results: {}'.format(
+        time_loops / max(time_vectorized, 1e-9), identical))
+
+    return identical
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ground truth evaluation in process_batch_results')
+    parser.add_argument(
+        '--n_images',
+        type=int,
+        default=1000000,
+        help='Number of synthetic images; default is 1000000')
+    args = parser.parse_args()
+
+    identical = run_benchmark(args.n_images)
+    assert identical, 'Vectorized evaluation differs from the per-file loops'
+
+
+if __name__ == '__main__':
+    main()
@@ -11,14 +11,33 @@
 #%% Constants and imports
 
 from collections import defaultdict
+from contextlib import contextmanager
+import gc
+import hashlib
 import json
 import os
 from typing import Dict, Mapping, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+# orjson parses large API output files faster than json; it's used if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 headers = ['image_path', 'max_confidence', 'detections']
 
+# Columns of the detections table from load_api_results_columnar() holding the bbox
+BBOX_COLUMNS = ['x_min', 'y_min', 'width_of_box', 'height_of_box']
+
+# Fields of each detection that have their own columns in the detections table
+DETECTION_COLUMN_FIELDS = ['category', 'conf', 'bbox']
+
+# Bump this when the format of the load_api_results_columnar() cache changes
+CACHE_VERSION = 2
+
 
 #%% Functions for grouping by sequence_id
 
@@ -62,8 +81,62 @@ def api_results_groupby(api_output_path, gt_db_indexed, file_to_image_id, field=
 
 #%% Functions for loading the result as a Pandas DataFrame
 
+@contextmanager
+def gc_paused():
+    """
+    Pauses garbage collection within a with block.
+
+    Building the millions of small objects in a large API output file otherwise
+    triggers collections that each traverse all of them, which takes longer than
+    building them.
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def load_json(path: str):
+    """
+    Parses a json file, with orjson if it's installed (falling back to json for what
+    orjson rejects, such as NaN), with garbage collection paused.
+    """
+    with gc_paused():
+        if orjson is not None:
+            with open(path, 'rb') as f:
+                s = f.read()
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                return json.loads(s)
+        with open(path) as f:
+            return json.load(f)
+
+
+def _normalize_file_column(detection_results: pd.DataFrame, column: str, normalize_paths: bool,
+                           filename_replacements: Optional[Mapping[str, str]]) -> None:
+    """
+    Applies os.path.normpath and then each of filename_replacements (in order) to
+    every filename in detection_results[column].
+    """
+
+    # Normalize paths to simplify comparisons later
+    if normalize_paths:
+        detection_results[column] = [os.path.normpath(fn) for fn in detection_results[column]]
+
+    # Replace some path tokens to match local paths to original blob structure
+    if filename_replacements is not None:
+        for string_to_replace, replacement_string in filename_replacements.items():
+            detection_results[column] = detection_results[column].str.replace(
+                string_to_replace, replacement_string, regex=False)
+
+
 def load_api_results(api_output_path: str, normalize_paths: bool = True,
-                     filename_replacements: Optional[Mapping[str, str]] = None
+                     filename_replacements: Optional[Mapping[str, str]] = None,
+                     cache_dir: Optional[str] = None
                      ) -> Tuple[pd.DataFrame, Dict]:
     """
     Loads the json formatted results from the batch processing API to a
@@ -75,50 +148,44 @@ def load_api_results(api_output_path: str, normalize_paths: bool = True,
             in each image entry in the output file
         filename_replacements: replace some path tokens to match local paths to
             the original blob structure
+        cache_dir: optional folder to cache the results in as Parquet files, see
+            load_api_results_columnar(); later calls rebuild the DataFrame from
+            there instead of parsing the json
 
     Returns:
         detection_results: pd.DataFrame, contains at least the columns:
                 ['file', 'max_detection_conf', 'detections','failure']            
         other_fields: a dict containing fields in the dict
     """
-    print('Loading API results from {}'.format(api_output_path))
+    if cache_dir is not None:
+        images, detections, other_fields, detection_results = _load_api_results_columnar(
+            api_output_path, normalize_paths, filename_replacements, cache_dir)
+        if detection_results is None:
+            detection_results = get_detection_results_from_tables(images, detections)
+        return detection_results, other_fields
 
-    with open(api_output_path) as f:
-        detection_results = json.load(f)
+    print('Loading API results from {}'.format(api_output_path))
 
-    print('De-serializing API results')
+    with gc_paused():
 
-    # Sanity-check that this is really a detector output file
-    for s in ['info', 'detection_categories', 'images']:
-        assert s in detection_results
+        detection_results = load_json(api_output_path)
 
-    # Fields in the API output json other than 'images'
-    other_fields = {}
-    for k, v in detection_results.items():
-        if k != 'images':
-            other_fields[k] = v
+        print('De-serializing API results')
 
-    # Normalize paths to simplify comparisons later
-    if normalize_paths:
-        for image in detection_results['images']:
-            image['file'] = os.path.normpath(image['file'])
-            # image['file'] = image['file'].replace('\\','/')
+        # Sanity-check that this is really a detector output file
+        for s in ['info', 'detection_categories', 'images']:
+            assert s in detection_results
 
-    # Pack the json output into a Pandas DataFrame
-    detection_results = pd.DataFrame(detection_results['images'])
-
-    # Replace some path tokens to match local paths to original blob structure
-    # string_to_replace = list(filename_replacements.keys())[0]
-    if filename_replacements is not None:
-        for string_to_replace in filename_replacements:
+        # Fields in the API output json other than 'images'
+        other_fields = {}
+        for k, v in detection_results.items():
+            if k != 'images':
+                other_fields[k] = v
 
-            replacement_string = filename_replacements[string_to_replace]
+        # Pack the json output into a Pandas DataFrame
+        detection_results = pd.DataFrame(detection_results['images'])
 
-            for i_row in range(len(detection_results)):
-                row = detection_results.iloc[i_row]
-                fn = row['file']
-                fn = fn.replace(string_to_replace, replacement_string)
-                detection_results.at[i_row, 'file'] = fn
+        _normalize_file_column(detection_results, 'file', normalize_paths, filename_replacements)
 
     print('Finished loading and de-serializing API results for {} images from {}'.format(
             len(detection_results),api_output_path))
@@ -126,6 +193,193 @@ def load_api_results(api_output_path: str, normalize_paths: bool = True,
     return detection_results, other_fields
 
 
+def get_detection_arrays(detection_results: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """
+    Flattens the 'detections' column of a DataFrame from load_api_results() into
+    NumPy arrays with one element per detection, in the order of the images and of
+    the detections within each image. Images without a list of detections (failed
+    images) have no elements.
+
+    Args:
+        detection_results: pd.DataFrame, as returned by load_api_results()
+
+    Returns: dict with the arrays
+        'image_index': int64, position of the detection's image in detection_results
+        'detection_index': int64, index of the detection in its image's 'detections'
+        'category': str, category ID
+        'conf': float64, confidence
+        'bbox': float64, shape [N, 4], [x_min, y_min, width_of_box, height_of_box]
+    """
+    detections_by_image = [d if isinstance(d, list) else []
+                           for d in detection_results['detections'].tolist()]
+    n_detections = np.array([len(d) for d in detections_by_image], dtype=np.int64)
+    detections = [d for image_detections in detections_by_image for d in image_detections]
+
+    image_index = np.repeat(np.arange(len(detections_by_image), dtype=np.int64), n_detections)
+    first_index = np.cumsum(n_detections) - n_detections
+    detection_index = np.arange(len(detections), dtype=np.int64) - first_index[image_index]
+
+    return {
+        'image_index': image_index,
+        'detection_index': detection_index,
+        'category': np.array([d['category'] for d in detections], dtype=str),
+        'conf': np.array([d['conf'] for d in detections], dtype=np.float64),
+        'bbox': np.array([d['bbox'] for d in detections], dtype=np.float64).reshape(-1, 4)
+    }
+
+
+def _get_cache_paths(api_output_path: str, cache_dir: str, normalize_paths: bool,
+                     filename_replacements: Optional[Mapping[str, str]]) -> Tuple[str, str, str]:
+    """
+    Returns the paths of the metadata .json and the images and detections .parquet
+    files caching one API output file loaded with the given options.
+    """
+    key = json.dumps([os.path.abspath(api_output_path), normalize_paths,
+                      list((filename_replacements or {}).items())])
+    name = '{}_{}'.format(os.path.splitext(os.path.basename(api_output_path))[0],
+                          hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+    base = os.path.join(cache_dir, name)
+    return base + '.json', base + '.images.parquet', base + '.detections.parquet'
+
+
+def _get_source_stamp(api_output_path: str) -> Dict:
+    st = os.stat(api_output_path)
+    return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'version': CACHE_VERSION}
+
+
+def load_api_results_columnar(api_output_path: str, normalize_paths: bool = True,
+                              filename_replacements: Optional[Mapping[str, str]] = None,
+                              cache_dir: Optional[str] = None
+                              ) -> Tuple[pd.DataFrame, pd.DataFrame, Dict]:
+    """
+    Loads the json formatted results from the batch processing API to two flat
+    Pandas DataFrames, one row per image and one row per detection, with no nested
+    lists or dicts.
+
+    With cache_dir, the tables are also written there as Parquet files (this needs
+    pyarrow), and later calls with the same file and options read them instead of
+    the json, as long as the json's modification time and size haven't changed.
+
+    Args:
+        api_output_path: path to the API output json file
+        normalize_paths: see load_api_results()
+        filename_replacements: see load_api_results()
+        cache_dir: optional folder for cached tables
+
+    Returns:
+        images: pd.DataFrame, the columns of load_api_results() except 'detections',
+            plus 'first_detection' and 'n_detections': the image's detections are
+            rows first_detection:first_detection + n_detections of detections; and
+            'detections_is_list', False for images without a list of detections
+            (failed images)
+        detections: pd.DataFrame, in the order of the images and of the detections
+            within each image, with the columns 'image_index' (row in images),
+            'detection_index' (index in the image's 'detections'), 'category', 'conf',
+            BBOX_COLUMNS and 'other_fields': the detection's other fields (e.g.
+            classifications) as a json string, or None if it has none
+        other_fields: a dict containing fields in the dict
+    """
+    images, detections, other_fields, _ = _load_api_results_columnar(
+        api_output_path, normalize_paths, filename_replacements, cache_dir)
+    return images, detections, other_fields
+
+
+def _load_api_results_columnar(api_output_path: str, normalize_paths: bool,
+                               filename_replacements: Optional[Mapping[str, str]],
+                               cache_dir: Optional[str]
+                               ) -> Tuple[pd.DataFrame, pd.DataFrame, Dict, Optional[pd.DataFrame]]:
+    """
+    load_api_results_columnar(), also returning the DataFrame from load_api_results()
+    if the json was loaded (None if the tables came from the cache).
+    """
+
+    if cache_dir is not None:
+        metadata_path, images_path, detections_path = _get_cache_paths(
+            api_output_path, cache_dir, normalize_paths, filename_replacements)
+        if os.path.isfile(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            if metadata['source'] == _get_source_stamp(api_output_path):
+                print('Loading cached API results for {} from {}'.format(api_output_path, cache_dir))
+                images = pd.read_parquet(images_path)
+                detections = pd.read_parquet(detections_path)
+                return images, detections, metadata['other_fields'], None
+
+    source_stamp = _get_source_stamp(api_output_path)
+    detection_results, other_fields = load_api_results(
+        api_output_path, normalize_paths=normalize_paths,
+        filename_replacements=filename_replacements)
+
+    detection_arrays = get_detection_arrays(detection_results)
+    detections = pd.DataFrame({
+        'image_index': detection_arrays['image_index'],
+        'detection_index': detection_arrays['detection_index'],
+        'category': detection_arrays['category'],
+        'conf': detection_arrays['conf']
+    })
+    for i_column, column in enumerate(BBOX_COLUMNS):
+        detections[column] = detection_arrays['bbox'][:, i_column]
+
+    detections_by_image = detection_results['detections'].tolist() \
+        if 'detections' in detection_results.columns else [None] * len(detection_results)
+    detections_is_list = np.array([isinstance(d, list) for d in detections_by_image], dtype=bool)
+    detections['other_fields'] = [
+        json.dumps({k: v for k, v in d.items() if k not in DETECTION_COLUMN_FIELDS})
+        if len(d) > len(DETECTION_COLUMN_FIELDS) else None
+        for image_detections in detections_by_image if isinstance(image_detections, list)
+        for d in image_detections]
+
+    images = detection_results.drop(columns=['detections'], errors='ignore')
+    n_detections = np.bincount(detection_arrays['image_index'], minlength=len(images))
+    images['first_detection'] = np.cumsum(n_detections) - n_detections
+    images['n_detections'] = n_detections
+    images['detections_is_list'] = detections_is_list
+
+    if cache_dir is not None:
+        print('Caching API results in {}'.format(cache_dir))
+        os.makedirs(cache_dir, exist_ok=True)
+        images.to_parquet(images_path, index=False)
+        detections.to_parquet(detections_path, index=False)
+
+        # Written last, so an interrupted write leaves no valid cache entry
+        with open(metadata_path, 'w') as f:
+            json.dump({'source': source_stamp, 'other_fields': other_fields}, f)
+
+    return images, detections, other_fields, detection_results
+
+
+def get_detection_results_from_tables(images: pd.DataFrame, detections: pd.DataFrame
+                                      ) -> pd.DataFrame:
+    """
+    Rebuilds the DataFrame of load_api_results() from the tables of
+    load_api_results_columnar(). The 'detections' column is NaN for images
+    without a list of detections (as when the json has no 'detections' for them),
+    and is the last column.
+    """
+
+    with gc_paused():
+        bboxes = detections[BBOX_COLUMNS].to_numpy().tolist()
+        all_detections = []
+        for category, conf, bbox, other_fields in zip(
+                detections['category'].tolist(), detections['conf'].tolist(), bboxes,
+                detections['other_fields'].tolist()):
+            d = {'category': category, 'conf': conf, 'bbox': bbox}
+            # Missing values read back from Parquet as NaN rather than None
+            if isinstance(other_fields, str):
+                d.update(json.loads(other_fields))
+            all_detections.append(d)
+
+        detection_results = images.drop(
+            columns=['first_detection', 'n_detections', 'detections_is_list'])
+        detection_results['detections'] = [
+            all_detections[first:first + n] if is_list else np.nan
+            for first, n, is_list in zip(images['first_detection'].tolist(),
+                                         images['n_detections'].tolist(),
+                                         images['detections_is_list'].tolist())]
+
+    return detection_results
+
+
 def write_api_results(detection_results_table, other_fields, out_path):
     """
     Writes a Pandas DataFrame back to a json that is compatible with the API output format.
@@ -170,21 +424,7 @@ def load_api_results_csv(filename, normalize_paths=True, filename_replacements={
     detection_results['detections'] = detection_results['detections'].apply(json.loads)
 
     # Optionally replace some path tokens to match local paths to the original blob structure
-    # string_to_replace = list(options.detector_output_filename_replacements.keys())[0]
-    for string_to_replace in filename_replacements:
-
-        replacement_string = filename_replacements[string_to_replace]
-
-        # TODO: hit some silly issues with vectorized str() and escaped characters, vectorize
-        # this later.
-        #
-        # detection_results['image_path'].str.replace(string_to_replace,replacement_string)
-        # iRow = 0
-        for iRow in range(0,len(detection_results)):
-            row = detection_results.iloc[iRow]
-            fn = row['image_path']
-            fn = fn.replace(string_to_replace,replacement_string)
-            detection_results.at[iRow,'image_path'] = fn
+    _normalize_file_column(detection_results, 'image_path', False, filename_replacements)
 
     print('Finished loading and de-serializing API results for {} images from {}'.format(len(detection_results),filename))
 
@@ -24,13 +24,14 @@ import collections
 import copy
 from enum import IntEnum
 import errno
+import hashlib
 import io
 import itertools
-from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import Pool, ThreadPool
 import os
 import sys
 import time
-from typing import Any, Dict, Iterable, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 import uuid
 import warnings
 
@@ -39,6 +40,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import humanfriendly
 import pandas as pd
+from PIL import Image
 from sklearn.metrics import precision_recall_curve, confusion_matrix, average_precision_score
 from tqdm import tqdm
 
@@ -143,9 +145,26 @@ class PostProcessingOptions:
     almost_detection_confidence_threshold = 0.75
 
     # Control rendering parallelization
-    parallelize_rendering_n_cores: Optional[int] = 100
+    #
+    # PIL drawing holds the GIL, so threads mostly help when reading images is the
+    # bottleneck (e.g. from a network share); with processes, parallelize_rendering_n_cores
+    # should usually be at most the number of cores.  None means 100 threads, or
+    # os.cpu_count() processes.
+    parallelize_rendering_n_cores: Optional[int] = None
+    parallelize_rendering_with_threads = True
     parallelize_rendering = False
 
+    # Optional folder of images that have already been resized to viz_target_width
+    # (and rotated according to their EXIF orientation), keyed by path, modification
+    # time, size and width, so that rendering the same images again (e.g. for another
+    # report) doesn't decode the full-size images.  Not used for SAS URLs.
+    thumbnail_cache_dir: Optional[str] = None
+
+    # Optional folder to cache the loaded API output in (see load_api_results()), so
+    # that postprocessing the same results file again doesn't parse the json.  Needs
+    # pyarrow.
+    results_cache_dir: Optional[str] = None
+
     # Determines whether missing images force an error
     allow_missing_images = False
 
@@ -277,6 +296,104 @@ def mark_detection_status(
 # ...mark_detection_status()
 
 
+def get_ground_truth_table(indexed_db: IndexedJsonDb) -> pd.DataFrame:
+    """
+    Returns a DataFrame with one row per filename in indexed_db.filename_to_id,
+    with columns:
+
+    * file
+    * gt_image_id
+    * gt_detection_status: the DetectionStatus set by mark_detection_status()
+    * gt_unambiguous_category: the class name set by mark_detection_status(), or
+        None
+    """
+
+    image_ids = list(indexed_db.filename_to_id.values())
+    images = [indexed_db.image_id_to_image[image_id] for image_id in image_ids]
+    return pd.DataFrame({
+        'file': list(indexed_db.filename_to_id.keys()),
+        'gt_image_id': image_ids,
+        'gt_detection_status': np.array([im['_detection_status'] for im in images], dtype=int),
+        'gt_unambiguous_category': [im.get('_unambiguous_category', None) for im in images]
+    })
+
+
+def get_classification_confusion(
+        detections: Sequence[List[Dict[str, Any]]],
+        gt_categories: Sequence[Optional[str]],
+        b_positive: np.ndarray,
+        classification_categories: Dict[str, str]
+        ) -> Tuple[np.ndarray, np.ndarray, List[str], np.ndarray]:
+    """
+    Evaluates top-1 classifications against ground truth classes.
+
+    Images are evaluated if they are positive, have an unambiguous ground truth
+    class and have at least one detection with classifications. The accuracy of
+    an image is the intersection over union of its ground truth class and the set
+    of top-1 classes of its detections, and each of those top-1 classes is counted
+    once in the ground truth class's row of the confusion matrix.
+
+    Args:
+        detections: each image's list of detections
+        gt_categories: each image's unambiguous ground truth class name, or None
+        b_positive: bool array, whether each image is positive in the ground truth
+        classification_categories: dict mapping classification category IDs to
+            class names
+
+    Returns:
+        i_evaluated: int array, the indices of the evaluated images
+        accuracies: float array, the accuracy of each evaluated image
+        classnames: sorted list of the ground truth and predicted classes of the
+            evaluated images
+        cm: int array of shape [len(classnames), len(classnames)], rows are ground
+            truth classes and columns are predicted classes
+    """
+
+    detections = pd.Series(detections, dtype=object).values
+    gt_categories = pd.Series(gt_categories, dtype=object).values
+    i_candidates = np.flatnonzero(np.asarray(b_positive) & pd.notna(gt_categories))
+
+    # One (image index, top-1 class name) pair per classified detection
+    pred_images = []
+    pred_classnames = []
+    for i_image in i_candidates:
+        for det in detections[i_image]:
+            if 'classifications' in det:
+                pred_images.append(i_image)
+                pred_classnames.append(classification_categories[det['classifications'][0][0]])
+    pred_images = np.array(pred_images, dtype=np.int64)
+
+    i_evaluated = np.unique(pred_images)
+    n_evaluated = len(i_evaluated)
+
+    classnames, class_indices = np.unique(
+        np.array(list(gt_categories[i_evaluated]) + pred_classnames, dtype=str),
+        return_inverse=True)
+    n_classes = len(classnames)
+    gt_class_indices = class_indices[0:n_evaluated]
+    pred_class_indices = class_indices[n_evaluated:]
+
+    # Count each predicted class once per image
+    pairs = np.unique(np.searchsorted(i_evaluated, pred_images) * n_classes + pred_class_indices)
+    pair_evaluated_indices = pairs // n_classes
+    pair_gt_class_indices = gt_class_indices[pair_evaluated_indices]
+    pair_pred_class_indices = pairs % n_classes
+
+    cm = np.bincount(pair_gt_class_indices * n_classes + pair_pred_class_indices,
+                     minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+    # |gt & pred| / |gt | pred|, with a single ground truth class
+    n_pred = np.bincount(pair_evaluated_indices, minlength=n_evaluated)
+    n_correct = np.bincount(pair_evaluated_indices,
+                            weights=(pair_gt_class_indices == pair_pred_class_indices),
+                            minlength=n_evaluated)
+    accuracies = n_correct / (n_pred + 1 - n_correct)
+
+    return i_evaluated, accuracies, [str(c) for c in classnames], cm
+
+# ...get_classification_confusion()
+
+
 def is_sas_url(s: str) -> bool:
     """
     Placeholder for a more robust way to verify that a link is a SAS URL.
@@ -308,6 +425,64 @@ def relative_sas_url(folder_url: str, relative_path: str) -> Optional[str]:
     return tokens[0] + relative_path + '?' + tokens[1]
 
 
+def get_thumbnail_cache_path(image_full_path: str, target_width: Optional[int],
+                             thumbnail_cache_dir: str) -> str:
+    """
+    Returns the path in thumbnail_cache_dir for the resized copy of the image at
+    image_full_path, which depends on the image's absolute path, modification time
+    and size, and on target_width.
+
+    Raises OSError if the image doesn't exist.
+    """
+
+    st = os.stat(image_full_path)
+    key = '{}|{}|{}|{}'.format(os.path.abspath(image_full_path), st.st_mtime_ns,
+                               st.st_size, target_width)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(thumbnail_cache_dir, digest[0:2], digest + '.jpg')
+
+
+def open_resized_image(image_full_path: str, options: PostProcessingOptions) -> Image.Image:
+    """
+    Opens an image (a path or a URL), rotated according to its EXIF orientation and
+    resized to options.viz_target_width.
+
+    If options.thumbnail_cache_dir is set, the resized image is read from there
+    if it has already been cached, and cached otherwise.
+    """
+
+    target_width = options.viz_target_width
+
+    cache_path = None
+    if (options.thumbnail_cache_dir is not None) and \
+            (not image_full_path.startswith(('http://', 'https://'))):
+        cache_path = get_thumbnail_cache_path(image_full_path, target_width,
+                                              options.thumbnail_cache_dir)
+        try:
+            image = Image.open(cache_path)
+            image.load()
+            return image
+        except OSError:
+            pass
+
+    if target_width is not None and target_width > 0:
+        # JPEGs only need to be decoded at a size that is at least target_width wide
+        image = vis_utils.open_image(image_full_path, min_decode_size=target_width)
+        image = vis_utils.resize_image(image, target_width)
+    else:
+        image = vis_utils.open_image(image_full_path)
+
+    if cache_path is not None and image.mode == 'RGB':
+        # Write to a temporary file first, so that concurrent renderers never read a
+        # partial thumbnail
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(cache_path, uuid.uuid4().hex)
+        image.save(temp_path, format='JPEG', quality=95)
+        os.replace(temp_path, cache_path)
+
+    return image
+
+
 def render_bounding_boxes(
         image_base_dir,
         image_relative_path,
@@ -358,14 +533,11 @@ def render_bounding_boxes(
         # os.path.isfile() is slow when mounting remote directories; much faster
         # to just try/except on the image open.
         try:
-            image = vis_utils.open_image(image_full_path)
+            image = open_resized_image(image_full_path, options)
         except:
             print('Warning: could not open image file {}'.format(image_full_path))
             return ''
 
-        if options.viz_target_width is not None:
-            image = vis_utils.resize_image(image, options.viz_target_width)
-
         vis_utils.render_detection_bounding_boxes(
             detections, image,
             label_map=detection_categories,
@@ -402,6 +574,39 @@ def render_bounding_boxes(
 # ...render_bounding_boxes
 
 
+def _render_bounding_boxes_for_task(render_args):
+    """
+    Worker for render_images, calls render_bounding_boxes(*render_args).
+    """
+    return render_bounding_boxes(*render_args)
+
+
+def render_images(render_args, options):
+    """
+    Calls render_bounding_boxes for each tuple of arguments in render_args; on a
+    pool of threads or processes if options.parallelize_rendering is set.
+
+    Returns the html info structs, in the order of render_args.
+    """
+
+    if not options.parallelize_rendering:
+        return [render_bounding_boxes(*args) for args in tqdm(render_args)]
+
+    n_workers = options.parallelize_rendering_n_cores
+    if n_workers is None:
+        n_workers = 100 if options.parallelize_rendering_with_threads else os.cpu_count()
+    print('Rendering images with {} workers'.format(n_workers))
+    if options.parallelize_rendering_with_threads:
+        pool = ThreadPool(n_workers)
+    else:
+        pool = Pool(n_workers)
+    with pool:
+        return list(tqdm(pool.imap(_render_bounding_boxes_for_task, render_args),
+                         total=len(render_args)))
+
+# ...render_images()
+
+
 def prepare_html_subpages(images_html, output_dir, options=None):
     """
     Write out a series of html image lists, e.g. the fp/tp/fn/tn pages.
@@ -484,7 +689,8 @@ def process_batch_results(options: PostProcessingOptions
     if options.api_detection_results is None:
         detections_df, other_fields = load_api_results(
             options.api_output_file, normalize_paths=True,
-            filename_replacements=options.api_output_filename_replacements)
+            filename_replacements=options.api_output_filename_replacements,
+            cache_dir=options.results_cache_dir)
         ppresults.api_detection_results = detections_df
         ppresults.api_other_fields = other_fields
 
@@ -590,20 +796,16 @@ def process_batch_results(options: PostProcessingOptions
         p_detection = detections_df['max_detection_conf'].values
         n_detections = len(p_detection)
 
-        # numpy array of bools (0.0/1.0), and -1 as null value
-        gt_detections = np.zeros(n_detections, dtype=float)
-
-        for i_detection, fn in enumerate(detector_files):
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detection_status = image['_detection_status']
+        # Ground truth for each row of detections_df
+        ground_truth_df = detections_df[['file']].merge(
+            get_ground_truth_table(ground_truth_indexed_db), on='file', how='left')
+        assert len(ground_truth_df) == n_detections
+        gt_status = ground_truth_df['gt_detection_status'].values
 
-            if detection_status == DetectionStatus.DS_NEGATIVE:
-                gt_detections[i_detection] = 0.0
-            elif detection_status == DetectionStatus.DS_POSITIVE:
-                gt_detections[i_detection] = 1.0
-            else:
-                gt_detections[i_detection] = -1.0
+        # numpy array of bools (0.0/1.0), and -1 as null value
+        gt_detections = np.full(n_detections, -1.0)
+        gt_detections[gt_status == DetectionStatus.DS_NEGATIVE] = 0.0
+        gt_detections[gt_status == DetectionStatus.DS_POSITIVE] = 1.0
 
         # Don't include ambiguous/unknown ground truth in precision/recall analysis
         b_valid_ground_truth = gt_detections >= 0.0
@@ -655,75 +857,24 @@ def process_batch_results(options: PostProcessingOptions
 
         ##%% Collect classification results, if they exist
 
-        classifier_accuracies = []
+        i_evaluated, classifier_accuracies, classname_list, classifier_cm = \
+            get_classification_confusion(
+                detections_df['detections'].values,
+                ground_truth_df['gt_unambiguous_category'].values,
+                gt_status == DetectionStatus.DS_POSITIVE,
+                classification_categories)
 
-        # Mapping of classnames to idx for the confusion matrix.
-        #
-        # The lambda is actually kind of a hack, because we use assume that
-        # the following code does not reassign classname_to_idx
-        classname_to_idx = collections.defaultdict(lambda: len(classname_to_idx))
-
-        # Confusion matrix as defaultdict of defaultdict
-        #
-        # Rows / first index is ground truth, columns / second index is predicted category
-        classifier_cm = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
-
-        # iDetection = 0; fn = detector_files[iDetection]; print(fn)
-        assert len(detector_files) == len(detections_df)
-        for iDetection, fn in enumerate(detector_files):
-
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detections = detections_df['detections'].iloc[iDetection]
-            pred_class_ids = [det['classifications'][0][0] \
-                for det in detections if 'classifications' in det.keys()]
-            pred_classnames = [classification_categories[pd] for pd in pred_class_ids]
-
-            # If this image has classification predictions, and an unambiguous class
-            # annotated, and is a positive image...
-            if len(pred_classnames) > 0 \
-                    and '_unambiguous_category' in image.keys() \
-                    and image['_detection_status'] == DetectionStatus.DS_POSITIVE:
-
-                # The unambiguous category, we make this a set for easier handling afterward
-                gt_categories = set([image['_unambiguous_category']])
-                pred_categories = set(pred_classnames)
-
-                # Compute the accuracy as intersection of union,
-                # i.e. (# of categories in both prediciton and GT)
-                #      divided by (# of categories in either prediction or GT
-                #
-                # In case of only one GT category, the result will be 1.0, if
-                # prediction is one category and this category matches GT
-                #
-                # It is 1.0/(# of predicted top-1 categories), if the GT is
-                # one of the predicted top-1 categories.
-                #
-                # It is 0.0, if none of the predicted categories is correct
-
-                classifier_accuracies.append(
-                    len(gt_categories & pred_categories)
-                    / len(gt_categories | pred_categories)
-                )
-                image['_classification_accuracy'] = classifier_accuracies[-1]
-
-                # Distribute this accuracy across all predicted categories in the
-                # confusion matrix
-                assert len(gt_categories) == 1
-                gt_class_idx = classname_to_idx[list(gt_categories)[0]]
-                for pred_category in pred_categories:
-                    pred_class_idx = classname_to_idx[pred_category]
-                    classifier_cm[gt_class_idx][pred_class_idx] += 1
-
-        # ...for each file in the detection results
+        # Rendering uses the accuracy to sort true positives into tpc/tpi
+        gt_image_ids = ground_truth_df['gt_image_id'].values
+        for i_image, accuracy in zip(i_evaluated, classifier_accuracies):
+            image = ground_truth_indexed_db.image_id_to_image[gt_image_ids[i_image]]
+            image['_classification_accuracy'] = float(accuracy)
 
         # If we have classification results
         if len(classifier_accuracies) > 0:
 
-            # Build confusion matrix as array from classifier_cm
-            all_class_ids = sorted(classname_to_idx.values())
-            classifier_cm_array = np.array(
-                [[classifier_cm[r_idx][c_idx] for c_idx in all_class_ids] for r_idx in all_class_ids], dtype=float)
+            # Normalize each row of the confusion matrix
+            classifier_cm_array = classifier_cm.astype(float)
             classifier_cm_array /= (classifier_cm_array.sum(axis=1, keepdims=True) + 1e-7)
 
             # Print some statistics
@@ -737,8 +888,6 @@ def process_batch_results(options: PostProcessingOptions
             np.savetxt(sio, classifier_cm_array * 100, fmt='%5.1f')
             cm_str = sio.getvalue()
             # Get fixed-size classname for each idx
-            idx_to_classname = {v:k for k,v in classname_to_idx.items()}
-            classname_list = [idx_to_classname[idx] for idx in sorted(classname_to_idx.values())]
             classname_headers = ['{:<5}'.format(cname[:5]) for cname in classname_list]
 
             # Prepend class name on each line and add to the top
@@ -818,7 +967,16 @@ def process_batch_results(options: PostProcessingOptions
             # Filenames should already have been normalized to either '/' or '\'
             files_to_render.append([row['file'], row['max_detection_conf'], row['detections']])
 
-        def render_image_with_gt(file_info):
+        # Renderers only need the rendering options, not the loaded results
+        rendering_options = copy.copy(options)
+        rendering_options.api_detection_results = None
+        rendering_options.api_other_fields = None
+
+        def get_rendering_task_with_gt(file_info):
+            """
+            Returns (arguments to render_bounding_boxes, ground truth class names) for
+            one image, or None if it shouldn't be rendered.
+            """
 
             image_relative_path = file_info[0]
             max_conf = file_info[1]
@@ -867,38 +1025,36 @@ def process_batch_results(options: PostProcessingOptions
                 res.upper(), str(gt_presence), gt_class_summary,
                 max_conf * 100, image_relative_path)
 
-            rendered_image_html_info = render_bounding_boxes(
-                options.image_base_dir,
-                image_relative_path,
-                display_name,
-                detections,
-                res,
-                detection_categories,
-                classification_categories,
-                options)
+            render_args = (options.image_base_dir,
+                           image_relative_path,
+                           display_name,
+                           detections,
+                           res,
+                           detection_categories,
+                           classification_categories,
+                           rendering_options)
+
+            return render_args, gt_classes
+
+        # ...def get_rendering_task_with_gt(file_info)
+
+        start_time = time.time()
+
+        # file_info = files_to_render[0]
+        rendering_tasks = [get_rendering_task_with_gt(file_info) for file_info in files_to_render]
+        rendering_tasks = [task for task in rendering_tasks if task is not None]
+        rendered_image_html_infos = render_images([task[0] for task in rendering_tasks], options)
 
+        for (render_args, gt_classes), rendered_image_html_info in zip(
+                rendering_tasks, rendered_image_html_infos):
             image_result = None
             if len(rendered_image_html_info) > 0:
+                res = render_args[4]
                 image_result = [[res, rendered_image_html_info]]
                 for gt_class in gt_classes:
                     image_result.append(['class_{}'.format(gt_class), rendered_image_html_info])
+            rendering_results.append(image_result)
 
-            return image_result
-
-        # ...def render_image_with_gt(file_info)
-
-        start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_with_gt, files_to_render), total=len(files_to_render)))
-        else:
-            # file_info = files_to_render[0]
-            for file_info in tqdm(files_to_render):
-                rendering_results.append(render_image_with_gt(file_info))
         elapsed = time.time() - start_time
 
         # Map all the rendering results in the list rendering_results into the
@@ -995,11 +1151,11 @@ def process_batch_results(options: PostProcessingOptions
         # Show links to each GT class
         #
         # We could do this without classification results; currently we don't.
-        if len(classname_to_idx) > 0:
+        if len(classname_list) > 0:
 
             index_page += '<h3>Images of specific classes</h3><br/><div class="contentdiv">'
             # Add links to all available classes
-            for cname in sorted(classname_to_idx.keys()):
+            for cname in classname_list:
                 index_page += '<a href="class_{0}.html">{0}</a> ({1})<br>'.format(
                     cname,
                     len(images_html['class_{}'.format(cname)]))
@@ -1086,8 +1242,18 @@ def process_batch_results(options: PostProcessingOptions
                     positive_categories.add(d['category'])
             return sorted(positive_categories)
 
-        # Local function for parallelization
-        def render_image_no_gt(file_info):
+        # Renderers only need the rendering options, not the loaded results
+        rendering_options = copy.copy(options)
+        rendering_options.api_detection_results = None
+        rendering_options.api_other_fields = None
+        almost_detection_rendering_options = copy.copy(rendering_options)
+        almost_detection_rendering_options.confidence_threshold = \
+            options.almost_detection_confidence_threshold
+
+        def get_rendering_task_no_gt(file_info):
+            """
+            Returns (arguments to render_bounding_boxes, detections) for one image.
+            """
 
             image_relative_path = file_info[0]
             max_conf = file_info[1]
@@ -1121,18 +1287,29 @@ def process_batch_results(options: PostProcessingOptions
             display_name = '<b>Result type</b>: {}, <b>Image</b>: {}, <b>Max conf</b>: {:0.3f}'.format(
                 res, image_relative_path, max_conf)
 
-            rendering_options = copy.copy(options)
             if detection_status == DetectionStatus.DS_ALMOST:
-                rendering_options.confidence_threshold = rendering_options.almost_detection_confidence_threshold
-            rendered_image_html_info = render_bounding_boxes(
-                options.image_base_dir,
-                image_relative_path,
-                display_name,
-                detections,
-                res,
-                detection_categories,
-                classification_categories,
-                rendering_options)
+                image_rendering_options = almost_detection_rendering_options
+            else:
+                image_rendering_options = rendering_options
+
+            render_args = (options.image_base_dir,
+                           image_relative_path,
+                           display_name,
+                           detections,
+                           res,
+                           detection_categories,
+                           classification_categories,
+                           image_rendering_options)
+
+            return render_args, detections
+
+        # ...def get_rendering_task_no_gt(file_info):
+
+        def get_image_result_no_gt(res, detections, rendered_image_html_info):
+            """
+            Returns the list of [collection name, html info struct] pairs for one
+            rendered image, or None if it couldn't be rendered.
+            """
 
             image_result = None
 
@@ -1166,19 +1343,18 @@ def process_batch_results(options: PostProcessingOptions
 
             return image_result
 
-        # ...def render_image_no_gt(file_info):
+        # ...def get_image_result_no_gt(...)
 
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_no_gt, files_to_render), total=len(files_to_render)))
-        else:
-            for file_info in tqdm(files_to_render):
-                rendering_results.append(render_image_no_gt(file_info))
+
+        rendering_tasks = [get_rendering_task_no_gt(file_info) for file_info in files_to_render]
+        rendered_image_html_infos = render_images([task[0] for task in rendering_tasks], options)
+
+        for (render_args, detections), rendered_image_html_info in zip(
+                rendering_tasks, rendered_image_html_infos):
+            rendering_results.append(get_image_result_no_gt(
+                render_args[4], detections, rendered_image_html_info))
+
         elapsed = time.time() - start_time
 
         # Map all the rendering results in the list rendering_results into the
@@ -1357,6 +1533,23 @@ def main():
     parser.add_argument(
         '--viz_target_width', type=int, default=options.viz_target_width,
         help='Output image width')
+    parser.add_argument(
+        '--parallelize_rendering', action='store_true',
+        help='Render images in parallel')
+    parser.add_argument(
+        '--parallelize_rendering_n_cores', type=int,
+        default=options.parallelize_rendering_n_cores,
+        help='Number of rendering workers (default: 100 threads, or one process per core)')
+    parser.add_argument(
+        '--parallelize_rendering_with_processes', action='store_false',
+        dest='parallelize_rendering_with_threads',
+        help='Render on a pool of processes rather than threads')
+    parser.add_argument(
+        '--thumbnail_cache_dir', default=options.thumbnail_cache_dir,
+        help='Folder to cache resized images in, for rendering them again later')
+    parser.add_argument(
+        '--results_cache_dir', default=options.results_cache_dir,
+        help='Folder to cache the loaded API output in, for postprocessing it again later')
     parser.add_argument(
         '--random_output_sort', action='store_true',
         help='Sort output randomly (defaults to sorting by filename)')
@@ -0,0 +1,182 @@
+########
+#
+# benchmark_repeat_detections.py
+#
+# Times find_matches_in_directory on one synthetic camera folder, with and without the
+# spatial index of candidate locations (RepeatDetectionOptions.bUseSpatialIndex), and
+# checks that both find the same matches.
+#
+# The folder has a few hundred repeat locations (branches, grass) that show up with some
+# jitter in many images, plus random boxes that each become a new candidate location,
+# so the number of candidates grows to tens of thousands. Comparing every detection to
+# every candidate is quadratic, so without the index only the first --n_compare_images
+# images are run.
+#
+# It also times re-deriving the matches for other thresholds from a MatchGraph (see
+# RepeatDetectionOptions.matchGraphFileToSave), against finding them again, on the
+# first --n_rematch_images images.
+#
+# Sample invocation:
+#
+# python api/batch_processing/postprocessing/repeat_detection_elimination/benchmark_repeat_detections.py --n_detections 1000000
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from api.batch_processing.postprocessing.repeat_detection_elimination import repeat_detections_core
+
+
+#%% Functions
+
+def make_synthetic_folder(n_detections, n_detections_per_image=5, n_repeat_locations=300,
+                          repeat_fraction=0.9, seed=0):
+    """
+    Returns a DataFrame of images in one folder with n_detections detections in total,
+    in the format of load_api_results.
+    """
+    rng = np.random.RandomState(seed)
+    n_images = n_detections // n_detections_per_image
+
+    # Repeat locations, with each coordinate jittered by up to 1% in each image
+    repeat_size = rng.uniform(0.02, 0.3, size=(n_repeat_locations, 2))
+    repeat_xy = rng.uniform(0, 1, size=(n_repeat_locations, 2)) * (1 - repeat_size)
+    repeat_boxes = np.concatenate([repeat_xy, repeat_size], axis=1)
+
+    b_repeat = rng.uniform(size=n_detections) < repeat_fraction
+    boxes = repeat_boxes[rng.randint(0, n_repeat_locations, size=n_detections)]
+    boxes = boxes * (1 + rng.uniform(-0.01, 0.01, size=(n_detections, 4)))
+    random_size = rng.uniform(0.01, 0.4, size=(n_detections, 2))
+    random_xy = rng.uniform(0, 1, size=(n_detections, 2)) * (1 - random_size)
+    boxes[~b_repeat] = np.concatenate([random_xy, random_size], axis=1)[~b_repeat]
+    boxes = np.round(boxes, 4)
+
+    confs = np.round(rng.uniform(0.8, 1.0, size=n_detections), 3)
+    categories = rng.choice(['1', '2', '3'], size=n_detections)
+
+    rows = []
+    for i_image in range(n_images):
+        i_first = i_image * n_detections_per_image
+        detections = [{'category': categories[i], 'conf': confs[i], 'bbox': boxes[i].tolist()}
+                      for i in range(i_first, i_first + n_detections_per_image)]
+        rows.append({'file': 'camera/im{:07d}.jpg'.format(i_image),
+                     'max_detection_conf': max(d['conf'] for d in detections),
+                     'detections': detections})
+    return pd.DataFrame(rows)
+
+
+def time_find_matches(rows, b_use_spatial_index, options=None):
+    """Returns (seconds, list of candidate DetectionLocations) for the images in rows."""
+    if options is None:
+        options = repeat_detections_core.RepeatDetectionOptions()
+    options.bUseSpatialIndex = b_use_spatial_index
+    start_time = time.time()
+    detection_arrays = repeat_detections_core.DetectionArrays(rows)
+    candidates = repeat_detections_core.find_matches_in_directory(
+        'camera', options, detection_arrays)
+    return time.time() - start_time, candidates
+
+
+def summarize_matches(candidates):
+    """Returns a comparable summary of candidate locations and their instances."""
+    return [(candidate.bbox, [(instance.filename, instance.iDetection)
+                              for instance in candidate.instances])
+            for candidate in candidates]
+
+
+def run_benchmark(n_detections, n_compare_images):
+    rows = make_synthetic_folder(n_detections)
+    print('{} images, {} detections'.format(len(rows), n_detections))
+
+    compare_rows = rows.iloc[0:n_compare_images]
+    time_all, candidates_all = time_find_matches(compare_rows, False)
+    time_indexed, candidates_indexed = time_find_matches(compare_rows, True)
+    identical = summarize_matches(candidates_all) == summarize_matches(candidates_indexed)
+
+    print('First {} images: {} candidate locations'.format(
+        len(compare_rows), len(candidates_all)))
+    print('All candidates: {:.2f} s'.format(time_all))
+    print('Spatial index:  {:.2f} s'.format(time_indexed))
+    print('Speedup: {:.1f}x; identical matches: {}'.format(
+        time_all / max(time_indexed, 1e-9), identical))
+
+    time_indexed, candidates_indexed = time_find_matches(rows, True)
+    n_instances = sum(len(candidate.instances) for candidate in candidates_indexed)
+    print('All {} images with the spatial index: {:.2f} s, {} candidate locations, {} instances'.format(
+        len(rows), time_indexed, len(candidates_indexed), n_instances))
+
+    return identical
+
+
+def run_rematch_benchmark(rows, build_iou_threshold, iou_thresholds, max_sizes):
+    options = repeat_detections_core.RepeatDetectionOptions()
+    options.iouThreshold = build_iou_threshold
+    options.maxSuspiciousDetectionSize = max(max_sizes)
+    options.occurrenceThreshold = 1
+    time_build, candidates = time_find_matches(rows, True, options)
+
+    detection_arrays = repeat_detections_core.DetectionArrays(rows)
+    filename_to_row = dict(zip(detection_arrays.files, range(len(detection_arrays.files))))
+    start_time = time.time()
+    match_graph = repeat_detections_core.MatchGraph.from_candidates(
+        [candidates], ['camera'], options, detection_arrays, filename_to_row)
+    time_graph = time.time() - start_time
+    print('First {} images: matching at IoU {} took {:.2f} s, building the match graph {:.2f} s ({} edges)'.format(
+        len(rows), build_iou_threshold, time_build, time_graph, len(match_graph.edgeIous)))
+
+    identical = True
+    for iou_threshold in iou_thresholds:
+        for max_size in max_sizes:
+            options.iouThreshold = iou_threshold
+            options.maxSuspiciousDetectionSize = max_size
+            time_matches, candidates = time_find_matches(rows, True, options)
+            start_time = time.time()
+            candidates_rematched = match_graph.get_candidate_detections(0, options, detection_arrays)
+            time_rematch = time.time() - start_time
+            same = summarize_matches(candidates) == summarize_matches(candidates_rematched)
+            identical = identical and same
+            print('IoU {}, max size {}: matching {:.2f} s, from the match graph {:.2f} s, identical: {}'.format(
+                iou_threshold, max_size, time_matches, time_rematch, same))
+
+    return identical
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark finding repeat detections with and without the spatial index')
+    parser.add_argument(
+        '--n_detections',
+        type=int,
+        default=1000000,
+        help='Number of synthetic detections in the folder; default is 1000000')
+    parser.add_argument(
+        '--n_compare_images',
+        type=int,
+        default=2000,
+        help='Number of images to also run without the spatial index; default is 2000')
+    parser.add_argument(
+        '--n_rematch_images',
+        type=int,
+        default=20000,
+        help='Number of images to re-derive matches for from a match graph; default is 20000')
+    args = parser.parse_args()
+
+    identical = run_benchmark(args.n_detections, args.n_compare_images)
+    assert identical, 'Matches with and without the spatial index differ'
+
+    rows = make_synthetic_folder(args.n_detections).iloc[0:args.n_rematch_images]
+    identical = run_rematch_benchmark(rows, 0.8, [0.8, 0.9, 0.95], [0.2, 0.05])
+    assert identical, 'Matches from the match graph differ from matching again'
+
+
+if __name__ == '__main__':
+    main()
@@ -97,6 +97,10 @@ def main():
                         help='HTML or filtering folder output dir')
     parser.add_argument('--filterFileToLoad', action='store', type=str, default='',  # checks for string length so default needs to be the empty string
                         help='Path to detectionIndex.json, which should be inside a folder of images that are manually verified to _not_ contain valid animals')
+    parser.add_argument('--matchGraphFileToSave', action='store', type=str, default='',
+                        help='.npz file to save all candidate locations to, for re-tuning thresholds with --matchGraphFileToLoad')
+    parser.add_argument('--matchGraphFileToLoad', action='store', type=str, default='',
+                        help='.npz file written with --matchGraphFileToSave; re-derives matches from it rather than comparing boxes (--iouThreshold can only be raised, --maxSuspiciousDetectionSize and the confidence range only narrowed)')
 
     parser.add_argument('--confidenceMax', action='store', type=float,
                         default=defaultOptions.confidenceMax,
@@ -113,6 +117,14 @@ def main():
     parser.add_argument('--nWorkers', action='store', type=int,
                         default=defaultOptions.nWorkers,
                         help='Level of parallelism for rendering and IOU computation')
+    parser.add_argument('--comparisonPoolType', action='store', type=str,
+                        choices=['process', 'thread'],
+                        default=defaultOptions.comparisonPoolType,
+                        help='Use a pool of threads (default) or processes for IOU computation; processes '
+                             'run the comparisons in parallel, threads mostly don\'t')
+    parser.add_argument('--resultsCacheDir', action='store', type=str,
+                        default=defaultOptions.resultsCacheDir,
+                        help='Folder to cache the loaded input file in, for running on it again later')
     parser.add_argument('--maxSuspiciousDetectionSize', action='store', type=float,
                         default=defaultOptions.maxSuspiciousDetectionSize,
                         help='Detections larger than this fraction of image area are not considered suspicious')
@@ -135,6 +147,9 @@ def main():
                         dest='bParallelizeComparisons')
     parser.add_argument('--forceSerialRendering', action='store_false',
                         dest='bParallelizeRendering')
+    parser.add_argument('--noSpatialIndex', action='store_false',
+                        dest='bUseSpatialIndex',
+                        help='Compare each detection to every candidate location in its folder (slower, same results)')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -8,12 +8,15 @@
 
 # %% Imports and environment
 
+import hashlib
+import math
 import os
 import warnings
 from datetime import datetime
 from itertools import compress
 
 import jsonpickle
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
@@ -23,15 +26,17 @@ import write_html_image_list
 import path_utils
 
 from api.batch_processing.postprocessing.load_api_results import load_api_results, write_api_results
+from api.batch_processing.postprocessing.load_api_results import get_detection_arrays
 from api.batch_processing.postprocessing.postprocess_batch_results import is_sas_url
 from api.batch_processing.postprocessing.postprocess_batch_results import relative_sas_url
 
 from visualization.visualization_utils import open_image, render_detection_bounding_boxes
 import ct_utils
 
+from multiprocessing import Pool
+
 # Imports I'm not using but use when I tinker with parallelization
 #
-# from multiprocessing import Pool
 # from multiprocessing.pool import ThreadPool
 # import multiprocessing
 # import joblib
@@ -95,6 +100,18 @@ class RepeatDetectionOptions:
     # text file, one relative filename per line.  See enumerate_images().
     filteredFileListToLoad = None
 
+    # .npz file to save the candidate locations found in every directory to (see
+    # MatchGraph), so they can be loaded with matchGraphFileToLoad to try other
+    # thresholds without comparing boxes again.  Find matches with the lowest
+    # iouThreshold and the largest maxSuspiciousDetectionSize you want to try.
+    matchGraphFileToSave = ''
+
+    # .npz file written via matchGraphFileToSave; if set, candidate locations are
+    # re-derived from this file for the current iouThreshold (which must be at least
+    # the one the file was written with), occurrenceThreshold,
+    # maxSuspiciousDetectionSize and confidence range (which can only be narrowed)
+    matchGraphFileToLoad = ''
+
     # Turn on/off optional outputs
     bRenderHtml = False
     bWriteFilteringFolder = True
@@ -105,6 +122,19 @@ class RepeatDetectionOptions:
     debugMaxRenderInstance = -1
     bParallelizeComparisons = True
     bParallelizeRendering = True
+
+    # Whether bParallelizeComparisons uses a pool of threads ('thread') or processes
+    # ('process').  Finding matches is pure Python, so threads hardly run in parallel;
+    # with processes, each worker gets a directory's boxes as an array (see
+    # find_matches_with_process_pool()).  'process' needs the calling script to be
+    # guarded by if __name__ == '__main__' on Windows and macOS, and doesn't work from
+    # interactive sessions there.
+    comparisonPoolType = 'thread'
+
+    # Only compare each detection to candidate locations that could possibly match
+    # it (see DetectionLocationIndex), rather than to all candidates in the folder.
+    # Gives the same matches either way.
+    bUseSpatialIndex = True
     
     # Determines whether bounding-box rendering errors (typically network errors) should
     # be treated as failures    
@@ -124,6 +154,10 @@ class RepeatDetectionOptions:
     # has changed relative to the structure the detector saw
     filenameReplacements = {}
 
+    # Optional folder to cache the loaded input file in (see load_api_results()), so
+    # that running on the same file again doesn't parse the json.  Needs pyarrow.
+    resultsCacheDir = None
+
     # How many folders up from the leaf nodes should we be going to aggregate images?
     nDirLevelsFromLeaf = 0
 
@@ -143,12 +177,16 @@ class RepeatDetectionResults:
     # The data table after modification
     detectionResultsFiltered = None
 
-    # dict mapping folder names to whole rows from the data table
-    rowsByDirectory = None
+    # The data table in columnar form, grouped by folder (a DetectionArrays object)
+    detectionArrays = None
 
     # dict mapping filenames to rows in the master table
     filenameToRow = None
 
+    # The candidate locations in every directory (a MatchGraph), when finding
+    # matches with matchGraphFileToSave or loading them with matchGraphFileToLoad
+    matchGraph = None
+
     # An array of length nDirs, where each element is a list of DetectionLocation 
     # objects for that directory that have been flagged as suspicious
     suspiciousDetections = None
@@ -205,6 +243,413 @@ class DetectionLocation:
         return detection
 
 
+class DetectionArrays:
+    """
+    The detector output in columnar form for finding repeat detections: per-image and
+    per-detection NumPy arrays (see load_api_results.get_detection_arrays()), with the
+    images and detections of each directory found from directory codes, so nothing
+    iterates over per-row pandas objects.
+    """
+
+    def __init__(self, detectionResults, nDirLevelsFromLeaf=0):
+        """
+        Args:
+            detectionResults: DataFrame from load_api_results()
+            nDirLevelsFromLeaf: see RepeatDetectionOptions.nDirLevelsFromLeaf
+        """
+
+        # Per-image lists and arrays, in the order of detectionResults
+        self.files = detectionResults['file'].tolist()
+        self.detections = detectionResults['detections'].tolist()
+        if 'failure' in detectionResults.columns:
+            self.failures = detectionResults['failure'].tolist()
+        else:
+            self.failures = [None] * len(self.files)
+        self.maxDetectionConf = detectionResults['max_detection_conf'].to_numpy(
+            dtype=np.float64, na_value=np.nan)
+        self.bIsImageFile = np.array([ct_utils.is_image_file(fn) for fn in self.files], dtype=bool)
+        self.bHasDetections = np.array([isinstance(d,list) for d in self.detections], dtype=bool)
+
+        # Per-detection arrays
+        detectionArrays = get_detection_arrays(detectionResults)
+        self.imageIndex = detectionArrays['image_index']
+        self.detectionIndex = detectionArrays['detection_index']
+        self.category = detectionArrays['category']
+        self.conf = detectionArrays['conf']
+        self.bbox = detectionArrays['bbox']
+        self.nDetections = np.bincount(self.imageIndex, minlength=len(self.files))
+        # Position of each image's first detection in the per-detection arrays
+        self.firstDetection = np.cumsum(self.nDetections) - self.nDetections
+
+        # Directory codes, numbered in the order directories first appear
+        dirNames = [DetectionArrays.get_directory_name(fn, nDirLevelsFromLeaf) for fn in self.files]
+        imageDirCodes, dirNames = pd.factorize(np.array(dirNames, dtype=object))
+        self.dirNames = list(dirNames)
+
+        # dicts mapping directory names to the indices of their images and detections
+        self.imageIndicesByDirectory = self._group_by_code(imageDirCodes)
+        self.detectionIndicesByDirectory = self._group_by_code(imageDirCodes[self.imageIndex])
+
+    @staticmethod
+    def get_directory_name(relativePath, nDirLevelsFromLeaf=0):
+        """
+        Returns the directory an image's detections are compared within.
+        """
+        dirName = os.path.dirname(relativePath)
+
+        if len(dirName) == 0:
+            assert nDirLevelsFromLeaf == 0, 'Can''t use the dirLevelsFromLeaf option with flat filenames'
+        else:
+            if nDirLevelsFromLeaf > 0:
+                iLevel = 0
+                while (iLevel < nDirLevelsFromLeaf):
+                    iLevel += 1
+                    dirName = os.path.dirname(dirName)
+            assert len(dirName) > 0
+
+        return dirName
+
+    def _group_by_code(self, codes):
+        """
+        Returns a dict mapping each directory name to the (ascending) positions in
+        codes with that directory's code.
+        """
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(self.dirNames))
+        return dict(zip(self.dirNames, np.split(order, np.cumsum(counts)[:-1])))
+
+
+class DetectionLocationIndex:
+    """
+    The boxes of the DetectionLocations of one directory, in a list and in an [N, 4]
+    array for ct_utils.get_iou_one_to_many() (see get_ious()), with a grid index so a
+    new detection is only compared to the locations that could have an IoU of at least
+    iouThreshold with it.
+
+    If two boxes have IoU >= t (t > 0), their intersection is at least t times the
+    larger box in each dimension, so their widths (and heights) are within a factor
+    of t of each other, and their x_min (and y_min) differ by at most
+    (1 - t) * max(width_a, width_b) <= (1 - t) / t * width_a.
+
+    Locations are hashed by the cell of their (x_min, y_min) on a grid of cellSize,
+    and of their (log width, log height) on a grid of -log(t); candidate_indices()
+    looks up the cells within those bounds, or returns all locations if there are
+    fewer of them than cells to look up. Locations whose boxes can't be hashed (zero,
+    negative or non-finite sizes) are always returned, so they are still compared.
+    With bUseGrid=False, all locations are always returned.
+    """
+
+    # Relative and absolute slack on the bounds, so floating-point rounding can't
+    # exclude a box right at the threshold
+    BOUND_TOLERANCE = 1e-9
+
+    # Below this many candidates, calling get_iou() per pair is faster than the
+    # overhead of ct_utils.get_iou_one_to_many()
+    MIN_VECTORIZED_CANDIDATES = 16
+
+    def __init__(self, iouThreshold, bUseGrid=True, cellSize=0.02):
+        self.iouThreshold = iouThreshold
+        self.cellSize = cellSize
+        self.bIndexed = bUseGrid and iouThreshold > 0
+        if self.bIndexed:
+            self.logSizeRadius = -math.log(min(iouThreshold,1.0))
+            self.logCellSize = max(self.logSizeRadius,DetectionLocationIndex.BOUND_TOLERANCE)
+        self.bboxList = []
+        # self.bboxList as an array; rows beyond len(self.bboxList) are unused
+        self.bboxes = np.empty((64,4))
+        # dict mapping cells to lists of location indices
+        self.cells = {}
+        self.unindexed = []
+        # The smallest and largest occupied cell in each dimension
+        self.minCell = None
+        self.maxCell = None
+
+    def __len__(self):
+        return len(self.bboxList)
+
+    def _is_indexable(self, bbox):
+        return all(math.isfinite(v) for v in bbox) and bbox[2] > 0 and bbox[3] > 0
+
+    def _size_cell(self, size):
+        return math.floor(math.log(size) / self.logCellSize)
+
+    def add(self, bbox):
+        """
+        Adds a location with box bbox ([x_min, y_min, width_of_box, height_of_box]).
+        """
+        iLocation = len(self.bboxList)
+        self.bboxList.append(bbox)
+        if iLocation == len(self.bboxes):
+            self.bboxes = np.concatenate([self.bboxes,np.empty_like(self.bboxes)])
+        self.bboxes[iLocation] = bbox
+        if not self.bIndexed or not self._is_indexable(bbox):
+            self.unindexed.append(iLocation)
+            return
+        cell = (math.floor(bbox[0] / self.cellSize), math.floor(bbox[1] / self.cellSize),
+                self._size_cell(bbox[2]), self._size_cell(bbox[3]))
+        self.cells.setdefault(cell,[]).append(iLocation)
+        if self.minCell is None:
+            self.minCell = cell
+            self.maxCell = cell
+        else:
+            self.minCell = tuple(map(min, self.minCell, cell))
+            self.maxCell = tuple(map(max, self.maxCell, cell))
+
+    def _cell_range(self, v, radius, cellSize, iDim):
+        tolerance = DetectionLocationIndex.BOUND_TOLERANCE
+        radius = radius * (1 + tolerance) + tolerance
+        return range(max(math.floor((v - radius) / cellSize), self.minCell[iDim]),
+                     min(math.floor((v + radius) / cellSize), self.maxCell[iDim]) + 1)
+
+    def candidate_indices(self, bbox):
+        """
+        Returns the indices of the locations that could match bbox, in the order they
+        were added.
+        """
+        if not self.bIndexed or not self._is_indexable(bbox):
+            return list(range(len(self.bboxList)))
+        if self.minCell is None:
+            return list(self.unindexed)
+
+        t = self.iouThreshold
+        x, y, w, h = bbox
+        xCells = self._cell_range(x, (1 - t) / t * w, self.cellSize, 0)
+        yCells = self._cell_range(y, (1 - t) / t * h, self.cellSize, 1)
+        wCells = self._cell_range(math.log(w), self.logSizeRadius, self.logCellSize, 2)
+        hCells = self._cell_range(math.log(h), self.logSizeRadius, self.logCellSize, 3)
+
+        # With low thresholds the bounds can span more cells than there are locations
+        if len(xCells) * len(yCells) * len(wCells) * len(hCells) > len(self.bboxList):
+            return list(range(len(self.bboxList)))
+
+        indices = list(self.unindexed)
+        for xCell in xCells:
+            for yCell in yCells:
+                for wCell in wCells:
+                    for hCell in hCells:
+                        cell = self.cells.get((xCell, yCell, wCell, hCell))
+                        if cell is not None:
+                            indices.extend(cell)
+        indices.sort()
+        return indices
+
+    def get_ious(self, bbox, indices):
+        """
+        Returns a list of the IoUs of bbox with the locations at indices, NaN where
+        either box is malformed.
+        """
+        if len(indices) >= DetectionLocationIndex.MIN_VECTORIZED_CANDIDATES:
+            return ct_utils.get_iou_one_to_many(bbox, self.bboxes[indices]).tolist()
+        ious = []
+        for i in indices:
+            try:
+                ious.append(ct_utils.get_iou(bbox, self.bboxList[i]))
+            except Exception:
+                ious.append(float('nan'))
+        return ious
+
+
+class MatchGraph:
+    """
+    The candidate locations found in every directory, in a form that can be saved and
+    loaded (see RepeatDetectionOptions.matchGraphFileToSave and matchGraphFileToLoad),
+    so suspicious detections can be re-derived for other thresholds without comparing
+    boxes again.
+
+    For each directory, stores the detections that were compared ("nodes", in the
+    order they were compared), which of them started a location ("leaders"), and an
+    edge with the IoU for each location a detection was added to.  match_bboxes adds a
+    detection to *every* earlier location it matches, so the edges hold every IoU >=
+    iouThreshold between a detection and an earlier leader, which is what
+    rematch_bboxes needs to redo the matching for a higher iouThreshold, or for a
+    subset of the detections (a smaller maxSuspiciousDetectionSize or a narrower
+    confidence range).  occurrenceThreshold is only applied afterwards.
+    """
+
+    # Options the graph is built with; see check_options() for how they can change
+    THRESHOLD_NAMES = ['iouThreshold', 'maxSuspiciousDetectionSize', 'confidenceMin',
+                       'confidenceMax', 'nDirLevelsFromLeaf']
+
+    def __init__(self):
+
+        self.iouThreshold = None
+        self.maxSuspiciousDetectionSize = None
+        self.confidenceMin = None
+        self.confidenceMax = None
+        self.nDirLevelsFromLeaf = 0
+        self.excludeClasses = []
+
+        # Identifies the detector output the graph was built from
+        self.filesHash = ''
+        self.nDetections = 0
+
+        self.dirNames = []
+
+        # Nodes, as positions in the per-detection arrays of DetectionArrays; directory
+        # i's nodes are nodeOffsets[i]:nodeOffsets[i+1]
+        self.nodeOffsets = np.zeros(1, dtype=np.int64)
+        self.nodeDetections = np.zeros(0, dtype=np.int64)
+        self.nodeIsLeader = np.zeros(0, dtype=bool)
+
+        # Edges, sorted by node, with nodes and leaders as positions within their
+        # directory's nodes; directory i's edges are edgeOffsets[i]:edgeOffsets[i+1]
+        self.edgeOffsets = np.zeros(1, dtype=np.int64)
+        self.edgeNodes = np.zeros(0, dtype=np.int64)
+        self.edgeLeaders = np.zeros(0, dtype=np.int64)
+        self.edgeIous = np.zeros(0, dtype=np.float64)
+
+    @staticmethod
+    def get_files_hash(files):
+        return hashlib.sha1('\n'.join(files).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_candidates(cls, allCandidateDetections, dirNames, options, detectionArrays, filenameToRow):
+        """
+        Builds the graph from the lists of DetectionLocations found for each directory
+        in dirNames with options.
+        """
+
+        da = detectionArrays
+        graph = cls()
+        for name in MatchGraph.THRESHOLD_NAMES:
+            setattr(graph, name, getattr(options, name))
+        graph.excludeClasses = sorted(options.excludeClasses)
+        graph.filesHash = MatchGraph.get_files_hash(da.files)
+        graph.nDetections = len(da.imageIndex)
+        graph.dirNames = list(dirNames)
+
+        nodeDetections, nodeIsLeader, edgeNodes, edgeLeaders, edgeIous = [], [], [], [], []
+        nodeOffsets, edgeOffsets = [0], [0]
+
+        for candidateDetections in allCandidateDetections:
+
+            # The instances of each location, as positions in the per-detection arrays
+            locations = [np.array([da.firstDetection[filenameToRow[instance.filename]] + instance.iDetection
+                                   for instance in candidate.instances], dtype=np.int64)
+                         for candidate in candidateDetections]
+            leaders = np.array([location[0] for location in locations], dtype=np.int64)
+
+            # Detections were compared in the order of the per-detection arrays
+            nodes = np.unique(np.concatenate([leaders] + locations))
+            bIsLeader = np.zeros(len(nodes), dtype=bool)
+            bIsLeader[np.searchsorted(nodes, leaders)] = True
+
+            dirEdgeNodes = [np.zeros(0, dtype=np.int64)]
+            dirEdgeLeaders = [np.zeros(0, dtype=np.int64)]
+            dirEdgeIous = [np.zeros(0, dtype=np.float64)]
+            for leader, location in zip(leaders, locations):
+                followers = location[1:]
+                dirEdgeNodes.append(followers)
+                dirEdgeLeaders.append(np.full(len(followers), leader))
+                dirEdgeIous.append(ct_utils.get_iou_one_to_many(da.bbox[leader], da.bbox[followers]))
+            dirEdgeNodes = np.searchsorted(nodes, np.concatenate(dirEdgeNodes))
+            dirEdgeLeaders = np.searchsorted(nodes, np.concatenate(dirEdgeLeaders))
+            dirEdgeIous = np.concatenate(dirEdgeIous)
+
+            order = np.lexsort((dirEdgeLeaders, dirEdgeNodes))
+            nodeDetections.append(nodes)
+            nodeIsLeader.append(bIsLeader)
+            edgeNodes.append(dirEdgeNodes[order])
+            edgeLeaders.append(dirEdgeLeaders[order])
+            edgeIous.append(dirEdgeIous[order])
+            nodeOffsets.append(nodeOffsets[-1] + len(nodes))
+            edgeOffsets.append(edgeOffsets[-1] + len(order))
+
+        # ...for each directory
+
+        graph.nodeOffsets = np.array(nodeOffsets, dtype=np.int64)
+        graph.edgeOffsets = np.array(edgeOffsets, dtype=np.int64)
+        graph.nodeDetections = np.concatenate([graph.nodeDetections] + nodeDetections)
+        graph.nodeIsLeader = np.concatenate([graph.nodeIsLeader] + nodeIsLeader)
+        graph.edgeNodes = np.concatenate([graph.edgeNodes] + edgeNodes)
+        graph.edgeLeaders = np.concatenate([graph.edgeLeaders] + edgeLeaders)
+        graph.edgeIous = np.concatenate([graph.edgeIous] + edgeIous)
+        return graph
+
+    ARRAY_NAMES = ['nodeOffsets', 'nodeDetections', 'nodeIsLeader',
+                   'edgeOffsets', 'edgeNodes', 'edgeLeaders', 'edgeIous']
+
+    def save(self, filename):
+        """
+        Writes the graph to a compressed .npz file.
+        """
+        fields = {name: getattr(self, name) for name in MatchGraph.ARRAY_NAMES}
+        for name in MatchGraph.THRESHOLD_NAMES:
+            fields[name] = np.array(getattr(self, name))
+        fields['excludeClasses'] = np.array(self.excludeClasses, dtype=np.int64)
+        fields['filesHash'] = np.array(self.filesHash)
+        fields['nDetections'] = np.array(self.nDetections)
+        fields['dirNames'] = np.array(self.dirNames, dtype=str)
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, **fields)
+
+    @classmethod
+    def load(cls, filename):
+        graph = cls()
+        with np.load(filename, allow_pickle=False) as fields:
+            for name in MatchGraph.ARRAY_NAMES:
+                setattr(graph, name, fields[name])
+            for name in MatchGraph.THRESHOLD_NAMES + ['filesHash', 'nDetections']:
+                setattr(graph, name, fields[name].item())
+            graph.excludeClasses = fields['excludeClasses'].tolist()
+            graph.dirNames = fields['dirNames'].tolist()
+        return graph
+
+    def check_options(self, options, detectionArrays, dirNames):
+        """
+        Asserts that the graph was built from the same detector output and directories,
+        and that options only select detections the graph has.
+        """
+
+        assert self.filesHash == MatchGraph.get_files_hash(detectionArrays.files) and \
+            self.nDetections == len(detectionArrays.imageIndex), \
+            'The match graph was built from different detector output'
+        assert self.nDirLevelsFromLeaf == options.nDirLevelsFromLeaf and self.dirNames == list(dirNames), \
+            'The match graph was built for different directories'
+        assert self.excludeClasses == sorted(options.excludeClasses), \
+            'The match graph was built with excludeClasses {}'.format(self.excludeClasses)
+        assert options.iouThreshold >= self.iouThreshold, \
+            'The match graph was built with iouThreshold {}, which can only be raised'.format(
+                self.iouThreshold)
+        assert options.maxSuspiciousDetectionSize <= self.maxSuspiciousDetectionSize, \
+            'The match graph was built with maxSuspiciousDetectionSize {}, which can only be lowered'.format(
+                self.maxSuspiciousDetectionSize)
+        assert options.confidenceMin >= self.confidenceMin and options.confidenceMax <= self.confidenceMax, \
+            'The match graph was built with confidences from {} to {}, which can only be narrowed'.format(
+                self.confidenceMin, self.confidenceMax)
+
+    def get_candidate_detections(self, iDir, options, detectionArrays):
+        """
+        Returns the list of DetectionLocations in directory iDir for options, leaving
+        out locations with fewer than options.occurrenceThreshold instances.
+        """
+
+        da = detectionArrays
+        iFirstNode, iLastNode = self.nodeOffsets[iDir:iDir+2]
+        iFirstEdge, iLastEdge = self.edgeOffsets[iDir:iDir+2]
+        nodes = self.nodeDetections[iFirstNode:iLastNode]
+
+        # The detections get_detections_to_compare() would return for options
+        confidence = da.conf[nodes]
+        bboxes = da.bbox[nodes]
+        area = bboxes[:,3] * bboxes[:,2]
+        bValid = ~(confidence < options.confidenceMin) & ~(confidence > options.confidenceMax) & \
+            ~(area > options.maxSuspiciousDetectionSize)
+
+        locations = rematch_bboxes(bboxes, self.nodeIsLeader[iFirstNode:iLastNode], bValid,
+                                   self.edgeNodes[iFirstEdge:iLastEdge],
+                                   self.edgeLeaders[iFirstEdge:iLastEdge],
+                                   self.edgeIous[iFirstEdge:iLastEdge],
+                                   options.iouThreshold, options.bUseSpatialIndex)
+        locations = [location for location in locations
+                     if len(location) >= options.occurrenceThreshold]
+
+        # Only make IndexedDetections for the nodes that are left
+        iNodes = sorted(set(i for location in locations for i in location))
+        instances = dict(zip(iNodes, make_indexed_detections(da, nodes[iNodes])))
+        return make_detection_locations(self.dirNames[iDir], instances, locations)
+
+
 ##%% Helper functions
 
 def enumerate_images(dirName,outputFileName=None):
@@ -235,133 +680,318 @@ def render_bounding_box(detection, inputFileName, outputFileName, lineWidth=5, e
     im.save(outputFileName)
 
 
-##%% Look for matches (one directory) (function)
+##%% Look for matches (one directory) (functions)
 
-def find_matches_in_directory(dirName, options, rowsByDirectory):
-        
-    if options.pbar is not None:
-        options.pbar.update()
+def get_detections_to_compare(dirName, options, detectionArrays):
+    """
+    Returns the detections in one directory that could be repeat detections, as a list
+    of IndexedDetections and an [N, 4] float64 array of their boxes.
+    """
 
-    # List of DetectionLocations
-    candidateDetections = []
+    da = detectionArrays
 
-    rows = rowsByDirectory[dirName]
+    # Don't bother checking images with no detections above threshold
+    iImages = da.imageIndicesByDirectory[dirName]
+    bChecked = da.bIsImageFile[iImages] & ~(da.maxDetectionConf[iImages] < options.confidenceMin)
 
-    # iDirectoryRow = 0; row = rows.iloc[iDirectoryRow]
-    for iDirectoryRow, row in rows.iterrows():
+    for iImage in iImages[bChecked & ~da.bHasDetections[iImages]].tolist():
+        assert isinstance(da.failures[iImage],str)
+        print('Skipping failed image {} ({})'.format(da.files[iImage],da.failures[iImage]))
 
-        filename = row['file']
-        if not ct_utils.is_image_file(filename):
-            continue
+    assert np.all(da.nDetections[iImages[bChecked & da.bHasDetections[iImages]]] > 0), \
+        'Image with detections above threshold but an empty detection list in {}'.format(dirName)
 
-        # Don't bother checking images with no detections above threshold
-        maxP = float(row['max_detection_conf'])
-        if maxP < options.confidenceMin:
-            continue
+    # Detections in checked images
+    iDetections = da.detectionIndicesByDirectory[dirName]
+    bChecked = da.bIsImageFile[da.imageIndex[iDetections]] & \
+        ~(da.maxDetectionConf[da.imageIndex[iDetections]] < options.confidenceMin)
+    iDetections = iDetections[bChecked]
 
-        # Array of dicts, where each element is
-        # {
-        #   'category': '1',  # str value, category ID
-        #   'conf': 0.926,  # confidence of this detections
-        #   'bbox': [x_min, y_min, width_of_box, height_of_box]  # (x_min, y_min) is upper-left,
-        #                                                           all in relative coordinates and length
-        # }
-        detections = row['detections']
-        if isinstance(detections,float):
-            assert isinstance(row['failure'],str)
-            print('Skipping failed image {} ({})'.format(filename,row['failure']))
-            continue
-        
-        assert len(detections) > 0
+    confidence = da.conf[iDetections]
 
-        # For each detection in this image
-        for iDetection, detection in enumerate(detections):
-            
-            assert 'category' in detection and 'conf' in detection and 'bbox' in detection
+    # This is no longer strictly true; I sometimes run RDE in stages, so
+    # some probabilities have already been made negative
+    # assert confidence >= 0.0 and confidence <= 1.0
+    assert np.all((confidence >= -1.0) & (confidence <= 1.0))
 
-            confidence = detection['conf']
-            
-            # This is no longer strictly true; I sometimes run RDE in stages, so
-            # some probabilities have already been made negative
-            # assert confidence >= 0.0 and confidence <= 1.0
-            assert confidence >= -1.0 and confidence <= 1.0
-            
-            if confidence < options.confidenceMin:
-                continue
-            if confidence > options.confidenceMax:
-                continue
+    iDetections = iDetections[~(confidence < options.confidenceMin) & ~(confidence > options.confidenceMax)]
 
-            # Optionally exclude some classes from consideration as suspicious
-            if len(options.excludeClasses) > 0:
-                iClass = int(detection['category'])
-                if iClass in options.excludeClasses:
-                    continue
+    # Optionally exclude some classes from consideration as suspicious
+    if len(options.excludeClasses) > 0:
+        iClass = da.category[iDetections].astype(np.int64)
+        iDetections = iDetections[~np.isin(iClass, options.excludeClasses)]
 
-            bbox = detection['bbox']
-            confidence = detection['conf']
-            
-            # Is this detection too big to be suspicious?
-            w, h = bbox[2], bbox[3]
-            
-            if (w == 0 or h == 0):
-                # print('Illegal zero-size bounding box on image {}'.format(filename))
-                continue
-            
-            area = h * w
+    # Is this detection too big to be suspicious?
+    w, h = da.bbox[iDetections,2], da.bbox[iDetections,3]
+    bNonzero = ~((w == 0) | (h == 0))
+    iDetections = iDetections[bNonzero]
+
+    area = h[bNonzero] * w[bNonzero]
+
+    # These are relative coordinates
+    assert np.all((area >= 0.0) & (area <= 1.0)), 'Illegal bounding box area in {}'.format(dirName)
+
+    iDetections = iDetections[~(area > options.maxSuspiciousDetectionSize)]
+
+    return make_indexed_detections(da, iDetections), da.bbox[iDetections]
+
+# ...def get_detections_to_compare(dirName)
+
+
+def make_indexed_detections(detectionArrays, iDetections):
+    """
+    Returns a list of IndexedDetections for positions iDetections in the per-detection
+    arrays of detectionArrays, with the bboxes of the original detection dicts.
+    """
+
+    da = detectionArrays
+    instances = []
+    for iImage, iDetection in zip(da.imageIndex[iDetections].tolist(),
+                                  da.detectionIndex[iDetections].tolist()):
+        detection = da.detections[iImage][iDetection]
+        instance = IndexedDetection(iDetection=iDetection,
+                                    filename=da.files[iImage], bbox=detection['bbox'],
+                                    confidence=detection['conf'], category=detection['category'])
+        instances.append(instance)
+    return instances
+
+
+def match_bboxes(bboxes, iouThreshold, bUseSpatialIndex=True):
+    """
+    Groups the boxes of one directory into locations: each box is added to every
+    existing location whose first box has IoU >= iouThreshold with it, or starts a new
+    location if there is none.
+
+    Args:
+        bboxes: [N, 4] array of [x_min, y_min, width_of_box, height_of_box] boxes
+        iouThreshold: IoU for considering two boxes the same
+        bUseSpatialIndex: see RepeatDetectionOptions.bUseSpatialIndex
+
+    Returns:
+        A list with one element per location: the list of indices into bboxes of the
+        boxes matching it, starting with the box that started the location.
+    """
+
+    locations = []
+
+    # Boxes of locations; without the spatial index, every location is compared
+    locationIndex = DetectionLocationIndex(iouThreshold, bUseGrid=bUseSpatialIndex)
+
+    for iBbox, bbox in enumerate(bboxes.tolist()):
 
-            # These are relative coordinates
-            assert area >= 0.0 and area <= 1.0, 'Illegal bounding box area {}'.format(area)
+        bFoundSimilarDetection = False
 
-            if area > options.maxSuspiciousDetectionSize:
-                # print('Ignoring very large detection with area {}'.format(area))
+        # Compare to each location that could match
+        iCandidates = locationIndex.candidate_indices(bbox)
+        ious = locationIndex.get_ious(bbox, iCandidates)
+
+        for iCandidate, iou in zip(iCandidates, ious):
+
+            # NaN if either box is malformed
+            if iou != iou:
+                candidateBbox = locationIndex.bboxList[iCandidate]
+                print('Warning: IOU computation error on boxes ({},{},{},{}),({},{},{},{}): malformed bounding box'.format(
+                    bbox[0],bbox[1],bbox[2],bbox[3],
+                    candidateBbox[0],candidateBbox[1],candidateBbox[2],candidateBbox[3]))
                 continue
 
-            category = detection['category']
-            
-            instance = IndexedDetection(iDetection=iDetection,
-                                        filename=row['file'], bbox=bbox, 
-                                        confidence=confidence, category=category)
+            # Is this a match?
+            if iou >= iouThreshold:
 
-            bFoundSimilarDetection = False
+                bFoundSimilarDetection = True
 
-            # For each detection in our candidate list
-            for iCandidate, candidate in enumerate(candidateDetections):
+                # If so, add this example to the list for this location
+                locations[iCandidate].append(iBbox)
 
-                # Is this a match?                    
-                try:
-                    iou = ct_utils.get_iou(bbox, candidate.bbox)
-                except Exception as e:
-                    print('Warning: IOU computation error on boxes ({},{},{},{}),({},{},{},{}): {}'.format(
-                        bbox[0],bbox[1],bbox[2],bbox[3],
-                        candidate.bbox[0],candidate.bbox[1],candidate.bbox[2],candidate.bbox[3], str(e)))
-                    continue
+                # We *don't* break here; we allow this instance to possibly
+                # match multiple candidates.  There isn't an obvious right or
+                # wrong here.
 
-                if iou >= options.iouThreshold:
-                    
-                    bFoundSimilarDetection = True
+        # ...for each location that could match
 
-                    # If so, add this example to the list for this detection
-                    candidate.instances.append(instance)
+        # If we found no matches, this is a new location
+        if not bFoundSimilarDetection:
+            locations.append([iBbox])
+            locationIndex.add(bbox)
 
-                    # We *don't* break here; we allow this instance to possibly
-                    # match multiple candidates.  There isn't an obvious right or
-                    # wrong here.
+    # ...for each box
 
-            # ...for each detection on our candidate list
+    return locations
 
-            # If we found no matches, add this to the candidate list
-            if not bFoundSimilarDetection:
-                candidate = DetectionLocation(instance, detection, dirName)
-                candidateDetections.append(candidate)
+# ...def match_bboxes(bboxes)
 
-        # ...for each detection
 
-    # ...for each row
+def rematch_bboxes(bboxes, bIsLeader, bValid, edgeNodes, edgeLeaders, edgeIous,
+                   iouThreshold, bUseSpatialIndex=True):
+    """
+    Returns what match_bboxes(bboxes[bValid], iouThreshold) would, from the matches
+    found by match_bboxes(bboxes, lowerIouThreshold).  Boxes are only compared again
+    to locations started by boxes that didn't start one before ("new leaders"), which
+    happens when a box no longer matches any of the locations it was added to.
+
+    Args:
+        bboxes: [N, 4] array of boxes
+        bIsLeader: [N] bool array, whether each box started a location before
+        bValid: [N] bool array, which boxes to match
+        edgeNodes, edgeLeaders, edgeIous: for every time a box was added to a location
+            before, the box, the box that started the location and their IoU, sorted
+            by box (see MatchGraph)
+        iouThreshold: IoU for considering two boxes the same, at least the one the
+            edges were found with
+        bUseSpatialIndex: see RepeatDetectionOptions.bUseSpatialIndex
+
+    Returns:
+        A list with one element per location, as in match_bboxes, with indices into
+        bboxes rather than into bboxes[bValid].
+    """
+
+    bMatch = bValid[edgeNodes] & bValid[edgeLeaders] & (edgeIous >= iouThreshold)
+    edgeNodes, edgeLeaders = edgeNodes[bMatch], edgeLeaders[bMatch]
 
+    # Find which boxes start a location, in order as match_bboxes does.  A box that
+    # still matches an earlier leader with an edge doesn't; otherwise (and for boxes
+    # that started a location before, which have no edges), compare it to the new
+    # leaders so far.
+    edgeStarts = np.searchsorted(edgeNodes, np.arange(len(bboxes) + 1)).tolist()
+    edgeLeaderList = edgeLeaders.tolist()
+    bboxList = bboxes.tolist()
+
+    bIsCurrentLeader = bIsLeader & bValid
+    bIsCurrentLeaderList = bIsCurrentLeader.tolist()
+    newLeaders = []
+    newLeaderIndex = DetectionLocationIndex(iouThreshold, bUseGrid=bUseSpatialIndex)
+
+    for iBbox in np.flatnonzero(bValid).tolist():
+
+        if any(bIsCurrentLeaderList[edgeLeaderList[iEdge]]
+               for iEdge in range(edgeStarts[iBbox], edgeStarts[iBbox + 1])):
+            continue
+
+        bFoundSimilarDetection = False
+        if len(newLeaders) > 0:
+            bbox = bboxList[iBbox]
+            iCandidates = newLeaderIndex.candidate_indices(bbox)
+            ious = newLeaderIndex.get_ious(bbox, iCandidates)
+            bFoundSimilarDetection = any(iou >= iouThreshold for iou in ious)
+
+        if bFoundSimilarDetection:
+            bIsCurrentLeaderList[iBbox] = False
+        elif not bIsLeader[iBbox]:
+            bIsCurrentLeaderList[iBbox] = True
+            newLeaders.append(iBbox)
+            newLeaderIndex.add(bboxList[iBbox])
+
+    # ...for each box
+
+    bIsCurrentLeader = np.array(bIsCurrentLeaderList, dtype=bool)
+    leaders = np.flatnonzero(bIsCurrentLeader)
+
+    # Boxes matching leaders that started a location before are in the edges
+    bMatch = bIsCurrentLeader[edgeLeaders]
+    locationLeaders = [leaders, edgeLeaders[bMatch]]
+    locationNodes = [leaders, edgeNodes[bMatch]]
+
+    # Boxes matching new leaders are compared to them, looking only at boxes whose
+    # x_min is close enough for an IoU of iouThreshold (see DetectionLocationIndex)
+    if len(newLeaders) > 0:
+        iSorted = np.flatnonzero(bValid)
+        iSorted = iSorted[np.argsort(bboxes[iSorted,0], kind='stable')]
+        xSorted = bboxes[iSorted,0]
+        tolerance = DetectionLocationIndex.BOUND_TOLERANCE
+        for iNewLeader in newLeaders:
+            x, width = bboxes[iNewLeader,0], bboxes[iNewLeader,2]
+            if iouThreshold > 0:
+                radius = (1 - iouThreshold) / iouThreshold * width * (1 + tolerance) + tolerance
+                iFirst = np.searchsorted(xSorted, x - radius, side='left')
+                iLast = np.searchsorted(xSorted, x + radius, side='right')
+                iCandidates = iSorted[iFirst:iLast]
+            else:
+                iCandidates = iSorted
+            iCandidates = iCandidates[iCandidates > iNewLeader]
+            ious = ct_utils.get_iou_one_to_many(bboxes[iNewLeader], bboxes[iCandidates])
+            iMatches = iCandidates[ious >= iouThreshold]
+            locationLeaders.append(np.full(len(iMatches), iNewLeader))
+            locationNodes.append(iMatches)
+
+    if len(leaders) == 0:
+        return []
+    locationLeaders = np.concatenate(locationLeaders)
+    locationNodes = np.concatenate(locationNodes)
+    order = np.lexsort((locationNodes, locationLeaders))
+    counts = np.bincount(np.searchsorted(leaders, locationLeaders), minlength=len(leaders))
+    return [location.tolist() for location in
+            np.split(locationNodes[order], np.cumsum(counts)[:-1])]
+
+# ...def rematch_bboxes(bboxes)
+
+
+def make_detection_locations(dirName, instances, locations):
+    """
+    Returns the list of DetectionLocations for the locations returned by match_bboxes
+    for the instances returned by get_detections_to_compare.
+    """
+
+    candidateDetections = []
+    for iInstances in locations:
+        firstInstance = instances[iInstances[0]]
+        candidate = DetectionLocation(firstInstance, {'bbox': firstInstance.bbox}, dirName)
+        candidate.instances.extend(instances[i] for i in iInstances[1:])
+        candidateDetections.append(candidate)
     return candidateDetections
 
+
+def find_matches_in_directory(dirName, options, detectionArrays):
+        
+    if options.pbar is not None:
+        options.pbar.update()
+
+    instances, bboxes = get_detections_to_compare(dirName, options, detectionArrays)
+    locations = match_bboxes(bboxes, options.iouThreshold, options.bUseSpatialIndex)
+
+    # List of DetectionLocations
+    return make_detection_locations(dirName, instances, locations)
+
 # ...def find_matches_in_directory(dirName)
 
+
+def _match_bboxes_for_directory(args):
+    """
+    Worker for find_matches_with_process_pool, returns (iDir, locations).
+    """
+    iDir, bboxes, iouThreshold, bUseSpatialIndex = args
+    return iDir, match_bboxes(bboxes, iouThreshold, bUseSpatialIndex)
+
+
+def find_matches_with_process_pool(dirNames, options, detectionArrays):
+    """
+    find_matches_in_directory for each directory in dirNames, with the matching on a
+    pool of options.nWorkers processes.
+
+    Only each directory's boxes are sent to the workers, as an array. Directories with
+    the most boxes are sent first, so a large directory doesn't start last and keep one
+    worker busy after the others are done.
+
+    Returns a list with the list of DetectionLocations for each directory.
+    """
+
+    print('Collecting detections to compare...')
+    detectionsByDir = [get_detections_to_compare(dirName, options, detectionArrays)
+                       for dirName in tqdm(dirNames)]
+
+    dirOrder = sorted(range(len(dirNames)), key=lambda iDir: len(detectionsByDir[iDir][1]),
+                      reverse=True)
+    tasks = [(iDir, detectionsByDir[iDir][1], options.iouThreshold, options.bUseSpatialIndex)
+             for iDir in dirOrder]
+
+    allCandidateDetections = [None] * len(dirNames)
+    with Pool(options.nWorkers) as pool:
+        for iDir, locations in tqdm(pool.imap_unordered(_match_bboxes_for_directory, tasks),
+                                    total=len(tasks)):
+            allCandidateDetections[iDir] = make_detection_locations(
+                dirNames[iDir], detectionsByDir[iDir][0], locations)
+
+    return allCandidateDetections
+
     
 ##%% Render problematic locations to html (function)
 
@@ -506,21 +1136,18 @@ def update_detection_table(RepeatDetectionResults, options, outputFilename=None)
 
             locationBbox = detectionEvent.bbox
 
+            # The bbox for each instance should be almost the same as the bbox
+            # for this detection group, where "almost" is defined by the IOU
+            # threshold (NaN, i.e. a malformed box, fails this too).
+            ious = ct_utils.get_iou_one_to_many(
+                locationBbox, [instance.bbox for instance in detectionEvent.instances])
+            assert np.all(ious >= options.iouThreshold)
+
             # For each instance of this suspicious detection
             for iInstance, instance in enumerate(detectionEvent.instances):
 
                 instanceBbox = instance.bbox
 
-                # This should match the bbox for the detection event
-                iou = ct_utils.get_iou(instanceBbox, locationBbox)
-                
-                # The bbox for this instance should be almost the same as the bbox
-                # for this detection group, where "almost" is defined by the IOU
-                # threshold.
-                assert iou >= options.iouThreshold
-                # if iou < options.iouThreshold:
-                #    print('IOU warning: {},{}'.format(iou,options.iouThreshold))
-
                 assert instance.filename in RepeatDetectionResults.filenameToRow
                 iRow = RepeatDetectionResults.filenameToRow[instance.filename]
                 row = detectionResults.iloc[iRow]
@@ -636,7 +1263,8 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
     # Load file
 
     detectionResults, otherFields = load_api_results(inputFilename, normalize_paths=True,
-                                         filename_replacements=options.filenameReplacements)
+                                         filename_replacements=options.filenameReplacements,
+                                         cache_dir=options.resultsCacheDir)
     toReturn.detectionResults = detectionResults
     toReturn.otherFields = otherFields
 
@@ -658,57 +1286,27 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
         
     ##%% Separate files into directories
 
-    # This will be a map from a directory name to smaller data frames
-    rowsByDirectory = {}
-
-    # This is a mapping back into the rows of the original table
-    filenameToRow = {}
-
     # TODO: in the case where we're loading an existing set of FPs after manual filtering,
     # we should load these data frames too, rather than re-building them from the input.
 
     print('Separating files into directories...')
 
-    # iRow = 0; row = detectionResults.iloc[0]
-    for iRow, row in detectionResults.iterrows():
-        relativePath = row['file']
-        dirName = os.path.dirname(relativePath)
-        
-        if len(dirName) == 0:
-            assert options.nDirLevelsFromLeaf == 0, 'Can''t use the dirLevelsFromLeaf option with flat filenames'
-        else:
-            if options.nDirLevelsFromLeaf > 0:
-                iLevel = 0
-                while (iLevel < options.nDirLevelsFromLeaf):
-                    iLevel += 1
-                    dirName = os.path.dirname(dirName)
-            assert len(dirName) > 0
-
-        if not dirName in rowsByDirectory:
-            # Create a new DataFrame with just this row
-            # rowsByDirectory[dirName] = pd.DataFrame(row)
-            rowsByDirectory[dirName] = []
-
-        rowsByDirectory[dirName].append(row)
+    detectionArrays = DetectionArrays(detectionResults, options.nDirLevelsFromLeaf)
 
-        assert relativePath not in filenameToRow
-        filenameToRow[relativePath] = iRow
-
-    # Convert lists of rows to proper DataFrames
-    dirs = list(rowsByDirectory.keys())
-    for d in dirs:
-        rowsByDirectory[d] = pd.DataFrame(rowsByDirectory[d])
+    # This is a mapping back into the rows of the original table
+    filenameToRow = dict(zip(detectionArrays.files, range(len(detectionArrays.files))))
+    assert len(filenameToRow) == len(detectionArrays.files), 'Duplicate filenames in the input file'
 
-    toReturn.rowsByDirectory = rowsByDirectory
+    toReturn.detectionArrays = detectionArrays
     toReturn.filenameToRow = filenameToRow
 
     print('Finished separating {} files into {} directories'.format(len(detectionResults),
-                                                                    len(rowsByDirectory)))
+                                                                    len(detectionArrays.dirNames)))
 
 
     ##% Look for matches (or load them from file)
 
-    dirsToSearch = list(rowsByDirectory.keys())
+    dirsToSearch = list(detectionArrays.dirNames)
     if options.debugMaxDir > 0:
         dirsToSearch = dirsToSearch[0:options.debugMaxDir]
 
@@ -723,21 +1321,45 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
 
         allCandidateDetections = [None] * len(dirsToSearch)
 
-        if not options.bParallelizeComparisons:
+        if len(options.matchGraphFileToLoad) > 0:
+
+            print('Re-deriving matches from {}'.format(options.matchGraphFileToLoad))
+            assert len(options.matchGraphFileToSave) == 0, \
+                'matchGraphFileToSave has no effect with matchGraphFileToLoad'
+            matchGraph = MatchGraph.load(options.matchGraphFileToLoad)
+            matchGraph.check_options(options, detectionArrays, dirsToSearch)
+            toReturn.matchGraph = matchGraph
+            for iDir in tqdm(range(len(dirsToSearch))):
+                allCandidateDetections[iDir] = matchGraph.get_candidate_detections(iDir, options, detectionArrays)
+
+        elif not options.bParallelizeComparisons:
 
             options.pbar = None
             # iDir = 0; dirName = dirsToSearch[iDir]
             for iDir, dirName in enumerate(tqdm(dirsToSearch)):
-                allCandidateDetections[iDir] = find_matches_in_directory(dirName, options, rowsByDirectory)
+                allCandidateDetections[iDir] = find_matches_in_directory(dirName, options, detectionArrays)
+
+        elif options.comparisonPoolType == 'process':
+
+            options.pbar = None
+            allCandidateDetections = find_matches_with_process_pool(dirsToSearch, options, detectionArrays)
 
         else:
 
+            assert options.comparisonPoolType == 'thread', \
+                'Unknown comparisonPoolType {}'.format(options.comparisonPoolType)
             options.pbar = tqdm(total=len(dirsToSearch))
             allCandidateDetections = Parallel(n_jobs=options.nWorkers, prefer='threads')(
-                delayed(find_matches_in_directory)(dirName, options, rowsByDirectory) for dirName in tqdm(dirsToSearch))
+                delayed(find_matches_in_directory)(dirName, options, detectionArrays) for dirName in tqdm(dirsToSearch))
 
         print('\nFinished looking for similar bounding boxes')
 
+        if len(options.matchGraphFileToSave) > 0:
+            print('Writing match graph to {}'.format(options.matchGraphFileToSave))
+            toReturn.matchGraph = MatchGraph.from_candidates(allCandidateDetections, dirsToSearch, options,
+                                                             detectionArrays, filenameToRow)
+            toReturn.matchGraph.save(options.matchGraphFileToSave)
+
         ##%% Find suspicious locations based on match results
 
         print('Filtering out repeat detections...')
@@ -4,6 +4,7 @@ ct_utils.py
 Script with shared utility functions, such as truncating floats
 """
 import argparse
+import concurrent.futures
 import inspect
 import json
 import math
@@ -52,6 +53,40 @@ def truncate_float(x, precision=3):
         return math.floor(x * factor)/factor
 
 
+def truncate_float_ndarray(xs, precision=3):
+    """
+    NumPy version of truncate_float(...), for truncating many floats with array
+    operations. Gives the same values as calling truncate_float(float(x)) on each
+    element, including returning int 0 for elements close to 0.
+
+    Args:
+    xs        (np.ndarray) Array of floats to truncate, any shape
+    precision (int)        The number of significant digits to preserve, should be
+                           greater or equal 1
+
+    Returns:
+    List of Python numbers, in the order of xs.ravel()
+    """
+
+    assert precision > 0
+
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    is_zero = np.isclose(xs, 0)
+
+    # Use 1.0 as a placeholder so log10 is defined; these are replaced by 0 below
+    xs_nonzero = np.where(is_zero, 1.0, xs)
+    exponents = precision - 1 - np.floor(np.log10(np.abs(xs_nonzero))).astype(np.int64)
+
+    # Look up the factor for each distinct exponent with math.pow, as truncate_float does
+    unique_exponents, inverse = np.unique(exponents, return_inverse=True)
+    factors = np.array([math.pow(10, e) for e in unique_exponents.tolist()])[inverse]
+
+    truncated = (np.floor(xs_nonzero * factors) / factors).tolist()
+    for i in np.flatnonzero(is_zero).tolist():
+        truncated[i] = 0
+    return truncated
+
+
 def args_to_object(args: argparse.Namespace, obj: object) -> None:
     """
     Copy all fields from a Namespace (i.e., the output from parse_args) to an
@@ -100,6 +135,61 @@ def is_image_file(s):
     return ext.lower() in image_extensions
 
 
+def _scan_dir(dir_name):
+    """Returns (file paths, subdirectory paths) in dir_name, skipping hidden entries."""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dir_name) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    else:
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        print('Could not list directory {}: {}'.format(dir_name, e))
+    return files, subdirs
+
+
+def iter_files(dir_name, recursive=False, file_filter=None, n_threads=8):
+    """
+    Yields the paths of files in dir_name (and its subdirectories, if recursive) as they
+    are found, listing directories in parallel with os.scandir on n_threads threads. This
+    is much faster than glob on network shares, and callers can start working on the first
+    files before the whole tree has been listed.
+
+    Like glob, skips hidden files and directories (names starting with '.'). The order of
+    the paths is not deterministic; sort them if that matters.
+
+    Args:
+    dir_name    (str)      Directory to list
+    recursive   (bool)     Also list subdirectories
+    file_filter (function) If given, only yield paths for which file_filter(path) is true
+    n_threads   (int)      Number of directories to list at the same time
+    """
+
+    if not recursive:
+        n_threads = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = {executor.submit(_scan_dir, dir_name)}
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                if recursive:
+                    for subdir in subdirs:
+                        pending.add(executor.submit(_scan_dir, subdir))
+                for path in files:
+                    if file_filter is None or file_filter(path):
+                        yield path
+
+
 def convert_xywh_to_tf(api_box):
     """
     Converts an xywh bounding box to an [y_min, x_min, y_max, x_max] box that the TensorFlow
@@ -189,3 +279,91 @@ def get_iou(bb1, bb2):
     assert iou >= 0.0, 'Illegal IOU < 0'
     assert iou <= 1.0, 'Illegal IOU > 1'
     return iou
+
+
+def get_iou_matrix(bboxes_a, bboxes_b):
+    """
+    Vectorized get_iou(...): the IoU of every box in bboxes_a with every box in
+    bboxes_b, with the same float operations as get_iou, so valid pairs get exactly
+    the values get_iou returns.
+
+    Degenerate boxes don't raise as in get_iou: a pair gets NaN wherever get_iou
+    would fail an assertion, i.e. when either box has x_min >= x_max or
+    y_min >= y_max after conversion to [x1,y1,x2,y2] (zero, negative or NaN width
+    or height), or the result is not in [0, 1] (e.g. for infinite boxes). NaN
+    compares False with any threshold, so such pairs never count as a match.
+
+    Args:
+        bboxes_a: array-like of shape [N, 4], rows are [x_min, y_min, width_of_box, height_of_box]
+        bboxes_b: array-like of shape [M, 4], in the same format
+
+    Returns:
+        np.ndarray of shape [N, M], dtype float64
+    """
+
+    bboxes_a = np.asarray(bboxes_a, dtype=np.float64).reshape(-1, 4)
+    bboxes_b = np.asarray(bboxes_b, dtype=np.float64).reshape(-1, 4)
+
+    # [x1, y1, x2, y2] as column vectors for a, row vectors for b
+    ax1, ay1 = bboxes_a[:, 0:1], bboxes_a[:, 1:2]
+    ax2, ay2 = ax1 + bboxes_a[:, 2:3], ay1 + bboxes_a[:, 3:4]
+    bx1, by1 = bboxes_b[:, 0], bboxes_b[:, 1]
+    bx2, by2 = bx1 + bboxes_b[:, 2], by1 + bboxes_b[:, 3]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_left = np.maximum(ax1, bx1)
+        y_top = np.maximum(ay1, by1)
+        x_right = np.minimum(ax2, bx2)
+        y_bottom = np.minimum(ay2, by2)
+
+        no_overlap = (x_right < x_left) | (y_bottom < y_top)
+        intersection_area = np.where(no_overlap, 0.0, (x_right - x_left) * (y_bottom - y_top))
+
+        a_area = (ax2 - ax1) * (ay2 - ay1)
+        b_area = (bx2 - bx1) * (by2 - by1)
+        iou = intersection_area / (a_area + b_area - intersection_area)
+
+        valid = ((ax1 < ax2) & (ay1 < ay2)) & ((bx1 < bx2) & (by1 < by2)) & \
+            (iou >= 0.0) & (iou <= 1.0)
+
+    iou[~valid] = np.nan
+    return iou
+
+
+def get_iou_one_to_many(bbox, bboxes):
+    """
+    The IoU of one box with each of several boxes: get_iou_matrix([bbox], bboxes)[0],
+    with less overhead for small numbers of boxes. See get_iou_matrix(...) for the
+    handling of degenerate boxes.
+
+    Args:
+        bbox: [x_min, y_min, width_of_box, height_of_box]
+        bboxes: array-like of shape [M, 4], in the same format
+
+    Returns:
+        np.ndarray of shape [M], dtype float64
+    """
+
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+
+    ax1, ay1, a_width, a_height = (float(v) for v in bbox)
+    ax2, ay2 = ax1 + a_width, ay1 + a_height
+    bx1, by1 = bboxes[:, 0], bboxes[:, 1]
+    bx2, by2 = bx1 + bboxes[:, 2], by1 + bboxes[:, 3]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        intersection_width = np.minimum(bx2, ax2) - np.maximum(bx1, ax1)
+        intersection_height = np.minimum(by2, ay2) - np.maximum(by1, ay1)
+        intersection_area = intersection_width * intersection_height
+        intersection_area[(intersection_width < 0) | (intersection_height < 0)] = 0.0
+
+        a_area = (ax2 - ax1) * (ay2 - ay1)
+        b_area = (bx2 - bx1) * (by2 - by1)
+        iou = intersection_area / (a_area + b_area - intersection_area)
+
+        valid = (bx1 < bx2) & (by1 < by2) & (iou >= 0.0) & (iou <= 1.0)
+
+    if not (ax1 < ax2 and ay1 < ay2):
+        valid[:] = False
+    iou[~valid] = np.nan
+    return iou
@@ -0,0 +1,99 @@
+r"""
+Microbenchmark for converting raw detector outputs to the batch API output format:
+compares TFDetector._detections_from_output (NumPy, vectorized) with
+TFDetector._detections_from_output_per_box (the per-box Python loop), and checks that
+both produce the same JSON.
+
+Uses synthetic model outputs shaped like MegaDetector's (100 boxes per image, scores
+sorted in descending order, most of them low), so no model file or images are needed.
+
+Sample invocation:
+
+python detection/benchmark_detector_postprocessing.py --n_images 10000
+"""
+
+#%% Constants, imports, environment
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from detection.run_tf_detector import TFDetector
+
+
+#%% Functions
+
+def make_synthetic_outputs(n_images, n_boxes=100, seed=0):
+    """Returns a list of (boxes, scores, classes) float32 arrays, one tuple per image,
+    in the format of the model outputs for one image."""
+    rng = np.random.RandomState(seed)
+    outputs = []
+    for _ in range(n_images):
+        y1x1 = rng.uniform(0, 0.9, size=(n_boxes, 2))
+        hw = rng.uniform(0.01, 0.5, size=(n_boxes, 2))
+        y2x2 = np.minimum(y1x1 + hw, 1.0)
+        boxes = np.concatenate([y1x1, y2x2], axis=1).astype(np.float32)
+
+        # a few confident boxes, then a long tail of low scores
+        scores = np.sort(rng.beta(0.3, 3.0, size=n_boxes))[::-1].astype(np.float32)
+        classes = rng.randint(1, 4, size=n_boxes).astype(np.float32)
+        outputs.append((boxes, scores, classes))
+    return outputs
+
+
+def time_postprocessing(fn, outputs, detection_threshold):
+    """Returns (seconds, list of (detections, max_detection_conf)) for running fn over outputs."""
+    start_time = time.time()
+    converted = [fn(boxes, scores, classes, detection_threshold)
+                 for boxes, scores, classes in outputs]
+    return time.time() - start_time, converted
+
+
+def run_benchmark(n_images, detection_threshold=TFDetector.DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD):
+    outputs = make_synthetic_outputs(n_images)
+
+    time_loop, converted_loop = time_postprocessing(
+        TFDetector._detections_from_output_per_box, outputs, detection_threshold)
+    time_vectorized, converted_vectorized = time_postprocessing(
+        TFDetector._detections_from_output, outputs, detection_threshold)
+
+    identical = json.dumps(converted_loop) == json.dumps(converted_vectorized)
+    n_detections = sum(len(detections) for detections, _ in converted_loop)
+
+    print('{} images, {} detections above {}'.format(n_images, n_detections, detection_threshold))
+    print('Per-box loop: {:.3f} s ({:.1f} us/image)'.format(
+        time_loop, 1e6 * time_loop / n_images))
+    print('Vectorized:   {:.3f} s ({:.1f} us/image)'.format(
+        time_vectorized, 1e6 * time_vectorized / n_images))
+    print('Speedup: {:.1f}x; identical JSON: {}'.format(
+        time_loop / max(time_vectorized, 1e-9), identical))
+
+    return identical
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark vectorized vs. per-box conversion of detector outputs')
+    parser.add_argument(
+        '--n_images',
+        type=int,
+        default=10000,
+        help='Number of synthetic images to convert; default is 10000')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=TFDetector.DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+        help='Confidence threshold for including detections; default is 0.1')
+    args = parser.parse_args()
+
+    identical = run_benchmark(args.n_images, args.threshold)
+    assert identical, 'Vectorized and per-box outputs differ'
+
+
+if __name__ == '__main__':
+    main()
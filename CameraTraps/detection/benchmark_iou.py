@@ -0,0 +1,135 @@
+r"""
+Microbenchmarks for the IoU functions in ct_utils: compares get_iou (one pair at a time)
+with the vectorized get_iou_one_to_many and get_iou_matrix, and checks that they give
+exactly the same values, with NaN wherever get_iou raises on a malformed box.
+
+Uses random boxes in relative coordinates, a few of them degenerate (zero or negative
+width or height, NaN), so no images or detector output are needed.
+
+Sample invocation:
+
+python detection/benchmark_iou.py
+"""
+
+#%% Constants, imports, environment
+
+import argparse
+import time
+
+import numpy as np
+
+from ct_utils import get_iou, get_iou_matrix, get_iou_one_to_many
+
+
+#%% Functions
+
+def make_synthetic_boxes(n_boxes, degenerate_fraction=0.01, seed=0):
+    """Returns an [n_boxes, 4] array of [x_min, y_min, width, height] boxes."""
+    rng = np.random.RandomState(seed)
+    size = rng.uniform(0.01, 0.5, size=(n_boxes, 2))
+    xy = rng.uniform(0, 1, size=(n_boxes, 2)) * (1 - size)
+    boxes = np.concatenate([xy, size], axis=1)
+
+    i_degenerate = np.flatnonzero(rng.uniform(size=n_boxes) < degenerate_fraction)
+    for k, i in enumerate(i_degenerate):
+        boxes[i, 2 + k % 2] = [0.0, -0.1, np.nan][k % 3]
+    return boxes
+
+
+def get_iou_or_nan(bb1, bb2):
+    try:
+        return get_iou(bb1, bb2)
+    except AssertionError:
+        return float('nan')
+
+
+def scalar_iou_matrix(boxes_a, boxes_b):
+    """get_iou_matrix, one get_iou call at a time."""
+    boxes_b = boxes_b.tolist()
+    return np.array([[get_iou_or_nan(a, b) for b in boxes_b] for a in boxes_a.tolist()])
+
+
+def same_values(x, y):
+    """Whether two float arrays are identical, counting NaNs in the same places as equal."""
+    return x.shape == y.shape and bool(np.all((x == y) | (np.isnan(x) & np.isnan(y))))
+
+
+def time_calls(fn, n_calls):
+    start_time = time.time()
+    for _ in range(n_calls):
+        result = fn()
+    return (time.time() - start_time) / n_calls, result
+
+
+def benchmark_one_to_many(n_candidates_list, n_pairs):
+    print('One box against M boxes (get_iou_one_to_many):')
+    identical = True
+    for n_candidates in n_candidates_list:
+        boxes = make_synthetic_boxes(n_candidates + 1, seed=n_candidates)
+        bbox, candidates = boxes[0].tolist(), boxes[1:]
+        n_calls = max(1, n_pairs // n_candidates)
+
+        candidate_list = candidates.tolist()
+        time_scalar, ious_scalar = time_calls(
+            lambda: [get_iou_or_nan(bbox, b) for b in candidate_list], n_calls)
+        time_vectorized, ious_vectorized = time_calls(
+            lambda: get_iou_one_to_many(bbox, candidates), n_calls)
+
+        same = same_values(np.array(ious_scalar), ious_vectorized)
+        identical = identical and same
+        print('M = {:>6}: get_iou {:9.1f} us, vectorized {:9.1f} us, speedup {:6.1f}x, identical: {}'.format(
+            n_candidates, 1e6 * time_scalar, 1e6 * time_vectorized,
+            time_scalar / max(time_vectorized, 1e-12), same))
+    return identical
+
+
+def benchmark_matrix(n_boxes_list):
+    print('N boxes against N boxes (get_iou_matrix):')
+    identical = True
+    for n_boxes in n_boxes_list:
+        boxes_a = make_synthetic_boxes(n_boxes, seed=1)
+        boxes_b = make_synthetic_boxes(n_boxes, seed=2)
+
+        time_scalar, ious_scalar = time_calls(lambda: scalar_iou_matrix(boxes_a, boxes_b), 1)
+        time_vectorized, ious_vectorized = time_calls(lambda: get_iou_matrix(boxes_a, boxes_b), 1)
+
+        same = same_values(ious_scalar, ious_vectorized)
+        identical = identical and same
+        print('N = {:>6}: get_iou {:9.3f} s, vectorized {:9.3f} s, speedup {:6.1f}x, identical: {}'.format(
+            n_boxes, time_scalar, time_vectorized,
+            time_scalar / max(time_vectorized, 1e-12), same))
+    return identical
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark vectorized vs. per-pair IoU computation')
+    parser.add_argument(
+        '--n_candidates',
+        type=int,
+        nargs='+',
+        default=[4, 16, 64, 256, 1024, 10000],
+        help='Numbers of boxes to compare one box against; default is 4 16 64 256 1024 10000')
+    parser.add_argument(
+        '--n_boxes',
+        type=int,
+        nargs='+',
+        default=[10, 100, 1000],
+        help='Numbers of boxes for the N x N IoU matrix; default is 10 100 1000')
+    parser.add_argument(
+        '--n_pairs',
+        type=int,
+        default=100000,
+        help='Approximate number of pairs to time for each one-to-many size; default is 100000')
+    args = parser.parse_args()
+
+    identical = benchmark_one_to_many(args.n_candidates, args.n_pairs)
+    identical = benchmark_matrix(args.n_boxes) and identical
+    assert identical, 'Vectorized and per-pair IoUs differ'
+
+
+if __name__ == '__main__':
+    main()
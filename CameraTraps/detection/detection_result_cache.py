@@ -0,0 +1,197 @@
+r"""
+A persistent on-disk cache of detection results, used by run_tf_detector_batch.py to skip
+images it has already seen (re-uploaded SD cards, renamed camera folders, overlapping runs).
+
+Results are keyed by a hash of the image file's bytes plus everything else that affects
+the result: a hash of the detector file, the confidence threshold, and the decode size.
+The cache does not store the 'file' field; a hit gets the image's current path. Results
+for images that failed to load or run are not cached.
+
+The cache is a SQLite database. When it grows beyond max_size_bytes, the least recently
+used entries are removed on close().
+"""
+
+#%% Constants, imports, environment
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import humanfriendly
+
+
+#%% Classes
+
+class DetectionResultCache:
+    """
+    Persistent cache of per-image detection results, see the module docstring.
+
+    Usage:
+        cache = DetectionResultCache(cache_path, model_file, confidence_threshold)
+        keys = cache.keys_for_images(im_files)
+        result = cache.get(keys[0])  # None on a miss
+        cache.put(keys[0], result)
+        cache.close()
+    """
+
+    DEFAULT_MAX_SIZE_BYTES = 2 * 1024 ** 3
+
+    # Number of threads hashing image files in keys_for_images()
+    N_HASH_THREADS = 8
+
+    # Commit new entries to disk every this many put() calls
+    COMMIT_FREQUENCY = 1000
+
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, cache_path, model_file, confidence_threshold, min_decode_size=None,
+                 max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        """
+        Args
+        - cache_path: str, path to the SQLite cache file; created if it does not exist
+        - model_file: str, path to the .pb detector file the results come from
+        - confidence_threshold: float, threshold used for the results
+        - min_decode_size: int or None, decode size used for the results
+        - max_size_bytes: int, size to shrink the cache to on close()
+        """
+        self.cache_path = cache_path
+        self.max_size_bytes = max_size_bytes
+
+        start_time = time.time()
+        model_hash = DetectionResultCache.hash_file(model_file)
+        print('Hashed detector file in {}'.format(
+            humanfriendly.format_timespan(time.time() - start_time)))
+        self._key_suffix = '_{}_{!r}_{}'.format(model_hash, float(confidence_threshold),
+                                                min_decode_size)
+
+        # results may be written from the writer thread of the pipelined mode
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, result TEXT NOT NULL, size INTEGER NOT NULL, '
+            'last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self._conn.commit()
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_added = 0
+        self.n_evicted = 0
+        self._n_uncommitted = 0
+
+    @staticmethod
+    def hash_file(path):
+        """Returns the SHA-256 hex digest of the contents of the file at path."""
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(DetectionResultCache.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                h.update(block)
+        return h.hexdigest()
+
+    def key_for_image(self, im_file):
+        """Returns the cache key for an image file, or None if the file cannot be read."""
+        try:
+            return DetectionResultCache.hash_file(im_file) + self._key_suffix
+        except OSError as e:
+            print('Image {} cannot be hashed for the result cache. Exception: {}'.format(im_file, e))
+            return None
+
+    def keys_for_images(self, im_files):
+        """Returns the cache keys for a list of image files (None for unreadable files),
+        hashing files on N_HASH_THREADS threads."""
+        if len(im_files) == 0:
+            return []
+        pool = ThreadPool(DetectionResultCache.N_HASH_THREADS)
+        try:
+            return pool.map(self.key_for_image, im_files)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _file_and_key(self, im_file):
+        return im_file, self.key_for_image(im_file)
+
+    def iter_keys_for_images(self, im_files):
+        """Like keys_for_images(), but for a list or an iterable that is still finding files:
+        yields (im_file, key) pairs in the order of im_files as the files are hashed on
+        N_HASH_THREADS threads, so lookups can start before all files are hashed."""
+        pool = ThreadPool(DetectionResultCache.N_HASH_THREADS)
+        try:
+            for im_file, key in pool.imap(self._file_and_key, im_files):
+                yield im_file, key
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get(self, key):
+        """Returns the cached result (without the 'file' field) for key, or None on a miss."""
+        if key is None:
+            self.n_misses += 1
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.n_misses += 1
+                return None
+            self._conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._count_change()
+        self.n_hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """Adds a result to the cache; results with a 'failure' field are not cached."""
+        if key is None or 'failure' in result:
+            return
+        s = json.dumps({k: v for k, v in result.items() if k != 'file'})
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                               (key, s, len(s) + len(key), time.time()))
+            self._count_change()
+        self.n_added += 1
+
+    def _count_change(self):
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= DetectionResultCache.COMMIT_FREQUENCY:
+            self._conn.commit()
+            self._n_uncommitted = 0
+
+    def evict(self):
+        """Removes least recently used entries until the cache is at most max_size_bytes."""
+        with self._lock:
+            total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+            if total_size <= self.max_size_bytes:
+                return
+            to_delete = []
+            for key, size in self._conn.execute('SELECT key, size FROM results ORDER BY last_used'):
+                if total_size <= self.max_size_bytes:
+                    break
+                to_delete.append((key,))
+                total_size -= size
+            self._conn.executemany('DELETE FROM results WHERE key = ?', to_delete)
+            self._conn.commit()
+        self.n_evicted += len(to_delete)
+
+    def print_stats(self):
+        n_lookups = self.n_hits + self.n_misses
+        print('Result cache {}: {} hits, {} misses ({:.1%} hit rate), {} added, {} evicted'.format(
+            self.cache_path, self.n_hits, self.n_misses,
+            self.n_hits / n_lookups if n_lookups > 0 else 0.0, self.n_added, self.n_evicted))
+
+    def close(self):
+        """Commits pending entries, evicts entries over max_size_bytes, prints the stats
+        and closes the cache."""
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.commit()
+        self.evict()
+        self._conn.close()
+        self._conn = None
+        self.print_stats()
@@ -0,0 +1,168 @@
+r"""
+Compares running the detector on JPEGs decoded at full size with decoding them at reduced
+size (--min_decode_size in run_tf_detector_batch.py), on a sample of images.
+
+Reports the time spent decoding in both cases, and how much the detections change:
+
+- the mean and max absolute difference in max_detection_conf
+- the fraction of images whose empty/non-empty call at --threshold changes
+- how many detections above --threshold at full size have a match (same category,
+  IoU >= 0.5) at reduced size, and vice versa
+
+Sample invocation:
+
+python detection/evaluate_decode_size.py "d:\temp\models\md_v4.1.0.pb" "d:\temp\test_images" --min_decode_size 600 --recursive
+"""
+
+#%% Constants, imports, environment
+
+import argparse
+import random
+import statistics
+import time
+
+import humanfriendly
+from tqdm import tqdm
+
+from ct_utils import get_iou
+from detection.run_tf_detector import ImagePathUtils, TFDetector
+import visualization.visualization_utils as viz_utils
+
+
+#%% Functions
+
+def match_detections(detections_a, detections_b, confidence_threshold, iou_threshold=0.5):
+    """Returns the number of detections in detections_a above confidence_threshold, and how
+    many of them overlap a detection of the same category in detections_b (also above
+    confidence_threshold) with IoU >= iou_threshold."""
+    dets_a = [d for d in detections_a if d['conf'] >= confidence_threshold]
+    dets_b = [d for d in detections_b if d['conf'] >= confidence_threshold]
+    n_matched = 0
+    for det_a in dets_a:
+        for det_b in dets_b:
+            if det_a['category'] == det_b['category'] and \
+                    get_iou(det_a['bbox'], det_b['bbox']) >= iou_threshold:
+                n_matched += 1
+                break
+    return len(dets_a), n_matched
+
+
+def detect(tf_detector, im_file, min_decode_size):
+    """Returns (seconds spent decoding, decoded size, result dict) for one image."""
+    start_time = time.time()
+    image = viz_utils.load_image(im_file, min_decode_size=min_decode_size)
+    elapsed = time.time() - start_time
+    result = tf_detector.generate_detections_one_image(image, im_file)
+    return elapsed, image.size, result
+
+
+def evaluate_decode_size(model_file, image_file_names, min_decode_size,
+                         confidence_threshold=TFDetector.DEFAULT_RENDERING_CONFIDENCE_THRESHOLD):
+    tf_detector = TFDetector(model_file)
+
+    time_full, time_reduced = [], []
+    pixels_full, pixels_reduced = [], []
+    conf_diffs = []
+    n_changed_calls = 0
+    n_full, n_full_matched = 0, 0
+    n_reduced, n_reduced_matched = 0, 0
+    n_images = 0
+
+    for im_file in tqdm(image_file_names):
+        try:
+            t_full, size_full, result_full = detect(tf_detector, im_file, None)
+            t_reduced, size_reduced, result_reduced = detect(tf_detector, im_file, min_decode_size)
+        except Exception as e:
+            print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
+            continue
+        if 'failure' in result_full or 'failure' in result_reduced:
+            continue
+
+        n_images += 1
+        time_full.append(t_full)
+        time_reduced.append(t_reduced)
+        pixels_full.append(size_full[0] * size_full[1])
+        pixels_reduced.append(size_reduced[0] * size_reduced[1])
+
+        conf_full = result_full['max_detection_conf']
+        conf_reduced = result_reduced['max_detection_conf']
+        conf_diffs.append(abs(conf_full - conf_reduced))
+        if (conf_full >= confidence_threshold) != (conf_reduced >= confidence_threshold):
+            n_changed_calls += 1
+
+        n, n_matched = match_detections(result_full['detections'], result_reduced['detections'],
+                                        confidence_threshold)
+        n_full += n
+        n_full_matched += n_matched
+        n, n_matched = match_detections(result_reduced['detections'], result_full['detections'],
+                                        confidence_threshold)
+        n_reduced += n
+        n_reduced_matched += n_matched
+
+    if n_images == 0:
+        print('No images could be processed')
+        return
+
+    print('Compared full-size decoding with min_decode_size={} on {} images'.format(
+        min_decode_size, n_images))
+    print('- mean decode time: {} (full), {} (reduced)'.format(
+        humanfriendly.format_timespan(statistics.mean(time_full)),
+        humanfriendly.format_timespan(statistics.mean(time_reduced))))
+    print('- mean decoded pixels: {:.1f} MP (full), {:.1f} MP (reduced)'.format(
+        statistics.mean(pixels_full) / 1e6, statistics.mean(pixels_reduced) / 1e6))
+    print('- max_detection_conf difference: mean {:.4f}, max {:.4f}'.format(
+        statistics.mean(conf_diffs), max(conf_diffs)))
+    print('- empty/non-empty call at {} changed on {} images ({:.2%})'.format(
+        confidence_threshold, n_changed_calls, n_changed_calls / n_images))
+    if n_full > 0:
+        print('- {} of {} full-size detections found at reduced size ({:.2%})'.format(
+            n_full_matched, n_full, n_full_matched / n_full))
+    if n_reduced > 0:
+        print('- {} of {} reduced-size detections found at full size ({:.2%})'.format(
+            n_reduced_matched, n_reduced, n_reduced_matched / n_reduced))
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare detections on JPEGs decoded at full and reduced size')
+    parser.add_argument(
+        'detector_file',
+        help='Path to .pb TensorFlow detector model file')
+    parser.add_argument(
+        'image_dir',
+        help='Directory to search for images')
+    parser.add_argument(
+        '--min_decode_size',
+        type=int,
+        required=True,
+        help='Min length of the shorter image side when decoding at reduced size')
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='Recurse into directories')
+    parser.add_argument(
+        '--n_images',
+        type=int,
+        default=200,
+        help='Number of images to sample; default is 200, -1 uses all images')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=TFDetector.DEFAULT_RENDERING_CONFIDENCE_THRESHOLD,
+        help='Confidence threshold for comparing detections; default is 0.85')
+    args = parser.parse_args()
+
+    image_file_names = ImagePathUtils.find_images(args.image_dir, args.recursive)
+    if 0 < args.n_images < len(image_file_names):
+        random.seed(0)
+        image_file_names = random.sample(image_file_names, args.n_images)
+
+    evaluate_decode_size(args.detector_file, image_file_names, args.min_decode_size,
+                         confidence_threshold=args.threshold)
+
+
+if __name__ == '__main__':
+    main()
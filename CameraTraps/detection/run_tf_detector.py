@@ -41,7 +41,6 @@ https://github.com/tensorflow/models/blob/master/research/object_detection/infer
 #%% Constants, imports, environment
 
 import argparse
-import glob
 import os
 import statistics
 import sys
@@ -52,7 +51,7 @@ import humanfriendly
 import numpy as np
 from tqdm import tqdm
 
-from ct_utils import truncate_float
+from ct_utils import iter_files, truncate_float, truncate_float_ndarray
 import visualization.visualization_utils as viz_utils
 
 # ignoring all "PIL cannot read EXIF metainfo for the images" warnings
@@ -100,25 +99,27 @@ class ImagePathUtils:
         return [s for s in strings if ImagePathUtils.is_image_file(s)]
 
     @staticmethod
-    def find_images(dir_name, recursive=False):
+    def iter_images(dir_name, recursive=False):
         """
-        Find all files in a directory that look like image file names
+        Yield files in a directory that look like image file names as they are found,
+        listing subdirectories in parallel; see ct_utils.iter_files()
         """
-        if recursive:
-            strings = glob.glob(os.path.join(dir_name, '**', '*.*'), recursive=True)
-        else:
-            strings = glob.glob(os.path.join(dir_name, '*.*'))
-
-        image_strings = ImagePathUtils.find_image_files(strings)
+        return iter_files(dir_name, recursive=recursive, file_filter=ImagePathUtils.is_image_file)
 
-        return image_strings
+    @staticmethod
+    def find_images(dir_name, recursive=False):
+        """
+        Find all files in a directory that look like image file names, sorted
+        """
+        return sorted(ImagePathUtils.iter_images(dir_name, recursive))
 
 
 class TFDetector:
     """
     A detector model loaded at the time of initialization. It is intended to be used with
-    the MegaDetector (TF). The inference batch size is set to 1; code needs to be modified
-    to support larger batch sizes, including resizing appropriately.
+    the MegaDetector (TF). generate_detections_one_image() runs with a batch size of 1;
+    generate_detections_batch() stacks images of the same size into one batch, since the
+    graph does its own resizing and cannot take images of different sizes in one tensor.
     """
 
     # Number of decimal places to round to for confidence and bbox coordinates
@@ -222,10 +223,6 @@ class TFDetector:
         np_im = np.asarray(image, np.uint8)
         im_w_batch_dim = np.expand_dims(np_im, axis=0)
 
-        # need to change the above line to the following if supporting a batch size > 1 and resizing to the same size
-        # np_images = [np.asarray(image, np.uint8) for image in images]
-        # images_stacked = np.stack(np_images, axis=0) if len(images) > 1 else np.expand_dims(np_images[0], axis=0)
-
         # performs inference
         (box_tensor_out, score_tensor_out, class_tensor_out) = self.tf_session.run(
             [self.box_tensor, self.score_tensor, self.class_tensor],
@@ -233,6 +230,85 @@ class TFDetector:
 
         return box_tensor_out, score_tensor_out, class_tensor_out
 
+    def _generate_detections_batch(self, images):
+        """Runs inference on a list of PIL images that all have the same size, in one
+        tf_session.run() call."""
+        np_images = [np.asarray(image, np.uint8) for image in images]
+        images_stacked = np.stack(np_images, axis=0)
+
+        (box_tensor_out, score_tensor_out, class_tensor_out) = self.tf_session.run(
+            [self.box_tensor, self.score_tensor, self.class_tensor],
+            feed_dict={self.image_tensor: images_stacked})
+
+        return box_tensor_out, score_tensor_out, class_tensor_out
+
+    @staticmethod
+    def _detections_from_output(boxes, scores, classes, detection_threshold):
+        """Converts the model outputs for one image (no batch dimension) to a list of
+        detection objects and the max detection confidence, as used in the output format.
+
+        Filtering, coordinate conversion and truncation are done with array operations;
+        the output is the same as that of _detections_from_output_per_box().
+        """
+        boxes = np.asarray(boxes)
+        scores = np.asarray(scores)
+
+        # Compare in float64, as the per-box loop does; comparing float32 scores with the
+        # threshold directly would be done in float32 under NumPy 2 and in float64 before
+        keep = scores.astype(np.float64) > float(detection_threshold)
+        if not np.any(keep):
+            return [], 0
+
+        kept_boxes = boxes[keep]
+        kept_scores = scores[keep]
+        kept_classes = np.asarray(classes)[keep]
+
+        # change from [y1, x1, y2, x2] to [x1, y1, width, height]; width and height are
+        # computed in the model's output precision, as in __convert_coords
+        coords = np.stack([kept_boxes[:, 1],
+                           kept_boxes[:, 0],
+                           kept_boxes[:, 3] - kept_boxes[:, 1],
+                           kept_boxes[:, 2] - kept_boxes[:, 0]], axis=1)
+
+        confs = truncate_float_ndarray(kept_scores, precision=TFDetector.CONF_DIGITS)
+        bboxes = truncate_float_ndarray(coords, precision=TFDetector.COORD_DIGITS)
+
+        detections_cur_image = [
+            {
+                'category': str(c),  # use string type for the numerical class label, not int
+                'conf': confs[i],
+                'bbox': bboxes[i * 4:(i + 1) * 4]
+            }
+            for i, c in enumerate(kept_classes.astype(np.int64).tolist())
+        ]
+
+        max_detection_conf = truncate_float(max(float(kept_scores.max()), 0.0),
+                                            precision=TFDetector.CONF_DIGITS)
+        return detections_cur_image, max_detection_conf
+
+    @staticmethod
+    def _detections_from_output_per_box(boxes, scores, classes, detection_threshold):
+        """Same as _detections_from_output(), looping over the boxes in Python; kept as a
+        reference for testing and benchmarking the vectorized version.
+        """
+        detections_cur_image = []  # will be empty for an image with no confident detections
+        max_detection_conf = 0.0
+        for b, s, c in zip(boxes, scores, classes):
+            if float(s) > float(detection_threshold):
+                detection_entry = {
+                    'category': str(int(c)),  # use string type for the numerical class label, not int
+                    'conf': truncate_float(float(s),  # cast to float for json serialization
+                                           precision=TFDetector.CONF_DIGITS),
+                    'bbox': TFDetector.__convert_coords(b)
+                }
+                detections_cur_image.append(detection_entry)
+                if s > max_detection_conf:
+                    max_detection_conf = s
+
+        max_detection_conf = truncate_float(float(max_detection_conf),
+                                            precision=TFDetector.CONF_DIGITS)
+        return detections_cur_image, max_detection_conf
+
     def generate_detections_one_image(self, image, image_id,
                                       detection_threshold=DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD):
         """Apply the detector to an image.
@@ -255,25 +331,11 @@ class TFDetector:
         try:
             b_box, b_score, b_class = self._generate_detections_one_image(image)
 
-            # our batch size is 1; need to loop the batch dim if supporting batch size > 1
-            boxes, scores, classes = b_box[0], b_score[0], b_class[0]
-
-            detections_cur_image = []  # will be empty for an image with no confident detections
-            max_detection_conf = 0.0
-            for b, s, c in zip(boxes, scores, classes):
-                if s > detection_threshold:
-                    detection_entry = {
-                        'category': str(int(c)),  # use string type for the numerical class label, not int
-                        'conf': truncate_float(float(s),  # cast to float for json serialization
-                                               precision=TFDetector.CONF_DIGITS),
-                        'bbox': TFDetector.__convert_coords(b)
-                    }
-                    detections_cur_image.append(detection_entry)
-                    if s > max_detection_conf:
-                        max_detection_conf = s
+            # our batch size is 1
+            detections_cur_image, max_detection_conf = TFDetector._detections_from_output(
+                b_box[0], b_score[0], b_class[0], detection_threshold)
 
-            result['max_detection_conf'] = truncate_float(float(max_detection_conf),
-                                                          precision=TFDetector.CONF_DIGITS)
+            result['max_detection_conf'] = max_detection_conf
             result['detections'] = detections_cur_image
 
         except Exception as e:
@@ -282,13 +344,84 @@ class TFDetector:
 
         return result
 
+    def generate_detections_batch(self, images, image_ids,
+                                  detection_threshold=DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+                                  batch_size=None):
+        """Apply the detector to a list of images.
+
+        Images are grouped by size (camera traps typically produce only a handful of
+        resolutions per deployment), and each group is run through the model in one
+        session call, or in chunks of batch_size if that is specified. Each image's
+        result is the same as what generate_detections_one_image() would produce.
+
+        Args:
+            images: list of PIL Image objects
+            image_ids: list of paths to identify the images, in the same order as images
+            detection_threshold: confidence above which to include the detection proposal
+            batch_size: int, max number of images per session call; None for no limit
+
+        Returns:
+        A list of result dicts in the same order as images, each in the format returned
+        by generate_detections_one_image()
+        """
+        assert len(images) == len(image_ids), 'images and image_ids need to have the same length'
+
+        # image size -> list of indices into images
+        size_to_indices = {}
+        for i_image, image in enumerate(images):
+            size_to_indices.setdefault(image.size, []).append(i_image)
+
+        results = [None] * len(images)
+
+        for indices in size_to_indices.values():
+
+            if batch_size is None or batch_size < 1:
+                batches = [indices]
+            else:
+                batches = [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+            for batch in batches:
+                try:
+                    b_box, b_score, b_class = self._generate_detections_batch(
+                        [images[i] for i in batch])
+                except Exception as e:
+                    print('TFDetector: batch of {} images failed during inference: {}'.format(
+                        len(batch), str(e)))
+                    for i_image in batch:
+                        results[i_image] = {
+                            'file': image_ids[i_image],
+                            'failure': TFDetector.FAILURE_TF_INFER
+                        }
+                    continue
+
+                for i_batch, i_image in enumerate(batch):
+                    result = {
+                        'file': image_ids[i_image]
+                    }
+                    try:
+                        detections_cur_image, max_detection_conf = TFDetector._detections_from_output(
+                            b_box[i_batch], b_score[i_batch], b_class[i_batch], detection_threshold)
+                        result['max_detection_conf'] = max_detection_conf
+                        result['detections'] = detections_cur_image
+                    except Exception as e:
+                        result['failure'] = TFDetector.FAILURE_TF_INFER
+                        print('TFDetector: image {} failed during inference: {}'.format(
+                            image_ids[i_image], str(e)))
+                    results[i_image] = result
+
+        return results
+
 
 #%% Main function
 
 def load_and_run_detector(model_file, image_file_names, output_dir,
                           render_confidence_threshold=TFDetector.DEFAULT_RENDERING_CONFIDENCE_THRESHOLD,
-                          crop_images=False):
-    """Load and run detector on target images, and visualize the results."""
+                          crop_images=False, min_decode_size=None):
+    """Load and run detector on target images, and visualize the results.
+
+    If min_decode_size is given, JPEG images are decoded at reduced size (see
+    viz_utils.set_jpeg_draft_size()), so rendered output images are smaller as well.
+    """
     if len(image_file_names) == 0:
         print('Warning: no files available')
         return
@@ -355,7 +488,7 @@ def load_and_run_detector(model_file, image_file_names, output_dir,
         try:
             start_time = time.time()
 
-            image = viz_utils.load_image(im_file)
+            image = viz_utils.load_image(im_file, min_decode_size=min_decode_size)
 
             elapsed = time.time() - start_time
             time_load.append(elapsed)
@@ -456,6 +589,12 @@ def main():
         action="store_true",
         help=('If set, produces separate output images for each crop, '
               'rather than adding bounding boxes to the original image'))
+    parser.add_argument(
+        '--min_decode_size',
+        type=int,
+        default=None,
+        help=('Decode JPEG images at 1/2, 1/4 or 1/8 scale, as long as the shorter side stays at '
+              'least this many pixels; by default, images are decoded at full size'))
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         parser.exit()
@@ -485,7 +624,8 @@ def main():
                           image_file_names=image_file_names,
                           output_dir=args.output_dir,
                           render_confidence_threshold=args.threshold,
-                          crop_images=args.crop)
+                          crop_images=args.crop,
+                          min_decode_size=args.min_decode_size)
 
 
 if __name__ == '__main__':
@@ -15,12 +15,48 @@ are processed and final results file written to output_file,
 the temporary checkpoint file will be deleted. If you want to resume from a checkpoint,
 set the checkpoint file's path using --resume_from_checkpoint.
 
+Checkpoints are append-only journals (.jsonl), with one result per line; each result is
+written once as it comes in, and the file is fsync'ed every n images. A line cut off by a
+crash is dropped when resuming, and resuming from a journal keeps appending to it.
+Checkpoints in the older format (a .json file with an 'images' list, rewritten in full
+every n images) can still be resumed from.
+
 The `threshold` you can provide as an argument is the confidence threshold above which detections
 will be included in the output file.
 
 Has preliminary multiprocessing support for CPUs only; if a GPU is available, it will
-use the GPU instead of CPUs, and the --ncores option will be ignored.  Checkpointing
-is not supported when using multiprocessing.
+use the GPU instead of CPUs, and the --ncores option will be ignored.  With --ncores n > 1,
+n worker processes each load the model once and take work units (of --batch_size images)
+from a shared queue; results come back in input order, so checkpointing and resuming
+work the same way as with a single process.
+
+Set --batch_size to n > 1 to load n images at a time and run images of the same size
+through the model in one call, which saves per-call session overhead. Results are the
+same as with the default batch size of 1.
+
+Set --loader_threads to n > 0 to load and decode images on n threads, feeding a queue of
+at most --prefetch_size images, while inference runs; results are handled on a separate
+writer thread. A summary of how busy each stage was is printed at the end.
+
+Set --stream_output to write each result to output_file as it comes in, rather than
+keeping all results in memory and writing them at the end.
+
+Set --min_decode_size to n to decode JPEGs directly at 1/2, 1/4 or 1/8 of their size (the
+smallest that keeps the shorter side at least n pixels). The model resizes its input anyway,
+so this mostly saves decoding time and memory; use evaluate_decode_size.py to check how
+much it changes the detections on your images.
+
+Set --result_cache to a file path to keep a persistent cache of results, keyed by a hash
+of each image file's contents, the detector file and the options that affect results.
+Images found in the cache are not loaded or run again, even if they were moved or renamed
+(the 'file' field always has the current path). The cache is trimmed to
+--result_cache_max_size at the end of each run, and hits and misses are reported.
+
+When image_file is a directory, images are listed with parallel os.scandir calls and passed
+to the detector as they are found, so the results are in the order the files were found
+rather than sorted. Set --sort_images to list the whole directory first and run the images
+in sorted order (which output_record.py --stream needs). Set --image_list_file to save the
+list of images found, and to read it instead of listing the directory on the next run.
 
 Sample invocation:
 
@@ -30,11 +66,14 @@ python run_tf_detector_batch.py "d:\temp\models\md_v4.1.0.pb" "d:\temp\test_imag
 #%% Constants, imports, environment
 
 import argparse
+import collections
 import json
 import os
 import sys
 import time
 import copy
+import queue
+import threading
 import warnings
 import itertools
 
@@ -54,6 +93,7 @@ if force_cpu:
     os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
 from detection.run_tf_detector import ImagePathUtils, TFDetector
+from detection.detection_result_cache import DetectionResultCache
 import visualization.visualization_utils as viz_utils
 
 # Numpy FutureWarnings from tensorflow import
@@ -65,6 +105,36 @@ print('TensorFlow version:', tf.__version__)
 print('tf.test.is_gpu_available:', tf.test.is_gpu_available())
 
 
+#%% Support functions for iterating over image files
+
+def _len_or_none(items):
+    """Returns len(items), or None if items is an iterator of unknown length."""
+    return len(items) if isinstance(items, (list, tuple)) else None
+
+
+def _iter_chunks(items, n):
+    """Yields lists of up to n consecutive elements of a list or iterable."""
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def save_image_list_when_done(image_file_names, image_list_file):
+    """Passes through an iterable of image paths, and writes them as a sorted JSON list to
+    image_list_file once it is exhausted, so the next run can read the list instead of
+    listing the directory again."""
+    found = []
+    for im_file in image_file_names:
+        found.append(im_file)
+        yield im_file
+    with open(image_list_file, 'w') as f:
+        json.dump(sorted(found), f, indent=1)
+    print('Saved the list of {} images to {}'.format(len(found), image_list_file))
+
+
 #%% Support functions for multiprocessing
 
 def process_images(im_files, tf_detector, confidence_threshold):
@@ -91,13 +161,15 @@ def process_images(im_files, tf_detector, confidence_threshold):
     return results
 
 
-def process_image(im_file, tf_detector, confidence_threshold):
+def process_image(im_file, tf_detector, confidence_threshold, min_decode_size=None):
     """Runs the MegaDetector over a single image file.
 
     Args
     - im_file: str, path to image file
     - tf_detector: TFDetector, loaded model
     - confidence_threshold: float, only detections above this threshold are returned
+    - min_decode_size: int, if given, decode JPEG images at reduced size, keeping the shorter
+        side at least this many pixels; see viz_utils.set_jpeg_draft_size()
 
     Returns:
     - result: dict representing detections on one image
@@ -105,7 +177,7 @@ def process_image(im_file, tf_detector, confidence_threshold):
     """
     print('Processing image {}'.format(im_file))
     try:
-        image = viz_utils.load_image(im_file)
+        image = viz_utils.load_image(im_file, min_decode_size=min_decode_size)
     except Exception as e:
         print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
         result = {
@@ -128,92 +200,638 @@ def process_image(im_file, tf_detector, confidence_threshold):
     return result
 
 
-def chunks_by_number_of_chunks(ls, n):
-    """Splits a list into n even chunks.
+def process_image_batch(im_files, tf_detector, confidence_threshold, min_decode_size=None):
+    """Runs the MegaDetector over a list of image files, batching together images of
+    the same size in one inference call.
 
     Args
-    - ls: list
-    - n: int, # of chunks
+    - im_files: list of str, paths to image files
+    - tf_detector: TFDetector, loaded model
+    - confidence_threshold: float, only detections above this threshold are returned
+    - min_decode_size: int, if given, decode JPEG images at reduced size, keeping the shorter
+        side at least this many pixels; see viz_utils.set_jpeg_draft_size()
+
+    Returns
+    - results: list of dict in the same order as im_files, each dict represents detections
+        on one image, see the 'images' key in https://github.com/microsoft/CameraTraps/tree/master/api/batch_processing#batch-processing-api-output-format
+    """
+    results = [None] * len(im_files)
+
+    images = []
+    image_indices = []
+    for i_file, im_file in enumerate(im_files):
+        print('Processing image {}'.format(im_file))
+        try:
+            image = viz_utils.load_image(im_file, min_decode_size=min_decode_size)
+        except Exception as e:
+            print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
+            results[i_file] = {
+                'file': im_file,
+                'failure': TFDetector.FAILURE_IMAGE_OPEN
+            }
+            continue
+        images.append(image)
+        image_indices.append(i_file)
+
+    if len(images) > 0:
+        batch_results = tf_detector.generate_detections_batch(
+            images, [im_files[i] for i in image_indices], detection_threshold=confidence_threshold)
+        for i_file, result in zip(image_indices, batch_results):
+            results[i_file] = result
+
+    return results
+
+
+# Detector used by each worker process when n_cores > 1; loaded once per process
+# by _init_pool_worker()
+_pool_worker_detector = None
+
+
+def _init_pool_worker(model_file):
+    global _pool_worker_detector
+    start_time = time.time()
+    _pool_worker_detector = TFDetector(model_file)
+    elapsed = time.time() - start_time
+    print('Loaded model (worker process {}) in {}'.format(os.getpid(),
+                                                         humanfriendly.format_timespan(elapsed)))
+
+
+def _process_work_unit(im_files, confidence_threshold, min_decode_size=None):
+    """Runs the worker process's detector over one work unit (a list of image files)."""
+    if len(im_files) > 1:
+        return process_image_batch(im_files, _pool_worker_detector, confidence_threshold,
+                                   min_decode_size=min_decode_size)
+    return [process_image(im_file, _pool_worker_detector, confidence_threshold,
+                          min_decode_size=min_decode_size)
+            for im_file in im_files]
+
+
+#%% Support functions for pipelined inference
+
+def _pipeline_loader(input_queue, frame_queue, busy_times, i_thread, min_decode_size=None):
+    """Loader stage: loads images named in input_queue and puts them on frame_queue.
+
+    Each item put on frame_queue is (index, im_file, image, failure_result), where
+    image is None and failure_result is a result dict if the image could not be loaded.
+    Puts a None on frame_queue when input_queue is exhausted.
+    """
+    while True:
+        item = input_queue.get()
+        if item is None:
+            break
+        i_file, im_file = item
+        start_time = time.time()
+        try:
+            image = viz_utils.load_image(im_file, min_decode_size=min_decode_size)
+            frame = (i_file, im_file, image, None)
+        except Exception as e:
+            print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
+            frame = (i_file, im_file, None, {
+                'file': im_file,
+                'failure': TFDetector.FAILURE_IMAGE_OPEN
+            })
+        busy_times[i_thread] += time.time() - start_time
+        frame_queue.put(frame)
+    frame_queue.put(None)
+
+
+def _pipeline_writer(result_queue, result_callback, stats, errors):
+    """Writer stage: passes results from result_queue to result_callback in input order.
+
+    Items on result_queue are (index, result); a None ends the stage.
     """
-    for i in range(0, n):
-        yield ls[i::n]
+    pending = {}
+    next_index = 0
+    while True:
+        item = result_queue.get()
+        if item is None:
+            break
+        i_file, result = item
+        pending[i_file] = result
+        start_time = time.time()
+        while next_index in pending:
+            result = pending.pop(next_index)
+            next_index += 1
+            if len(errors) > 0:
+                continue
+            try:
+                result_callback(result)
+            except Exception as e:
+                errors.append(e)
+        stats['writer'] += time.time() - start_time
+
+
+def process_images_pipelined(im_files, tf_detector, confidence_threshold, result_callback,
+                             n_loader_threads=4, prefetch_size=32, batch_size=1,
+                             min_decode_size=None):
+    """Runs the MegaDetector over a list of image files, with loading, inference and
+    result handling running as separate stages so the model does not wait on disk
+    access and JPEG decoding:
+
+    - n_loader_threads threads load images into a queue holding at most prefetch_size images
+    - the calling thread runs inference on images from that queue, up to batch_size at a time
+    - a writer thread passes each result to result_callback, in the order of im_files
+
+    Args
+    - im_files: list or iterable of str, paths to image files
+    - tf_detector: TFDetector, loaded model
+    - confidence_threshold: float, only detections above this threshold are returned
+    - result_callback: function taking one result dict; called from the writer thread
+    - n_loader_threads: int, # of threads loading images
+    - prefetch_size: int, max # of loaded images waiting for inference
+    - batch_size: int, max # of images per inference call
+    - min_decode_size: int, if given, decode JPEG images at reduced size, keeping the shorter
+        side at least this many pixels; see viz_utils.set_jpeg_draft_size()
+
+    Returns
+    - stats: dict with the wall time and the busy time of each stage, in seconds; see
+        print_pipeline_stats()
+    """
+    assert n_loader_threads > 0, 'n_loader_threads needs to be > 0'
+
+    # im_files may be a generator that is still finding files, so feed the loaders from
+    # a separate thread
+    input_queue = queue.Queue()
+
+    # An error iterating im_files is raised once the images already queued are done; it
+    # is not added to errors right away, since that would stop the writer from writing
+    # their results
+    feeder_errors = []
+
+    def feed_input_queue():
+        try:
+            for i_file, im_file in enumerate(im_files):
+                input_queue.put((i_file, im_file))
+        except Exception as e:
+            feeder_errors.append(e)
+        finally:
+            for _ in range(n_loader_threads):
+                input_queue.put(None)
+
+    frame_queue = queue.Queue(maxsize=max(prefetch_size, 1))
+    result_queue = queue.Queue()
+
+    loader_busy_times = [0.0] * n_loader_threads
+    stats = {
+        'n_loader_threads': n_loader_threads,
+        'loader': 0.0,
+        'inference': 0.0,
+        'inference_wait': 0.0,
+        'writer': 0.0
+    }
+    errors = []
+
+    start_time = time.time()
+
+    loaders = [threading.Thread(target=_pipeline_loader,
+                                args=(input_queue, frame_queue, loader_busy_times, i_thread,
+                                      min_decode_size),
+                                daemon=True)
+               for i_thread in range(n_loader_threads)]
+    writer = threading.Thread(target=_pipeline_writer,
+                              args=(result_queue, result_callback, stats, errors),
+                              daemon=True)
+    feeder = threading.Thread(target=feed_input_queue, daemon=True)
+    feeder.start()
+    for t in loaders:
+        t.start()
+    writer.start()
+
+    n_loaders_done = 0
+    with tqdm(total=_len_or_none(im_files)) as pbar:
+        while n_loaders_done < n_loader_threads:
+
+            # Block for the first frame of a batch, then take whatever else is ready
+            wait_start = time.time()
+            frame = frame_queue.get()
+            stats['inference_wait'] += time.time() - wait_start
+
+            frames = []
+            while True:
+                if frame is None:
+                    n_loaders_done += 1
+                elif frame[2] is None:
+                    result_queue.put((frame[0], frame[3]))
+                    pbar.update(1)
+                else:
+                    frames.append(frame)
+                if len(frames) >= batch_size or n_loaders_done == n_loader_threads:
+                    break
+                try:
+                    frame = frame_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if len(frames) == 0:
+                continue
+
+            infer_start = time.time()
+            for i_frame, im_file, _, _ in frames:
+                print('Processing image {}'.format(im_file))
+            if len(frames) == 1:
+                i_frame, im_file, image, _ = frames[0]
+                results = [tf_detector.generate_detections_one_image(
+                    image, im_file, detection_threshold=confidence_threshold)]
+            else:
+                results = tf_detector.generate_detections_batch(
+                    [f[2] for f in frames], [f[1] for f in frames],
+                    detection_threshold=confidence_threshold)
+            stats['inference'] += time.time() - infer_start
+
+            for frame, result in zip(frames, results):
+                result_queue.put((frame[0], result))
+            pbar.update(len(frames))
+
+    result_queue.put(None)
+    feeder.join()
+    for t in loaders:
+        t.join()
+    writer.join()
+
+    stats['wall'] = time.time() - start_time
+    stats['loader'] = sum(loader_busy_times)
+
+    errors.extend(feeder_errors)
+    if len(errors) > 0:
+        raise errors[0]
+
+    return stats
+
+
+def print_pipeline_stats(stats):
+    """Prints the stage utilization summary returned by process_images_pipelined()."""
+    wall = max(stats['wall'], 1e-9)
+    print('Pipeline finished in {}; stage utilization:'.format(
+        humanfriendly.format_timespan(stats['wall'])))
+    print('- loading ({} threads): {:.1%}'.format(
+        stats['n_loader_threads'], stats['loader'] / (wall * stats['n_loader_threads'])))
+    print('- inference: {:.1%} (waited {} for images)'.format(
+        stats['inference'] / wall, humanfriendly.format_timespan(stats['inference_wait'])))
+    print('- writing: {:.1%}'.format(stats['writer'] / wall))
+
+
+#%% Checkpoint journal functions
+
+def read_checkpoint_journal(journal_path, truncate_partial_line=False):
+    """Reads the results in a checkpoint journal, a file with one JSON-encoded result
+    per line.
+
+    A last line that is incomplete or cannot be parsed (e.g. because the process was
+    killed while writing it) is skipped with a warning.
+
+    Args
+    - journal_path: str, path to .jsonl checkpoint journal
+    - truncate_partial_line: bool, if True, also remove the incomplete last line from the
+        file, so more results can be appended to it
+
+    Returns
+    - results: list of dict, each dict represents detections on one image
+    """
+    results = []
+    valid_length = 0
+    with open(journal_path, 'rb') as f:
+        lines = f.readlines()
+
+    for i_line, line in enumerate(lines):
+        try:
+            if not line.endswith(b'\n'):
+                raise ValueError('line is not terminated')
+            if len(line.strip()) > 0:
+                results.append(json.loads(line.decode('utf-8')))
+        except ValueError as e:
+            if i_line < len(lines) - 1:
+                raise ValueError('Checkpoint journal {} is corrupt at line {}: {}'.format(
+                    journal_path, i_line + 1, e))
+            print('Warning: skipping incomplete last line of checkpoint journal {}'.format(journal_path))
+            break
+        valid_length += len(line)
+
+    if truncate_partial_line and valid_length < sum(len(line) for line in lines):
+        with open(journal_path, 'r+b') as f:
+            f.truncate(valid_length)
+
+    return results
+
+
+def append_to_checkpoint_journal(journal_file, results, sync=False):
+    """Appends results to an open checkpoint journal, one line per result.
+
+    Args
+    - journal_file: file object opened for appending in text mode
+    - results: list of dict, each dict represents detections on one image
+    - sync: bool, flush and fsync the file after writing, so the results are on disk
+    """
+    for result in results:
+        journal_file.write(json.dumps(result) + '\n')
+    if sync:
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def load_checkpoint(checkpoint_path, truncate_partial_line=False):
+    """Loads results from a checkpoint, either a .jsonl journal or a .json file with an
+    'images' field.
+
+    Returns
+    - results: list of dict, each dict represents detections on one image
+    """
+    if checkpoint_path.endswith('.jsonl'):
+        return read_checkpoint_journal(checkpoint_path, truncate_partial_line=truncate_partial_line)
+
+    with open(checkpoint_path) as f:
+        saved = json.load(f)
+    assert 'images' in saved, \
+        'The file saved as checkpoint does not have the correct fields; cannot be restored'
+    return saved['images']
+
+
+#%% Output file writer
+
+class ResultsFileWriter:
+    """
+    Writes detection results to a JSON output file in the batch API format
+    (https://github.com/microsoft/CameraTraps/tree/master/api/batch_processing#batch-processing-api-output-format)
+    one image at a time, so the full list of results never needs to be in memory. The
+    file is the same as what json.dump(..., indent=1) produces for the whole output
+    object; 'detection_categories' and 'info' are written by close().
+
+    Usage:
+        with ResultsFileWriter(output_file) as writer:
+            for result in results:
+                writer.write(result)
+    """
+
+    def __init__(self, output_file, relative_path_base=None):
+        """
+        Args
+        - output_file: str, path to JSON output file, should end in '.json'
+        - relative_path_base: str, path to a directory as the base for relative paths
+        """
+        self.output_file = output_file
+        self.relative_path_base = relative_path_base
+        self.n_images = 0
+        self._f = open(output_file, 'w')
+        self._f.write('{\n "images": [')
+
+    def write(self, result):
+        """Writes one image's result dict to the 'images' list."""
+        if self.relative_path_base is not None:
+            result = copy.copy(result)
+            result['file'] = os.path.relpath(result['file'], start=self.relative_path_base)
+
+        # Entries in the 'images' list are two levels deep in the output object
+        s = json.dumps(result, indent=1).replace('\n', '\n  ')
+        self._f.write(('\n  ' if self.n_images == 0 else ',\n  ') + s)
+        self.n_images += 1
+
+    def close(self):
+        """Finishes the 'images' list, writes the rest of the output object and closes the file."""
+        if self._f is None:
+            return
+        self._f.write('],\n' if self.n_images == 0 else '\n ],\n')
+        rest = {
+            'detection_categories': TFDetector.DEFAULT_DETECTOR_LABEL_MAP,
+            'info': {
+                'detection_completion_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                'format_version': '1.0'
+            }
+        }
+        # Drop the opening brace, the rest lines up with the 'images' key
+        self._f.write(json.dumps(rest, indent=1)[2:])
+        self._f.close()
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 #%% Main function
 
 def load_and_run_detector_batch(model_file, image_file_names, checkpoint_path=None,
                                 confidence_threshold=0, checkpoint_frequency=-1,
-                                results=None, n_cores=0):
+                                results=None, n_cores=0, batch_size=TFDetector.BATCH_SIZE,
+                                n_loader_threads=0, prefetch_size=32, results_writer=None,
+                                min_decode_size=None, result_cache=None):
     """
     Args
-    - model_file: str, path to .pb model file
-    - image_file_names: list of str, paths to image files
-    - checkpoint_path: str, path to JSON checkpoint file
+    - model_file: str, path to .pb model file, or TFDetector (loaded model) if n_cores <= 1
+    - image_file_names: list of str, paths to image files; can also be an iterable that is
+        still finding files (e.g. ImagePathUtils.iter_images()), so inference can start on
+        the first images right away
+    - checkpoint_path: str, path to checkpoint file; if it ends in .jsonl, new results are
+        appended to it as a journal, otherwise all results are written to it as JSON
     - confidence_threshold: float, only detections above this threshold are returned
-    - checkpoint_frequency: int, write results to JSON checkpoint file every N images
+    - checkpoint_frequency: int, write results to checkpoint file every N images
     - results: list of dict, existing results loaded from checkpoint
     - n_cores: int, # of CPU cores to use
+    - batch_size: int, # of images to load before running inference; images of the same
+        size within a batch are run through the model in one call
+    - n_loader_threads: int, if > 0, load images on this many threads while running
+        inference (see process_images_pipelined); only applies when n_cores <= 1
+    - prefetch_size: int, max # of loaded images waiting for inference when n_loader_threads > 0
+    - results_writer: ResultsFileWriter; if given, the results passed in and all new results
+        are written to it as they come in instead of being kept in memory. Requires a .jsonl
+        checkpoint_path if checkpointing.
+    - min_decode_size: int, if given, decode JPEG images at reduced size, keeping the shorter
+        side at least this many pixels; see viz_utils.set_jpeg_draft_size()
+    - result_cache: DetectionResultCache; if given, images whose results are in the cache
+        are not loaded or run, and new results are added to the cache. The cache needs to
+        have been created with the same model_file, confidence_threshold and min_decode_size.
 
     Returns
-    - results: list of dict, each dict represents detections on one image
+    - results: list of dict, each dict represents detections on one image; new results
+        are appended in the order of image_file_names. Empty if results_writer is given.
     """
     if results is None:
         results = []
 
+    if results_writer is not None:
+        assert checkpoint_frequency == -1 or checkpoint_path.endswith('.jsonl'), \
+            'Writing results as they come in requires a .jsonl checkpoint journal'
+
     already_processed = set([i['file'] for i in results])
 
+    if results_writer is not None:
+        for result in results:
+            results_writer.write(result)
+        results.clear()
+
+    # Will not add additional entries not in the starter checkpoint
+    def not_processed(im_file):
+        if im_file in already_processed:
+            print('Bypassing image {}'.format(im_file))
+            return False
+        return True
+
+    im_files_to_process = filter(not_processed, image_file_names)
+    if isinstance(image_file_names, list):
+        im_files_to_process = list(im_files_to_process)
+
+    # Does not count those already processed
+    count = 0
+
+    journal_file = None
+    if checkpoint_frequency != -1 and checkpoint_path.endswith('.jsonl'):
+        journal_file = open(checkpoint_path, 'a')
+
+    def write_result(result):
+        nonlocal count
+        count += 1
+        if results_writer is not None:
+            results_writer.write(result)
+        else:
+            results.append(result)
+
+        if journal_file is not None:
+            sync = count % checkpoint_frequency == 0
+            if sync:
+                print('Syncing the checkpoint journal after having processed {} images since last restart'.format(count))
+            append_to_checkpoint_journal(journal_file, [result], sync=sync)
+
+        # checkpoint
+        elif checkpoint_frequency != -1 and count % checkpoint_frequency == 0:
+            print('Writing a new checkpoint after having processed {} images since last restart'.format(count))
+            with open(checkpoint_path, 'w') as f:
+                json.dump({'images': results}, f)
+
+    im_files_to_run = im_files_to_process
+    write_run_result = write_result
+
+    if result_cache is not None:
+
+        # Look up images in the cache as they are found and hashed, and only run the
+        # misses. pending holds, in input order, the cached results and the keys of the
+        # images being run whose results have not been written yet; cached results are
+        # written as soon as everything before them is, so results stay in input order.
+        # The misses may be taken by another thread than the one writing results.
+        pending = collections.deque()
+        pending_lock = threading.Lock()
+
+        def write_cached_results():
+            while len(pending) > 0 and pending[0][0] is not None:
+                write_result(pending.popleft()[0])
+
+        def iter_cache_misses():
+            for im_file, key in result_cache.iter_keys_for_images(im_files_to_process):
+                cached = result_cache.get(key)
+                if cached is not None:
+                    result = {'file': im_file}
+                    result.update(cached)
+                    with pending_lock:
+                        pending.append((result, None))
+                        write_cached_results()
+                else:
+                    pending.append((None, key))
+                    yield im_file
+
+        def write_run_result(result):
+            with pending_lock:
+                write_cached_results()
+                _, key = pending.popleft()
+                result_cache.put(key, result)
+                write_result(result)
+
+        im_files_to_run = iter_cache_misses()
+
     if n_cores > 1 and tf.test.is_gpu_available():
         print('Warning: multiple cores requested, but a GPU is available; parallelization across GPUs is not currently supported, defaulting to one GPU')
 
-    # If we're not using multiprocessing...
-    if n_cores <= 1 or tf.test.is_gpu_available():
+    try:
+        # Everything may come from the cache, in which case we don't load the model
+        b_run = True
+        if result_cache is not None:
+            first_im_file = next(im_files_to_run, None)
+            b_run = first_im_file is not None
+            im_files_to_run = itertools.chain([first_im_file], im_files_to_run)
+        if b_run:
+            _run_detector(model_file, im_files_to_run, confidence_threshold, write_run_result,
+                          n_cores=n_cores, batch_size=batch_size,
+                          n_loader_threads=n_loader_threads, prefetch_size=prefetch_size,
+                          min_decode_size=min_decode_size)
+        if result_cache is not None:
+            with pending_lock:
+                write_cached_results()
+            assert len(pending) == 0, 'Missing results for images run'
+    finally:
+        if journal_file is not None:
+            append_to_checkpoint_journal(journal_file, [], sync=True)
+            journal_file.close()
 
-        # Load the detector
-        start_time = time.time()
-        tf_detector = TFDetector(model_file)
-        elapsed = time.time() - start_time
-        print('Loaded model in {}'.format(humanfriendly.format_timespan(elapsed)))
+    # results may have been modified in place, but we also return it for backwards-compatibility.
+    return results
 
-        # Does not count those already processed
-        count = 0
 
-        for im_file in tqdm(image_file_names):
+def _run_detector(model_file, im_files_to_process, confidence_threshold, write_result,
+                  n_cores, batch_size, n_loader_threads, prefetch_size, min_decode_size):
+    """Runs the detector over im_files_to_process, calling write_result on each result in
+    input order; see load_and_run_detector_batch() for the other arguments."""
 
-            # Will not add additional entries not in the starter checkpoint
-            if im_file in already_processed:
-                print('Bypassing image {}'.format(im_file))
-                continue
+    # If we're not using multiprocessing...
+    if n_cores <= 1 or tf.test.is_gpu_available():
 
-            count += 1
+        # Load the detector, unless it is already loaded
+        if isinstance(model_file, TFDetector):
+            tf_detector = model_file
+        else:
+            start_time = time.time()
+            tf_detector = TFDetector(model_file)
+            elapsed = time.time() - start_time
+            print('Loaded model in {}'.format(humanfriendly.format_timespan(elapsed)))
 
-            result = process_image(im_file, tf_detector, confidence_threshold)
-            results.append(result)
+        if n_loader_threads > 0:
 
-            # checkpoint
-            if checkpoint_frequency != -1 and count % checkpoint_frequency == 0:
-                print('Writing a new checkpoint after having processed {} images since last restart'.format(count))
-                with open(checkpoint_path, 'w') as f:
-                    json.dump({'images': results}, f)
+            stats = process_images_pipelined(im_files_to_process, tf_detector, confidence_threshold,
+                                             write_result, n_loader_threads=n_loader_threads,
+                                             prefetch_size=prefetch_size, batch_size=batch_size,
+                                             min_decode_size=min_decode_size)
+            print_pipeline_stats(stats)
 
-    else:
-        # when using multiprocessing, let the workers load the model
-        tf_detector = model_file
+        elif batch_size <= 1:
 
-        print('Creating pool with {} cores'.format(n_cores))
+            for im_file in tqdm(im_files_to_process, total=_len_or_none(im_files_to_process)):
+                write_result(process_image(im_file, tf_detector, confidence_threshold,
+                                           min_decode_size=min_decode_size))
 
-        if len(already_processed) > 0:
-            print('Warning: when using multiprocessing, all images are reprocessed')
+        else:
 
-        pool = workerpool(n_cores)
+            with tqdm(total=_len_or_none(im_files_to_process)) as pbar:
+                for im_files in _iter_chunks(im_files_to_process, batch_size):
+                    for result in process_image_batch(im_files, tf_detector, confidence_threshold,
+                                                      min_decode_size=min_decode_size):
+                        write_result(result)
+                    pbar.update(len(im_files))
 
-        image_batches = list(chunks_by_number_of_chunks(image_file_names, n_cores))
-        results = pool.map(partial(process_images, tf_detector=tf_detector,
-                                   confidence_threshold=confidence_threshold), image_batches)
+    else:
 
-        results = list(itertools.chain.from_iterable(results))
+        # Each worker loads the model once, then takes work units of batch_size images
+        # from the pool's task queue; imap() returns results in input order as they
+        # complete, so we can checkpoint while the pool is running.
+        assert isinstance(model_file, str), 'Worker processes need the path to the model file'
+        print('Creating pool with {} cores'.format(n_cores))
 
-    # results may have been modified in place, but we also return it for backwards-compatibility.
-    return results
+        work_units = _iter_chunks(im_files_to_process, batch_size)
+
+        pool = workerpool(n_cores, initializer=_init_pool_worker, initargs=(model_file,))
+        try:
+            with tqdm(total=_len_or_none(im_files_to_process)) as pbar:
+                for unit_results in pool.imap(partial(_process_work_unit,
+                                                      confidence_threshold=confidence_threshold,
+                                                      min_decode_size=min_decode_size),
+                                              work_units):
+                    for result in unit_results:
+                        write_result(result)
+                    pbar.update(len(unit_results))
+        except BaseException:
+            # On an error or Ctrl+C, stop the workers rather than waiting for the work units
+            # still queued
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
 
 
 def write_results_to_file(results, output_file, relative_path_base=None):
@@ -225,24 +843,9 @@ def write_results_to_file(results, output_file, relative_path_base=None):
     - output_file: str, path to JSON output file, should end in '.json'
     - relative_path_base: str, path to a directory as the base for relative paths
     """
-    if relative_path_base is not None:
-        results_relative = []
+    with ResultsFileWriter(output_file, relative_path_base=relative_path_base) as writer:
         for r in results:
-            r_relative = copy.copy(r)
-            r_relative['file'] = os.path.relpath(r_relative['file'], start=relative_path_base)
-            results_relative.append(r_relative)
-        results = results_relative
-
-    final_output = {
-        'images': results,
-        'detection_categories': TFDetector.DEFAULT_DETECTOR_LABEL_MAP,
-        'info': {
-            'detection_completion_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
-            'format_version': '1.0'
-        }
-    }
-    with open(output_file, 'w') as f:
-        json.dump(final_output, f, indent=1)
+            writer.write(r)
     print('Output file saved at {}'.format(output_file))
 
 
@@ -265,6 +868,17 @@ def main():
         '--recursive',
         action='store_true',
         help='Recurse into directories, only meaningful if image_file points to a directory')
+    parser.add_argument(
+        '--image_list_file',
+        help='Path to a JSON list of image paths, only meaningful if image_file points to a directory. '
+             'If the file exists, images are read from it instead of listing the directory; '
+             'otherwise the images found in the directory are saved to it for the next run')
+    parser.add_argument(
+        '--sort_images',
+        action='store_true',
+        help='List the whole directory first and run the images in sorted order, so the results '
+             'are in sorted order (as output_record.py --stream needs); only meaningful if '
+             'image_file points to a directory. By default, images are run as they are found')
     parser.add_argument(
         '--output_relative_filenames',
         action='store_true',
@@ -281,12 +895,52 @@ def main():
         help='Write results to a temporary file every N images; default is -1, which disables this feature')
     parser.add_argument(
         '--resume_from_checkpoint',
-        help='Path to a JSON checkpoint file to resume from, must be in same directory as output_file')
+        help='Path to a checkpoint file (.jsonl journal or .json) to resume from, must be in same '
+             'directory as output_file; a .jsonl journal is appended to as the new checkpoint')
     parser.add_argument(
         '--ncores',
         type=int,
         default=0,
-        help='Number of cores to use; only applies to CPU-based inference, does not support checkpointing when ncores > 1')
+        help='Number of cores to use; only applies to CPU-based inference')
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=TFDetector.BATCH_SIZE,
+        help='Number of images to load before running inference; images of the same size are run '
+             'through the model together. Default is 1. When ncores > 1, also the number of images '
+             'in each work unit taken by a worker process')
+    parser.add_argument(
+        '--loader_threads',
+        type=int,
+        default=0,
+        help='Number of threads loading images while inference runs; default is 0, which loads '
+             'images one at a time on the inference thread. Ignored when ncores > 1')
+    parser.add_argument(
+        '--prefetch_size',
+        type=int,
+        default=32,
+        help='Max number of loaded images waiting for inference when loader_threads > 0; default is 32')
+    parser.add_argument(
+        '--stream_output',
+        action='store_true',
+        help='Write results to output_file as they come in rather than keeping them all in memory '
+             'until the end; output_file is incomplete until the run finishes')
+    parser.add_argument(
+        '--min_decode_size',
+        type=int,
+        default=None,
+        help='Decode JPEG images at 1/2, 1/4 or 1/8 scale, as long as the shorter side stays at least '
+             'this many pixels; faster and uses less memory than decoding at full size. By default, '
+             'images are decoded at full size')
+    parser.add_argument(
+        '--result_cache',
+        help='Path to a result cache file (created if it does not exist); images whose contents '
+             'were already run with the same detector file and options are not run again')
+    parser.add_argument(
+        '--result_cache_max_size',
+        default='2GB',
+        help='Size the result cache is trimmed to at the end of the run, least recently used '
+             'entries first; default is 2GB')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -299,6 +953,11 @@ def main():
     assert args.output_file.endswith('.json'), 'output_file specified needs to end with .json'
     if args.checkpoint_frequency != -1:
         assert args.checkpoint_frequency > 0, 'Checkpoint_frequency needs to be > 0 or == -1'
+    assert args.batch_size > 0, 'batch_size needs to be > 0'
+    assert args.loader_threads >= 0, 'loader_threads needs to be >= 0'
+    assert args.prefetch_size > 0, 'prefetch_size needs to be > 0'
+    if args.min_decode_size is not None:
+        assert args.min_decode_size > 0, 'min_decode_size needs to be > 0'
     if args.output_relative_filenames:
         assert os.path.isdir(args.image_file), 'image_file must be a directory when --output_relative_filenames is set'
 
@@ -311,19 +970,30 @@ def main():
     # still full paths.
     if args.resume_from_checkpoint:
         assert os.path.exists(args.resume_from_checkpoint), 'File at resume_from_checkpoint specified does not exist'
-        with open(args.resume_from_checkpoint) as f:
-            saved = json.load(f)
-        assert 'images' in saved, \
-            'The file saved as checkpoint does not have the correct fields; cannot be restored'
-        results = saved['images']
+        results = load_checkpoint(args.resume_from_checkpoint, truncate_partial_line=True)
         print('Restored {} entries from the checkpoint'.format(len(results)))
     else:
         results = []
 
     # Find the images to score; images can be a directory, may need to recurse
     if os.path.isdir(args.image_file):
-        image_file_names = ImagePathUtils.find_images(args.image_file, args.recursive)
-        print('{} image files found in the input directory'.format(len(image_file_names)))
+        if args.image_list_file and os.path.exists(args.image_list_file):
+            with open(args.image_list_file) as f:
+                image_file_names = json.load(f)
+            print('{} image files found in the image list {}'.format(len(image_file_names),
+                                                                     args.image_list_file))
+        elif args.sort_images:
+            image_file_names = ImagePathUtils.find_images(args.image_file, args.recursive)
+            print('{} image files found in the input directory'.format(len(image_file_names)))
+            if args.image_list_file:
+                with open(args.image_list_file, 'w') as f:
+                    json.dump(image_file_names, f, indent=1)
+        else:
+            # Images are passed on as they are found, so inference can start right away
+            image_file_names = ImagePathUtils.iter_images(args.image_file, args.recursive)
+            if args.image_list_file:
+                image_file_names = save_image_list_when_done(image_file_names, args.image_list_file)
+            print('Listing images in the input directory while running the detector')
     # A json list of image paths
     elif os.path.isfile(args.image_file) and args.image_file.endswith('.json'):
         with open(args.image_file) as f:
@@ -337,8 +1007,9 @@ def main():
         raise ValueError('image_file specified is not a directory, a json list, or an image file, '
                          '(or does not have recognizable extensions).')
 
-    assert len(image_file_names) > 0, 'Specified image_file does not point to valid image files'
-    assert os.path.exists(image_file_names[0]), 'The first image to be scored does not exist at {}'.format(image_file_names[0])
+    if isinstance(image_file_names, list):
+        assert len(image_file_names) > 0, 'Specified image_file does not point to valid image files'
+        assert os.path.exists(image_file_names[0]), 'The first image to be scored does not exist at {}'.format(image_file_names[0])
 
     output_dir = os.path.dirname(args.output_file)
 
@@ -347,13 +1018,33 @@ def main():
 
     # Test that we can write to the output_file's dir if checkpointing requested
     if args.checkpoint_frequency != -1:
-        checkpoint_path = os.path.join(output_dir, 'checkpoint_{}.json'.format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
-        with open(checkpoint_path, 'w') as f:
-            json.dump({'images': []}, f)
+        if args.resume_from_checkpoint and args.resume_from_checkpoint.endswith('.jsonl'):
+            # Keep appending to the journal we resumed from
+            checkpoint_path = args.resume_from_checkpoint
+        else:
+            checkpoint_path = os.path.join(output_dir, 'checkpoint_{}.jsonl'.format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
+            # Results restored from a .json checkpoint go into the new journal as well
+            with open(checkpoint_path, 'w') as f:
+                append_to_checkpoint_journal(f, results, sync=True)
         print('The checkpoint file will be written to {}'.format(checkpoint_path))
     else:
         checkpoint_path = None
 
+    relative_path_base = None
+    if args.output_relative_filenames:
+        relative_path_base = args.image_file
+
+    result_cache = None
+    if args.result_cache:
+        result_cache = DetectionResultCache(args.result_cache, args.detector_file, args.threshold,
+                                            min_decode_size=args.min_decode_size,
+                                            max_size_bytes=humanfriendly.parse_size(
+                                                args.result_cache_max_size))
+
+    results_writer = None
+    if args.stream_output:
+        results_writer = ResultsFileWriter(args.output_file, relative_path_base=relative_path_base)
+
     start_time = time.time()
 
     results = load_and_run_detector_batch(model_file=args.detector_file,
@@ -362,15 +1053,25 @@ def main():
                                           confidence_threshold=args.threshold,
                                           checkpoint_frequency=args.checkpoint_frequency,
                                           results=results,
-                                          n_cores=args.ncores)
+                                          n_cores=args.ncores,
+                                          batch_size=args.batch_size,
+                                          n_loader_threads=args.loader_threads,
+                                          prefetch_size=args.prefetch_size,
+                                          results_writer=results_writer,
+                                          min_decode_size=args.min_decode_size,
+                                          result_cache=result_cache)
 
     elapsed = time.time() - start_time
     print('Finished inference in {}'.format(humanfriendly.format_timespan(elapsed)))
 
-    relative_path_base = None
-    if args.output_relative_filenames:
-        relative_path_base = args.image_file
-    write_results_to_file(results, args.output_file, relative_path_base=relative_path_base)
+    if result_cache is not None:
+        result_cache.close()
+
+    if results_writer is not None:
+        results_writer.close()
+        print('Output file saved at {}'.format(args.output_file))
+    else:
+        write_results_to_file(results, args.output_file, relative_path_base=relative_path_base)
 
     if checkpoint_path:
         os.remove(checkpoint_path)
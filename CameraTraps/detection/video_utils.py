@@ -10,7 +10,6 @@
 
 import os
 import cv2
-import glob
 import json
 
 from collections import defaultdict
@@ -21,6 +20,7 @@ from typing import Container,Iterable,List
 # from ai4eutils
 import path_utils
     
+from ct_utils import iter_files
 from visualization import visualization_utils as vis_utils
 
 
@@ -50,14 +50,10 @@ def find_video_strings(strings: Iterable[str]) -> List[str]:
 
 def find_videos(dirname: str, recursive: bool = False) -> List[str]:
     """
-    Finds all files in a directory that look like video file names. Returns
-    absolute paths.
+    Finds all files in a directory that look like video file names, listing
+    subdirectories in parallel (see ct_utils.iter_files). Returns sorted paths.
     """
-    if recursive:
-        strings = glob.glob(os.path.join(dirname, '**', '*.*'), recursive=True)
-    else:
-        strings = glob.glob(os.path.join(dirname, '*.*'))
-    return find_video_strings(strings)
+    return sorted(iter_files(dirname, recursive=recursive, file_filter=is_video_file))
 
 
 #%% Function for rendering frames to video and vice-versa
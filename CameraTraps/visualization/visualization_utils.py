@@ -7,7 +7,7 @@ Core rendering functions shared across visualization scripts
 #%% Constants and imports
 
 from io import BytesIO
-from typing import Union
+from typing import Optional, Union
 import time
 
 import matplotlib.pyplot as plt
@@ -40,7 +40,28 @@ error_names_for_retry = ['ConnectionError']
 
 #%% Functions
 
-def open_image(input_file: Union[str, BytesIO]) -> Image:
+# JPEG images can be decoded directly at these fractions of their full size
+JPEG_DRAFT_SCALES = [8, 4, 2]
+
+
+def set_jpeg_draft_size(image: Image, min_decode_size: int) -> None:
+    """Configures a JPEG image that has not been loaded yet to be decoded at a
+    reduced size (1/2, 1/4 or 1/8 of each dimension, using PIL's draft mode), the
+    smallest one at which the shorter side is at least min_decode_size pixels.
+    Does nothing for other formats, or if no reduction is possible.
+    """
+    if image.format != 'JPEG':
+        return
+    short_side = min(image.size)
+    for scale in JPEG_DRAFT_SCALES:
+        if short_side // scale >= min_decode_size:
+            w, h = image.size
+            image.draft(image.mode, (w // scale, h // scale))
+            return
+
+
+def open_image(input_file: Union[str, BytesIO],
+               min_decode_size: Optional[int] = None) -> Image:
     """Opens an image in binary format using PIL.Image and converts to RGB mode.
 
     This operation is lazy; image will not be actually loaded until the first
@@ -50,6 +71,9 @@ def open_image(input_file: Union[str, BytesIO]) -> Image:
     Args:
         input_file: str or BytesIO, either a path to an image file (anything
             that PIL can open), or an image as a stream of bytes
+        min_decode_size: optional int, if given, JPEG images are decoded at
+            1/2, 1/4 or 1/8 scale as long as the shorter side stays at least
+            this many pixels; see set_jpeg_draft_size()
 
     Returns:
         an PIL image object in RGB mode
@@ -82,6 +106,8 @@ def open_image(input_file: Union[str, BytesIO]) -> Image:
 
     else:
         image = Image.open(input_file)
+    if min_decode_size is not None:
+        set_jpeg_draft_size(image, min_decode_size)
     if image.mode not in ('RGBA', 'RGB', 'L', 'I;16'):
         raise AttributeError(
             f'Image {input_file} uses unsupported mode {image.mode}')
@@ -103,7 +129,8 @@ def open_image(input_file: Union[str, BytesIO]) -> Image:
     return image
 
 
-def load_image(input_file: Union[str, BytesIO]) -> Image:
+def load_image(input_file: Union[str, BytesIO],
+               min_decode_size: Optional[int] = None) -> Image:
     """Loads the image at input_file as a PIL Image into memory.
 
     Image.open() used in open_image() is lazy and errors will occur downstream
@@ -112,10 +139,12 @@ def load_image(input_file: Union[str, BytesIO]) -> Image:
     Args:
         input_file: str or BytesIO, either a path to an image file (anything
             that PIL can open), or an image as a stream of bytes
+        min_decode_size: optional int, decode JPEG images at reduced size, see
+            open_image()
 
     Returns: PIL.Image.Image, in RGB mode
     """
-    image = open_image(input_file)
+    image = open_image(input_file, min_decode_size=min_decode_size)
     image.load()
     return image
 
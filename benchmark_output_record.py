@@ -0,0 +1,106 @@
+"""
+Times writing the people spreadsheet of output_record.py with each output format in
+output_record.ROW_WRITERS, on synthetic rows, so no images or detector output are needed.
+Optionally also times DataFrame.to_excel, which output_record.py used before.
+
+Each format is written twice: from a DataFrame as main() does (write_table), and row by
+row as the --stream mode does.
+
+Run from the repository root:
+
+python benchmark_output_record.py --n_rows 1000000 --to_excel
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import output_record
+
+
+def make_rows(n_rows, seed=0):
+    """Returns a DataFrame of n_rows synthetic rows with output_record.HUMAN_COLUMNS."""
+    rng = np.random.RandomState(seed)
+    cameras = np.array(sorted(output_record.CAMERA_NAMES))
+    camera = cameras[rng.randint(0, len(cameras), size=n_rows)]
+    timestamp = pd.Timestamp('2020-06-01') + pd.to_timedelta(
+        np.sort(rng.randint(0, 365 * 24 * 3600, size=n_rows)), unit='s')
+    timestamp = pd.Series(timestamp)
+    df = pd.DataFrame({
+        'Filename': [c + ' ' + t for c, t in zip(camera, timestamp.dt.strftime('%Y%m%d %H%M%S') + '.JPG')],
+        'Timestamp': timestamp,
+        'Date': timestamp.dt.strftime('%Y-%m-%d'),
+        'Time': timestamp.dt.strftime('%H:%M:%S'),
+        'Camera': [output_record.CAMERA_NAMES[c] for c in camera],
+        'Number': rng.randint(1, 5, size=n_rows),
+        'Dogs': rng.randint(0, 2, size=n_rows),
+    })
+    return df[output_record.HUMAN_COLUMNS]
+
+
+def time_write(fn):
+    start_time = time.time()
+    fn()
+    return time.time() - start_time
+
+
+def write_rows(df, path, output_format):
+    row_writer = output_record.ROW_WRITERS[output_format]
+    writer = row_writer(path, list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        writer.write_row(row)
+    writer.close()
+
+
+def run_benchmark(n_rows, output_formats, to_excel=False):
+    df = make_rows(n_rows)
+    output_folder = tempfile.mkdtemp()
+    output_record.OUTPUT_FOLDER = os.path.join(output_folder, '')
+    print('Writing {} rows to {}'.format(n_rows, output_folder))
+
+    try:
+        if to_excel:
+            # DataFrame.to_excel cannot write more rows than fit on one sheet
+            n = min(n_rows, output_record.XlsxRowWriter.MAX_ROWS - 1)
+            elapsed = time_write(lambda: df[:n].to_excel(
+                os.path.join(output_folder, 'to_excel.xlsx'), sheet_name='sheet1', index=False))
+            print('{:<8} to_excel:     {:7.2f} s ({:.1f} us/row)'.format(
+                'xlsx', elapsed, 1e6 * elapsed / n))
+
+        for output_format in output_formats:
+            extension = output_record.ROW_WRITERS[output_format].extension
+            elapsed = time_write(lambda: output_record.write_table(df, 'table', output_format))
+            size = os.path.getsize(os.path.join(output_folder, 'table' + extension))
+            print('{:<8} write_table:  {:7.2f} s ({:.1f} us/row), {:.1f} MB'.format(
+                output_format, elapsed, 1e6 * elapsed / n_rows, size / 1e6))
+
+            path = os.path.join(output_folder, 'rows' + extension)
+            elapsed = time_write(lambda: write_rows(df, path, output_format))
+            print('{:<8} row by row:   {:7.2f} s ({:.1f} us/row)'.format(
+                output_format, elapsed, 1e6 * elapsed / n_rows))
+    finally:
+        shutil.rmtree(output_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the spreadsheet output formats of output_record.py')
+    parser.add_argument('--n_rows', type=int, default=1000000,
+                        help='Number of synthetic rows to write; default is 1000000')
+    parser.add_argument('--output_formats', nargs='+', choices=sorted(output_record.ROW_WRITERS),
+                        default=sorted(output_record.ROW_WRITERS),
+                        help='Output formats to time; default is all of them')
+    parser.add_argument('--to_excel', action='store_true',
+                        help='Also time DataFrame.to_excel (slow for many rows)')
+    args = parser.parse_args()
+
+    run_benchmark(args.n_rows, args.output_formats, to_excel=args.to_excel)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Runs MegaDetector on the image folder and sorts each image into the output folders as
+soon as its result is known, in one pass, instead of run.cmd's two steps (writing
+output/output.json, then output_record.py reading it back and copying every image).
+
+Results go to output_record.StreamingSorter as they come out of the detector, while the
+next images are loaded and run, so the spreadsheets and folders are done shortly after
+the last image is run. By default images are hard linked into the output folders rather
+than copied (falling back to copying if the output folder is on another drive).
+output/output.json is still written as the detector's output, but nothing depends on it.
+
+Run from the repository root, with PYTHONPATH set as in run.cmd:
+
+python detect_and_sort.py ./md_v4.1.0.pb
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import humanfriendly
+
+from detection.run_tf_detector import ImagePathUtils, TFDetector
+from detection.run_tf_detector_batch import load_and_run_detector_batch, ResultsFileWriter
+
+import output_record
+
+
+class _ResultsTee:
+    """Passes each result on to several results writers."""
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, result):
+        for writer in self.writers:
+            writer.write(result)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def detect_and_sort(detector_file, image_folder, output_file=None,
+                    confidence_threshold=TFDetector.DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+                    mode='hardlink', n_threads=None, output_format=None,
+                    n_loader_threads=4, batch_size=1, min_decode_size=None):
+    """
+    Runs the detector on the images in image_folder and sorts them into
+    output_record.OUTPUT_FOLDER as the results come in.
+
+    Args
+    - detector_file: str, path to .pb detector model file
+    - image_folder: str, folder with the images (not searched recursively, like
+        output_record.py)
+    - output_file: str, path to write the detector output JSON to, or None to not write it
+    - confidence_threshold: float, only detections above this threshold are kept
+    - mode: str, how images are put in the output folders, see output_record.SORT_MODES
+    - n_threads: int, # of threads putting images in the output folders
+    - output_format: str, spreadsheet format, see output_record.ROW_WRITERS
+    - n_loader_threads: int, # of threads loading images while the detector runs
+    - batch_size: int, # of images of the same size run through the model in one call
+    - min_decode_size: int, if given, decode JPEG images at reduced size, keeping the
+        shorter side at least this many pixels
+    """
+    # output_record.py works on its global folder names
+    output_record.IMG_FOLDER = os.path.join(image_folder, '')
+
+    # Sorted, so each camera's images come in time order for the dog reassignment
+    image_file_names = ImagePathUtils.find_images(image_folder)
+    print('{} images found in {}'.format(len(image_file_names), image_folder))
+
+    sorter = output_record.StreamingSorter(mode=mode, n_threads=n_threads,
+                                           output_format=output_format)
+    writers = [sorter]
+    results_file_writer = None
+    if output_file is not None:
+        results_file_writer = ResultsFileWriter(output_file)
+        writers.append(results_file_writer)
+    results_writer = _ResultsTee(writers)
+
+    tf_detector = TFDetector(detector_file)
+
+    start_time = time.time()
+    try:
+        load_and_run_detector_batch(tf_detector, image_file_names,
+                                    confidence_threshold=confidence_threshold,
+                                    batch_size=batch_size,
+                                    n_loader_threads=n_loader_threads,
+                                    results_writer=results_writer,
+                                    min_decode_size=min_decode_size)
+    except BaseException:
+        # Aborted (including Ctrl+C): don't close the sorter, which would sort the images
+        # not run yet into Empty and finish the spreadsheets as if the run were complete
+        print('Detection stopped, images not run yet were not sorted')
+        try:
+            if results_file_writer is not None:
+                results_file_writer.close()
+        finally:
+            sorter.abort()
+        raise
+
+    results_writer.close()
+
+    elapsed = time.time() - start_time
+    print('Detected and sorted {} images in {}'.format(
+        len(image_file_names), humanfriendly.format_timespan(elapsed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run MegaDetector and sort the images into output folders in one pass')
+    parser.add_argument('detector_file', help='Path to .pb TensorFlow detector model file')
+    parser.add_argument('--image_folder', default=output_record.IMG_FOLDER,
+                        help='Folder with the images; default is ' + output_record.IMG_FOLDER)
+    parser.add_argument('--output_file', default=output_record.MD_OUTPUT,
+                        help='Where to write the MegaDetector output JSON; default is ' + output_record.MD_OUTPUT)
+    parser.add_argument('--no_output_file', action='store_true',
+                        help='Do not write the MegaDetector output JSON')
+    parser.add_argument('--threshold', type=float, default=TFDetector.DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+                        help="Don't include boxes below this confidence in the output file; default is 0.1")
+    parser.add_argument('--mode', choices=output_record.SORT_MODES, default='hardlink',
+                        help='How images are put in the output folders; default is hardlink')
+    parser.add_argument('--threads', type=int, default=output_record.N_FILE_THREADS,
+                        help='Number of threads doing file operations; default is {}'.format(
+                            output_record.N_FILE_THREADS))
+    parser.add_argument('--output_format', choices=sorted(output_record.ROW_WRITERS),
+                        default=output_record.OUTPUT_FORMAT,
+                        help='Spreadsheet format; default is ' + output_record.OUTPUT_FORMAT)
+    parser.add_argument('--loader_threads', type=int, default=4,
+                        help='Number of threads loading images while the detector runs; default is 4')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Number of images of the same size run through the model at once; default is 1')
+    parser.add_argument('--min_decode_size', type=int, default=None,
+                        help='Decode JPEG images at reduced size, as long as the shorter side stays at '
+                             'least this many pixels; by default images are decoded at full size')
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    assert os.path.exists(args.detector_file), 'Specified detector_file does not exist'
+    assert os.path.isdir(args.image_folder), 'Specified image_folder does not exist'
+    assert 0.0 < args.threshold <= 1.0, 'Confidence threshold needs to be between 0 and 1'
+    assert args.loader_threads > 0, 'loader_threads needs to be > 0'
+    assert args.batch_size > 0, 'batch_size needs to be > 0'
+
+    output_file = None if args.no_output_file else args.output_file
+    if output_file is not None:
+        output_dir = os.path.dirname(output_file)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    detect_and_sort(args.detector_file, args.image_folder, output_file=output_file,
+                    confidence_threshold=args.threshold, mode=args.mode,
+                    n_threads=args.threads, output_format=args.output_format,
+                    n_loader_threads=args.loader_threads, batch_size=args.batch_size,
+                    min_decode_size=args.min_decode_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
 import os
 import sys
+import csv
 import json
+import bisect
 import shutil
+import argparse
+import functools
+import numpy as np
 import pandas as pd
 
+from datetime import datetime
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
 from pandas import DataFrame
+from PIL import Image
 
 #### GLOBAL CONSTANTS, CHANGE IF YOU CHANGE FOLDER NAMES #####
 IMG_FOLDER = "images/"
@@ -13,32 +24,567 @@ OUTPUT_FOLDER = "output/"
 TH = 0.8
 ##############################################################
 
+# An animal detected less than DOG_TIME_WINDOW seconds from a human is counted as a dog.
+# Humans only count on the same value of the DOG_GROUP_BY column ('Camera'), or on any
+# camera if DOG_GROUP_BY is None.
+DOG_TIME_WINDOW = 300
+DOG_GROUP_BY = 'Camera'
+
+ANIMAL_COLUMNS = ['Filename', 'Timestamp', 'Date', 'Time', 'Camera', 'Number']
+HUMAN_COLUMNS = ANIMAL_COLUMNS + ['Dogs']
+
+# Images with animals or humans on the same camera less than EVENT_GAP seconds apart
+# belong to the same event (one trigger of the camera, or one animal passing by)
+EVENT_GAP = 60
+
+# Animals and Humans are the largest counts in one image of the event; the animals in
+# events with humans are probably dogs
+EVENT_COLUMNS = ['Event', 'Camera', 'Start', 'End', 'Images', 'Animals', 'Humans',
+                 'Human present', 'Max confidence', 'First image', 'Last image']
+
+TIMESTAMP_COLUMNS = ['Timestamp', 'Start', 'End']
+
+# Each image ends up in exactly one of these; images can also be copied to 'Maybe'
+SORT_FOLDERS = ['Animal', 'Human', 'Empty']
+
+# How images are put in the output folders:
+# 'copy'     - copy the file (the default, and the original behavior)
+# 'move'     - move the file out of IMG_FOLDER (Maybe images are copied first); only for
+#              one-off runs, since reruns and watch_folder.py need the images in IMG_FOLDER
+# 'hardlink' - hard link to the file; instant and takes no space, but IMG_FOLDER and
+#              OUTPUT_FOLDER must be on the same drive
+# 'link'     - symbolic link to the file (needs admin rights or developer mode on Windows)
+# 'reflink'  - copy-on-write clone of the file, on file systems that support it (Btrfs, XFS)
+# hardlink and reflink fall back to copying when the file system does not support them.
+SORT_MODES = ['copy', 'move', 'hardlink', 'link', 'reflink']
+SORT_MODE = 'copy'
+
+# Number of threads doing file operations; more than a few mostly helps on network drives
+N_FILE_THREADS = 8
+
+# Linux ioctl for cloning a file (FICLONE)
+_FICLONE = 0x40049409
+
+# Camera names for the camera codes the file names start with
+CAMERA_NAMES = {
+    'BR': 'Bridge',
+    'PA': 'Path',
+    'TL': 'Treeline',
+    'TR': 'Track',
+    'TS': 'TSS',
+    'ZZ': 'Zigzag',
+    'CP': 'carpark',
+    'ST': 'stream',
+    'SN': 'SNH',
+}
+
+# Number of threads reading EXIF timestamps of images not named by the convention
+N_EXIF_THREADS = 8
+
+# At most this many file names without a timestamp are printed
+MAX_REPORTED_FILENAMES = 20
+
+# EXIF tags DateTimeOriginal and DateTime
+_EXIF_DATETIME_TAGS = [36867, 306]
+
 def camera_name(cam):
-    if cam == 'BR':
-        return 'Bridge'
-    elif cam == 'PA':
-        return 'Path'
-    elif cam == 'TL':
-        return 'Treeline'
-    elif cam == 'TR':
-        return 'Track'
-    elif cam == 'TS':
-        return 'TSS'
-    elif cam == 'ZZ':
-        return 'Zigzag'
-    elif cam == 'CP':
-        return 'carpark'
-    elif cam == 'ST':
-        return 'stream'
-    elif cam == 'SN':
-        return 'SNH'
-    else:
+    name = CAMERA_NAMES.get(cam)
+    if name is None:
         print('Unknown camera: '+ cam )
         return cam
+    return name
 
 
-def main():
-    #region
+def parse_filename(filename):
+    """
+    Returns the timestamp of a file name following ECN's naming convention,
+    "XX YYYYMMDD hhmmss.*", or NaT if it doesn't.
+    """
+    try:
+        return pd.Timestamp(datetime.strptime(filename[-19:-11] + filename[-10:-4], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return pd.NaT
+
+
+@functools.lru_cache(maxsize=None)
+def _read_exif_timestamp(path, mtime):
+    try:
+        with Image.open(path) as image:
+            exif = image._getexif() or {}
+    except Exception:
+        return pd.NaT
+    for tag in _EXIF_DATETIME_TAGS:
+        try:
+            return pd.Timestamp(datetime.strptime(exif[tag].strip('\x00 '), '%Y:%m:%d %H:%M:%S'))
+        except (KeyError, AttributeError, ValueError):
+            pass
+    return pd.NaT
+
+
+def read_exif_timestamp(path):
+    """
+    Returns the EXIF DateTimeOriginal (or else DateTime) of an image as a timestamp, or
+    NaT if it has neither. Results are cached as long as the file is not modified.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return pd.NaT
+    return _read_exif_timestamp(path, mtime)
+
+
+def report_missing_timestamps(filenames):
+    print('Could not get a timestamp for {} images (not named "XX YYYYMMDD hhmmss.*" and no EXIF date):'.format(
+        len(filenames)))
+    for filename in filenames[:MAX_REPORTED_FILENAMES]:
+        print('  ' + filename)
+    if len(filenames) > MAX_REPORTED_FILENAMES:
+        print('  ...')
+
+
+def _char_matrix(strings, width):
+    """Returns strings (of at most width characters) as an n x width array of characters."""
+    return np.asarray(strings, dtype='U{}'.format(width)).view('U1').reshape(len(strings), width)
+
+
+def parse_filenames(filenames, n_threads=None):
+    """
+    Returns a DataFrame with the Timestamp, Date, Time and Camera of each of the file
+    names in IMG_FOLDER, in the same order.
+
+    Timestamps are parsed from ECN's naming convention, "XX YYYYMMDD hhmmss.*", for all
+    names at once. For names that don't follow it, the timestamp is read from the image's
+    EXIF data instead, on n_threads threads (default N_EXIF_THREADS). Names without either
+    are reported and get no timestamp (NaT, and empty Date and Time).
+    """
+    if n_threads is None:
+        n_threads = N_EXIF_THREADS
+    names = pd.Series(filenames, dtype=object)
+
+    # "YYYYMMDDhhmmss" from each name, reformatted as "YYYY-MM-DD hh:mm:ss", which
+    # to_datetime parses much faster than other formats
+    digits = _char_matrix(names.str[-19:-11] + names.str[-10:-4], 14)
+    all_digits = ((digits >= '0') & (digits <= '9')).all(axis=1)
+    iso = np.empty((len(names), 19), dtype='U1')
+    iso[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] = digits
+    iso[:, [4, 7]] = '-'
+    iso[:, 10] = ' '
+    iso[:, [13, 16]] = ':'
+    iso = pd.Series(iso.view('U19').ravel(), dtype=object).where(all_digits)
+    timestamps = pd.to_datetime(iso, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+
+    missing = np.flatnonzero(timestamps.isna().values)
+    if len(missing) > 0:
+        paths = [IMG_FOLDER + filenames[i] for i in missing]
+        pool = ThreadPool(n_threads)
+        try:
+            exif_timestamps = pool.map(read_exif_timestamp, paths)
+        finally:
+            pool.close()
+            pool.join()
+        timestamps.iloc[missing] = pd.to_datetime(pd.Series(exif_timestamps, dtype=object)).values
+        still_missing = [filenames[i] for i in missing if pd.isnull(timestamps.iloc[i])]
+        if len(still_missing) > 0:
+            report_missing_timestamps(still_missing)
+
+    codes = names.str[0:2]
+    cameras = codes.map(CAMERA_NAMES)
+    unknown = cameras.isna()
+    if unknown.any():
+        for code, count in codes[unknown].value_counts().items():
+            print('Unknown camera: {} ({} images)'.format(code, count))
+        cameras[unknown] = codes[unknown]
+
+    # "YYYY-MM-DDThh:mm:ss" split into date and time
+    iso = _char_matrix(timestamps.values.astype('datetime64[s]').astype('U19'), 19)
+    dates = iso[:, :10].copy().view('U10').ravel()
+    times = iso[:, 11:].copy().view('U8').ravel()
+    no_timestamp = timestamps.isna().values
+    dates[no_timestamp] = ''
+    times[no_timestamp] = ''
+
+    return DataFrame({'Timestamp': timestamps, 'Date': dates, 'Time': times, 'Camera': cameras})
+
+
+def count_detections(detections):
+    """
+    Returns (animals, humans, maybe) for the detections of one image: the number of
+    animals and humans with confidence >= TH, and whether the image should also go to
+    Maybe. Counting stops at the first possible animal (confidence >= 0.5) found before
+    any animal above TH.
+    """
+    animals = 0
+    humans = 0
+    max_conf = 0
+
+    for det in detections:
+        if det["category"] == '1':
+            if det["conf"] >= TH:
+                max_conf = max(max_conf, det["conf"])
+                animals +=1
+            elif det["conf"] >= 0.5 and max_conf == 0:
+                return animals, humans, True
+
+        elif det["category"] == '2' and det["conf"] >= TH:
+            humans +=1
+
+    return animals, humans, False
+
+
+def max_confidence(detections):
+    """Returns the highest confidence of the animal and human detections >= TH, or 0."""
+    return max([det["conf"] for det in detections if det["category"] in ('1', '2') and det["conf"] >= TH],
+               default=0)
+
+
+def group_events(frames, gap=EVENT_GAP):
+    """
+    Groups images into events: runs of images on the same camera with less than gap
+    seconds between one image and the next.
+
+    frames is a DataFrame with the Filename, Timestamp, Camera, Animals, Humans and
+    Confidence of each image (in the order the images were run); images without a
+    timestamp are left out. Returns a DataFrame with a row per event, with the
+    EVENT_COLUMNS, numbered in the order of their first images in frames.
+    """
+    frames = frames.assign(order=np.arange(len(frames)))
+    frames = frames[frames['Timestamp'].notna()]
+    frames = frames.sort_values(['Camera', 'Timestamp'], kind='mergesort')
+
+    times = frames['Timestamp'].values.astype('datetime64[ns]')
+    cameras = frames['Camera'].values
+    new_event = np.ones(len(frames), dtype=bool)
+    new_event[1:] = (cameras[1:] != cameras[:-1]) | (times[1:] - times[:-1] >= np.timedelta64(gap, 's'))
+    event_ids = np.cumsum(new_event)
+
+    grouped = frames.groupby(event_ids, sort=True)
+    events = DataFrame({
+        'Camera': grouped['Camera'].first(),
+        'Start': grouped['Timestamp'].first(),
+        'End': grouped['Timestamp'].last(),
+        'Images': grouped.size(),
+        'Animals': grouped['Animals'].max(),
+        'Humans': grouped['Humans'].max(),
+        'Max confidence': grouped['Confidence'].max(),
+        'First image': grouped['Filename'].first(),
+        'Last image': grouped['Filename'].last(),
+        'order': grouped['order'].first()})
+    events['Human present'] = events['Humans'] > 0
+
+    events = events.sort_values('order').reset_index(drop=True)
+    events['Event'] = np.arange(1, len(events) + 1)
+    return events[EVENT_COLUMNS]
+
+
+def _reflink(src, dest):
+    import fcntl
+    with open(src, 'rb') as f_src, open(dest, 'wb') as f_dest:
+        fcntl.ioctl(f_dest.fileno(), _FICLONE, f_src.fileno())
+
+
+def _place_file(src, dest, mode):
+    if mode == 'copy':
+        shutil.copy(src, dest)
+        return
+    if mode == 'move':
+        shutil.move(src, dest)
+        return
+
+    # Links cannot overwrite an existing file
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if mode == 'link':
+        os.symlink(os.path.abspath(src), dest)
+        return
+    try:
+        if mode == 'hardlink':
+            os.link(src, dest)
+        else:
+            _reflink(src, dest)
+    except (OSError, ImportError):
+        # Different drives, or no support in the file system
+        if os.path.lexists(dest):
+            os.remove(dest)
+        shutil.copy(src, dest)
+
+
+def copy_image(filename, folder, changed_filenames=None, mode=None):
+    """
+    Copies (or moves or links, see SORT_MODES; mode defaults to SORT_MODE) filename from
+    IMG_FOLDER to the output folder 'folder'.
+    If changed_filenames is given (incremental sorting), images already in the folder are
+    skipped unless they are in changed_filenames, and copies left in the other SORT_FOLDERS
+    by an earlier run are removed.
+    """
+    if mode is None:
+        mode = SORT_MODE
+    dest = OUTPUT_FOLDER + folder + '/' + filename
+    if changed_filenames is not None and filename not in changed_filenames and os.path.lexists(dest):
+        return
+    try:
+        _place_file(IMG_FOLDER+filename, dest, mode)
+    except:
+        print("Could not move " + filename +", is it in the image folder?")
+        return
+    if changed_filenames is not None and folder in SORT_FOLDERS:
+        for other_folder in SORT_FOLDERS:
+            if other_folder != folder and os.path.lexists(OUTPUT_FOLDER + other_folder + '/' + filename):
+                os.remove(OUTPUT_FOLDER + other_folder + '/' + filename)
+
+
+def copy_images(folder_by_filename, changed_filenames=None, mode=None, n_threads=None):
+    """
+    Calls copy_image for each (filename, folder) in folder_by_filename (a dict), on
+    n_threads threads (default N_FILE_THREADS).
+    """
+    if n_threads is None:
+        n_threads = N_FILE_THREADS
+    if len(folder_by_filename) == 0:
+        return
+    pool = ThreadPool(n_threads)
+    try:
+        pool.starmap(copy_image, [(filename, folder, changed_filenames, mode)
+                                  for filename, folder in folder_by_filename.items()],
+                     chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _timestamps_ns(df):
+    return df['Timestamp'].values.astype('datetime64[ns]').view(np.int64)
+
+
+def reassign_dogs(animal_df, human_df, time_window=DOG_TIME_WINDOW, group_by=DOG_GROUP_BY):
+    """
+    Changes animal detections to dogs if a human was detected less than time_window
+    seconds before or after, in the same group_by group (e.g. on the same camera).
+
+    Animals are checked in order, and an animal changed to a dog counts as a human for the
+    animals after it, like in the original pairwise loop, so the result is the same. Each
+    check is a binary search in the sorted times of the humans in the group.
+
+    Returns the new (animal_df, human_df): the dogs are removed from animal_df and appended
+    to human_df with Number 0 and their animal count in Dogs. Rows without a timestamp
+    stay where they are; they are only skipped in the check, so an animal without one is
+    never a dog and a human without one makes no animal a dog.
+    """
+    window = pd.Timedelta(seconds=time_window).value
+    animal_times = _timestamps_ns(animal_df)
+    animal_has_time = animal_df['Timestamp'].notna().values
+    human_has_time = human_df['Timestamp'].notna().values
+
+    if group_by is None:
+        animal_groups = [None] * len(animal_df)
+        human_groups = [None] * len(human_df)
+    else:
+        animal_groups = animal_df[group_by].tolist()
+        human_groups = human_df[group_by].tolist()
+
+    # Sorted human times per group
+    times_by_group = {}
+    for group, t, has_time in zip(human_groups, _timestamps_ns(human_df).tolist(), human_has_time):
+        if has_time:
+            times_by_group.setdefault(group, []).append(t)
+    for times in times_by_group.values():
+        times.sort()
+
+    is_dog = np.zeros(len(animal_df), dtype=bool)
+    for i, (group, t) in enumerate(zip(animal_groups, animal_times.tolist())):
+        times = times_by_group.get(group)
+        if times is None or not animal_has_time[i]:
+            continue
+        # First human time > t - window; a dog if it is also < t + window
+        j = bisect.bisect_right(times, t - window)
+        if j < len(times) and times[j] < t + window:
+            is_dog[i] = True
+            bisect.insort(times, t)
+
+    if not is_dog.any():
+        return animal_df, human_df
+
+    dogs = animal_df[is_dog]
+    dog_df = dogs.assign(Number=0, Dogs=dogs['Number'])[HUMAN_COLUMNS]
+    human_df = pd.concat([human_df, dog_df], ignore_index=True)
+    animal_df = animal_df[~is_dog].reset_index(drop=True)
+    return animal_df, human_df
+
+
+#region
+#### Output formats
+
+class RowWriter:
+    """
+    Base class of the spreadsheet writers in ROW_WRITERS. A writer is created with the
+    path and column names, gets rows (tuples in the order of the columns) from
+    write_row() or whole DataFrames from write_dataframe(), and finishes the file on
+    close(). Rows are written as they come, so memory use does not depend on the number
+    of rows.
+    """
+
+    extension = None
+
+    def write_row(self, row):
+        raise NotImplementedError
+
+    def write_dataframe(self, df):
+        for row in df.itertuples(index=False, name=None):
+            self.write_row(row)
+
+    def close(self):
+        raise NotImplementedError
+
+
+class CsvRowWriter(RowWriter):
+    """Writes rows to a CSV file, CHUNK_SIZE rows at a time."""
+
+    extension = '.csv'
+    CHUNK_SIZE = 10000
+
+    def __init__(self, path, columns):
+        self.f = open(path, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(columns)
+        self.rows = []
+
+    def write_row(self, row):
+        self.rows.append(['' if value is pd.NaT else value for value in row])
+        if len(self.rows) >= CsvRowWriter.CHUNK_SIZE:
+            self._write_rows()
+
+    def _write_rows(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+
+    def write_dataframe(self, df):
+        # Formatting timestamps a column at a time is much faster than letting the csv
+        # module format them a value at a time; NaT becomes ''
+        for column in TIMESTAMP_COLUMNS:
+            if column in df.columns:
+                df = df.assign(**{column: df[column].dt.strftime('%Y-%m-%d %H:%M:%S')})
+        self._write_rows()
+        self.writer.writerows(df.astype(object).where(df.notna(), '').values.tolist())
+
+    def close(self):
+        self._write_rows()
+        self.f.close()
+
+
+class XlsxRowWriter(RowWriter):
+    """
+    Writes rows to an .xlsx file with openpyxl's write-only mode, which streams rows to
+    disk instead of keeping the sheet in memory like DataFrame.to_excel. Rows beyond
+    Excel's limit of MAX_ROWS rows per sheet go on to a new sheet (sheet2, ...).
+    """
+
+    extension = '.xlsx'
+    MAX_ROWS = 1048576
+
+    def __init__(self, path, columns):
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        self._cell_class = WriteOnlyCell
+        self.path = path
+        self.columns = columns
+        self.workbook = Workbook(write_only=True)
+        self.n_sheets = 0
+        self._new_sheet()
+
+    def _new_sheet(self):
+        self.n_sheets += 1
+        self.sheet = self.workbook.create_sheet('sheet{}'.format(self.n_sheets))
+        self.sheet.append(self.columns)
+        self.n_rows = 1
+
+    def _cell(self, value):
+        if value is pd.NaT:
+            return None
+        if isinstance(value, pd.Timestamp):
+            cell = self._cell_class(self.sheet, value.to_pydatetime())
+            cell.number_format = 'YYYY-MM-DD HH:MM:SS'
+            return cell
+        return value
+
+    def write_row(self, row):
+        if self.n_rows == XlsxRowWriter.MAX_ROWS:
+            self._new_sheet()
+        self.sheet.append([self._cell(value) for value in row])
+        self.n_rows += 1
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+class ParquetRowWriter(RowWriter):
+    """
+    Writes rows to a Parquet file, a compressed columnar format for analysis (e.g.
+    pd.read_parquet), with one row group per CHUNK_SIZE rows. Needs pyarrow.
+    """
+
+    extension = '.parquet'
+    CHUNK_SIZE = 100000
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('The parquet output format needs pyarrow (pip install pyarrow)')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self.columns = columns
+        self.rows = []
+        self.writer = None
+
+    def write_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= ParquetRowWriter.CHUNK_SIZE:
+            self._write_rows()
+
+    def _write_rows(self):
+        if len(self.rows) > 0:
+            df = DataFrame.from_records(self.rows, columns=self.columns)
+            self.rows = []
+            self.write_dataframe(df)
+
+    def write_dataframe(self, df):
+        # Keep the column types the same in every row group, even if a chunk has no
+        # timestamps
+        for column in TIMESTAMP_COLUMNS:
+            if column in df.columns:
+                df = df.assign(**{column: pd.to_datetime(df[column])})
+        if self.writer is None:
+            table = self._pa.Table.from_pandas(df, preserve_index=False)
+            self.writer = self._pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = self._pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self):
+        self._write_rows()
+        if self.writer is None:
+            self.write_dataframe(DataFrame(columns=self.columns))
+        self.writer.close()
+
+
+ROW_WRITERS = {'xlsx': XlsxRowWriter, 'csv': CsvRowWriter, 'parquet': ParquetRowWriter}
+OUTPUT_FORMAT = 'xlsx'
+
+
+def write_table(df, name, output_format=None):
+    """Writes a DataFrame to OUTPUT_FOLDER + name, in output_format (default OUTPUT_FORMAT)."""
+    if output_format is None:
+        output_format = OUTPUT_FORMAT
+    row_writer = ROW_WRITERS[output_format]
+    writer = row_writer(OUTPUT_FOLDER + name + row_writer.extension, list(df.columns))
+    writer.write_dataframe(df)
+    writer.close()
+
+#endregion
+
+
+def make_output_folders():
     ##### Output-folders
     if not os.path.exists(OUTPUT_FOLDER):
         os.makedirs(OUTPUT_FOLDER)
@@ -54,10 +600,39 @@ def main():
     
     if not os.path.exists(OUTPUT_FOLDER+'Maybe'):
         os.makedirs(OUTPUT_FOLDER+'Maybe')
-    #endregion
 
-    folder = IMG_FOLDER
-    pics = os.listdir(folder)
+
+def main(changed_filenames=None, mode=None, n_threads=None, output_format=None):
+    """
+    Sorts the images in IMG_FOLDER into the output folders and writes the spreadsheets,
+    based on the MegaDetector output in MD_OUTPUT.
+
+    Returns (True, '') on success, (False, error message) if MD_OUTPUT can't be read.
+
+    If changed_filenames (a set of file names) is given, only sorts incrementally: images
+    that are already in the right output folder are not copied again, unless they are in
+    changed_filenames. Spreadsheets are always rewritten in full.
+
+    mode is how images are put in the output folders (see SORT_MODES, default SORT_MODE),
+    n_threads the number of threads doing that (default N_FILE_THREADS). output_format
+    is the format of the spreadsheets (see ROW_WRITERS, default OUTPUT_FORMAT).
+    """
+    if mode is None:
+        mode = SORT_MODE
+    if output_format is None:
+        output_format = OUTPUT_FORMAT
+    assert mode in SORT_MODES, 'Unknown sort mode: ' + mode
+    assert output_format in ROW_WRITERS, 'Unknown output format: ' + output_format
+
+    make_output_folders()
+
+    if changed_filenames is not None:
+        # Changed images may be sorted differently now, so remove their old copies
+        for filename in changed_filenames:
+            for folder in SORT_FOLDERS + ['Maybe']:
+                if os.path.lexists(OUTPUT_FOLDER + folder + '/' + filename):
+                    os.remove(OUTPUT_FOLDER + folder + '/' + filename)
+
     try:
         json_data = json.load(open(MD_OUTPUT))
 
@@ -71,136 +646,555 @@ def main():
         print(msg)
         return False, msg
 
-    # Lists for metadata to be added to spreadsheet
-    human_cameras = list()
-    human_timestamps = list()
-    human_number = list()
-    dog_number = list()
-    human_filenames = list()
-    human_dates = list()
-    human_times = list()
-
-    animal_cameras = list()
-    animal_number = list()
-    animal_timestamps = list()
-    animal_filenames = list()
-    animal_dates = list()
-    animal_times = list()
-    
+    # Images with animals or humans, and their counts
+    filenames = list()
+    animal_counts = list()
+    human_counts = list()
+    confidences = list()
+    maybe_filenames = list()
+    n_failed = 0
+
     # ADD TQDM BAR? 
     # Reads all detections in lists that will be saved as an excel-file
     for img in json_data["images"]:
+        if 'failure' in img:
+            # Sorted into Empty with the other files without a result
+            n_failed += 1
+            continue
+
         filename = (img["file"].split("/")[-1]).split("\\")[-1]
-        cam = filename[0:2]
-        Y = filename[-19:-15]
-        M = filename[-15:-13]
-        D = filename[-13:-11]
-        h = filename[-10:-8]
-        m = filename[-8:-6]
-        s = filename[-6:-4]
 
+        animals, humans, maybe = count_detections(img["detections"])
+        if maybe:
+            maybe_filenames.append(filename)
+
+        if animals > 0 or humans > 0:
+            filenames.append(filename)
+            animal_counts.append(animals)
+            human_counts.append(humans)
+            confidences.append(max_confidence(img["detections"]))
+
+    if n_failed > 0:
+        print('{} images could not be run by the detector and were sorted into Empty'.format(n_failed))
+
+    images = parse_filenames(filenames)
+    images.insert(0, 'Filename', filenames)
+    animals = np.array(animal_counts, dtype=np.int64)
+    humans = np.array(human_counts, dtype=np.int64)
+
+    events = group_events(images.assign(Animals=animals, Humans=humans,
+                                        Confidence=np.array(confidences, dtype=np.float64)))
+
+    # Animals in the same image as humans are dogs
+    dogs = np.where(humans > 0, animals, 0)
+    animals = np.where(humans > 0, 0, animals)
+
+    animal_df = images[animals > 0].assign(Number=animals[animals > 0])[ANIMAL_COLUMNS]
+    human_df = images[humans > 0].assign(Number=humans[humans > 0], Dogs=dogs[humans > 0])[HUMAN_COLUMNS]
+    animal_df = animal_df.reset_index(drop=True)
+    human_df = human_df.reset_index(drop=True)
+
+    # Changes animal detections to dogs if there was a human detected on the same camera close in time
+    animal_df, human_df = reassign_dogs(animal_df, human_df)
+    
+    #region
+    #### Saving detections in excel-sheets
+    write_table(animal_df, 'wildlife', output_format)
+    write_table(human_df, 'people', output_format)
+    write_table(events, 'events', output_format)
+    #endregion
+
+    #region
+
+    # The output folder of every image, so finding the empty images is one lookup per file
+    folder_by_filename = dict.fromkeys(animal_df['Filename'], 'Animal')
+    folder_by_filename.update(dict.fromkeys(human_df['Filename'], 'Human'))
+    for filename in os.listdir(IMG_FOLDER):
+        if filename not in folder_by_filename:
+            folder_by_filename[filename] = 'Empty'
+
+    # Maybe images also go to one of the other folders, so they cannot be moved
+    copy_images(dict.fromkeys(maybe_filenames, 'Maybe'), changed_filenames,
+                mode='copy' if mode == 'move' else mode, n_threads=n_threads)
+    copy_images(folder_by_filename, changed_filenames, mode=mode, n_threads=n_threads)
+# Could add dog-folder
+
+    return True, ''
+
+    #endregion
+
+#region
+#### Streaming mode
+
+class _JsonReader:
+    """Reads JSON values one at a time from a file, keeping only a chunk of it in memory."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read_more(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read_more():
+                return ''
+
+    def next_char(self, expected):
+        c = self.peek()
+        if c not in expected:
+            raise ValueError('Expected one of {!r} in JSON, found {!r}'.format(expected, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value that ends at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._read_more()
+
+
+def iter_md_images(json_path, chunk_size=1024 * 1024):
+    """
+    Yields the entries of the 'images' list in a MegaDetector output file one at a time,
+    reading the file in chunks of chunk_size characters, so memory use does not depend
+    on the size of the file.
+    """
+    with open(json_path) as f:
+        reader = _JsonReader(f, chunk_size)
+        reader.next_char('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.next_char(':')
+            if key == 'images':
+                reader.next_char('[')
+                if reader.peek() == ']':
+                    reader.next_char(']')
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.next_char(',]') == ']':
+                            break
+            else:
+                reader.value()
+            if reader.next_char(',}') == '}':
+                return
+
+
+class StreamingDogReassigner:
+    """
+    Dog reassignment like reassign_dogs(), for rows that arrive one at a time, in time
+    order per camera (as they do when the images are named by ECN's convention and
+    sorted by name). An animal row is decided once a row from the same camera at least
+    time_window seconds later has arrived, or on flush(), so only the last time_window
+    seconds per camera are kept in memory.
+
+    add_human(), add_animal() and flush() return the animal rows decided, as a list of
+    (row, is_dog) in the order the rows were added. Rows without a timestamp are skipped in
+    the check, as in reassign_dogs(): such an animal is returned right away as not a dog.
+    """
+
+    def __init__(self, time_window=DOG_TIME_WINDOW, group_by=DOG_GROUP_BY):
+        self.window = pd.Timedelta(seconds=time_window).value
+        self.group_index = None if group_by is None else ANIMAL_COLUMNS.index(group_by)
+        self.timestamp_index = ANIMAL_COLUMNS.index('Timestamp')
+
+        # Per group: sorted recent human and dog times, animal rows still to be decided,
+        # and the latest time seen
+        self.human_times = {}
+        self.pending = {}
+        self.latest = {}
+
+        # Rows that arrived earlier than a row before them on the same camera
+        self.n_out_of_order = 0
+
+    def _add(self, row):
+        group = None if self.group_index is None else row[self.group_index]
+        t = row[self.timestamp_index].value
+        latest = self.latest.get(group)
+        if latest is not None and t < latest:
+            self.n_out_of_order += 1
+        else:
+            self.latest[group] = t
+        return group, t
+
+    def add_human(self, row):
+        if pd.isnull(row[self.timestamp_index]):
+            return []
+        group, t = self._add(row)
+        bisect.insort(self.human_times.setdefault(group, []), t)
+        return self._decide(group, self.latest[group] - self.window)
+
+    def add_animal(self, row):
+        if pd.isnull(row[self.timestamp_index]):
+            return [(row, False)]
+        group, t = self._add(row)
+        self.pending.setdefault(group, deque()).append((t, row))
+        return self._decide(group, self.latest[group] - self.window)
+
+    def flush(self):
+        decided = []
+        for group in list(self.pending):
+            decided.extend(self._decide(group, None))
+        return decided
+
+    def _decide(self, group, max_time):
+        """Decides the pending animals of group with times up to max_time (None for all)."""
+        pending = self.pending.get(group)
+        if not pending:
+            return []
+        times = self.human_times.setdefault(group, [])
+        decided = []
+        while pending and (max_time is None or pending[0][0] <= max_time):
+            t, row = pending.popleft()
+            j = bisect.bisect_right(times, t - self.window)
+            is_dog = j < len(times) and times[j] < t + self.window
+            if is_dog:
+                bisect.insort(times, t)
+            decided.append((row, is_dog))
+
+        # Older times are too far from any animal still to come
+        oldest = pending[0][0] if pending else self.latest[group]
+        del times[:bisect.bisect_right(times, oldest - self.window)]
+        return decided
+
+
+class StreamingEventGrouper:
+    """
+    Event grouping like group_events(), for images that arrive one at a time, in time
+    order per camera. add() returns the rows (in EVENT_COLUMNS order) of the events the
+    image ended, and flush() the rest. Only the open event of each camera is in memory.
+    """
+
+    def __init__(self, gap=EVENT_GAP):
+        self.gap = pd.Timedelta(seconds=gap)
+        self.open_events = {}
+        self.n_events = 0
+
+    @staticmethod
+    def _row(event):
+        return (event['Event'], event['Camera'], event['Start'], event['End'], event['Images'],
+                event['Animals'], event['Humans'], event['Humans'] > 0, event['Max confidence'],
+                event['First image'], event['Last image'])
+
+    def add(self, filename, timestamp, camera, animals, humans, confidence):
+        if pd.isnull(timestamp):
+            return []
+        ended = []
+        event = self.open_events.get(camera)
+        if event is not None and timestamp - event['End'] >= self.gap:
+            ended.append(StreamingEventGrouper._row(self.open_events.pop(camera)))
+            event = None
+        if event is None:
+            self.n_events += 1
+            event = {'Event': self.n_events, 'Camera': camera, 'Start': timestamp, 'Images': 0,
+                     'Animals': 0, 'Humans': 0, 'Max confidence': 0, 'First image': filename}
+            self.open_events[camera] = event
+        event['End'] = timestamp
+        event['Last image'] = filename
+        event['Images'] += 1
+        event['Animals'] = max(event['Animals'], animals)
+        event['Humans'] = max(event['Humans'], humans)
+        event['Max confidence'] = max(event['Max confidence'], confidence)
+        return ended
+
+    def flush(self):
+        events = sorted(self.open_events.values(), key=lambda event: event['Event'])
+        self.open_events = {}
+        return [StreamingEventGrouper._row(event) for event in events]
+
+
+def sort_image(filename, folder, maybe=False, mode=None):
+    """Puts filename in the output folder 'folder', and first in Maybe if maybe is True."""
+    if mode is None:
+        mode = SORT_MODE
+    if maybe:
+        copy_image(filename, 'Maybe', mode='copy' if mode == 'move' else mode)
+    copy_image(filename, folder, mode=mode)
+
+
+class _ImageSorter:
+    """Runs sort_image on a thread pool in batches, while the caller goes on reading.
+    One batch runs at a time, so images are sorted in the order they were added and at
+    most two batches are in memory."""
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, mode, n_threads):
+        self.mode = mode
+        self.pool = ThreadPool(n_threads)
+        self.batch = []
+        self.running = None
+
+    def add(self, filename, folder, maybe=False):
+        self.batch.append((filename, folder, maybe, self.mode))
+        if len(self.batch) >= _ImageSorter.BATCH_SIZE:
+            self._submit()
+
+    def _submit(self):
+        if self.running is not None:
+            self.running.get()
+        self.running = self.pool.starmap_async(sort_image, self.batch, chunksize=16)
+        self.batch = []
+
+    def flush(self):
+        """Waits until the images added so far are sorted."""
+        self._submit()
+        self.running.get()
+
+    def close(self):
         try:
-            ts = pd.Timestamp(Y + '-' + M + '-'+ D + ' ' + h + ':' + m + ':' + s)
-            date = Y + '-' + M + '-'+ D 
-            time = h + ':' + m + ':' + s
-        except:
-            print("Could not convert to timestamp for filename: "+filename)
-        
-        animals = 0
-        humans = 0
+            self.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+class StreamingSorter:
+    """
+    Sorts images one at a time as their MegaDetector results come in: writes their
+    spreadsheet rows and puts them in the output folders right away (animals once their
+    dog reassignment is decided, see StreamingDogReassigner).
+
+    Results are passed to write(), so a StreamingSorter can be used as the results_writer
+    of run_tf_detector_batch.load_and_run_detector_batch. close() sorts the files in
+    IMG_FOLDER that had no result into Empty and finishes the spreadsheets.
+    watch_folder.py keeps one open while watching, writing the rows of the images sorted
+    by earlier runs with sort_image=False first.
+
+    Compared to main():
+    - dog reassignment needs the images in time order per camera, which they are if the
+      file names follow ECN's convention and the images are run in sorted order (as
+      run_tf_detector_batch.py does with --sort_images, and detect_and_sort.py always
+      does); a warning is printed if they are not
+    - dogs are in time order in the people sheet, instead of at the end
+    - there is no incremental mode
+
+    Only the names of the images seen are kept in memory, to find the files in IMG_FOLDER
+    without a result at the end.
+    """
+
+    def __init__(self, mode=None, n_threads=None, output_format=None):
+        if mode is None:
+            mode = SORT_MODE
+        if n_threads is None:
+            n_threads = N_FILE_THREADS
+        if output_format is None:
+            output_format = OUTPUT_FORMAT
+        assert mode in SORT_MODES, 'Unknown sort mode: ' + mode
+        assert output_format in ROW_WRITERS, 'Unknown output format: ' + output_format
+
+        make_output_folders()
+
+        row_writer = ROW_WRITERS[output_format]
+        self.animal_writer = row_writer(OUTPUT_FOLDER + 'wildlife' + row_writer.extension, ANIMAL_COLUMNS)
+        self.human_writer = row_writer(OUTPUT_FOLDER + 'people' + row_writer.extension, HUMAN_COLUMNS)
+        self.event_writer = row_writer(OUTPUT_FOLDER + 'events' + row_writer.extension, EVENT_COLUMNS)
+        self.dog_reassigner = StreamingDogReassigner()
+        self.event_grouper = StreamingEventGrouper()
+        self.sorter = _ImageSorter(mode, n_threads)
+
+        self.seen_filenames = set()
+        # Animals written with sort_image=False whose dog reassignment is still pending
+        self.unsorted_animals = set()
+        self.missing_timestamps = list()
+        self.n_images = 0
+        self.n_failed = 0
+
+    def _write_decided(self, decided):
+        for row, is_dog in decided:
+            sort_image = row[0] not in self.unsorted_animals
+            self.unsorted_animals.discard(row[0])
+            if is_dog:
+                self.human_writer.write_row(row[:-1] + (0, row[-1]))
+                if sort_image:
+                    self.sorter.add(row[0], 'Human')
+            else:
+                self.animal_writer.write_row(row)
+                if sort_image:
+                    self.sorter.add(row[0], 'Animal')
+
+    def write(self, img, sort_image=True):
+        """
+        Sorts one image, given its entry in the MegaDetector output's 'images' list.
+        With sort_image=False, only its rows are written and it is not put in an output
+        folder (e.g. because an earlier run did), but it still counts for the dog
+        reassignment and events of the images after it.
+        """
+        self.n_images += 1
+        filename = (img["file"].split("/")[-1]).split("\\")[-1]
+        cam = filename[0:2]
+        self.seen_filenames.add(filename)
+
+        if 'failure' in img:
+            self.n_failed += 1
+            if sort_image:
+                self.sorter.add(filename, 'Empty')
+            return
+
         dogs = 0
-        max_conf = 0
-        
-        for det in img["detections"]:
-            if det["category"] == '1':
-                if det["conf"] >= TH:
-                    max_conf = max(max_conf, det["conf"])
-                    animals +=1
-                elif det["conf"] >= 0.5 and max_conf == 0:
-                    try:
-                        shutil.copy(IMG_FOLDER+filename, OUTPUT_FOLDER+'Maybe/'+filename)
-                    except:
-                        print("Could not move " + filename +", is it in the image folder?")
-                    break
-
-            elif det["category"] == '2' and det["conf"] >= TH:
-                humans +=1
-        
+        animals, humans, maybe = count_detections(img["detections"])
         if animals > 0 and humans > 0:
             dogs = animals
             animals = 0
-            
-        elif animals > 0:
-            animal_cameras.append(camera_name(cam)) 
-            animal_number.append(animals)
-            animal_timestamps.append(ts)
-            animal_filenames.append(filename)
-            animal_dates.append(date)
-            animal_times.append(time)
-            
+
+        if animals > 0 or humans > 0:
+            ts = parse_filename(filename)
+            if pd.isnull(ts):
+                ts = read_exif_timestamp(IMG_FOLDER + filename)
+            if pd.isnull(ts):
+                self.missing_timestamps.append(filename)
+                date, time = '', ''
+            else:
+                date, time = ts.strftime('%Y-%m-%d'), ts.strftime('%H:%M:%S')
+
+            camera = camera_name(cam)
+            for row in self.event_grouper.add(filename, ts, camera, animals + dogs, humans,
+                                              max_confidence(img["detections"])):
+                self.event_writer.write_row(row)
+
         if humans > 0:
-            human_cameras.append( camera_name(cam) )
-            human_timestamps.append(ts)
-            human_number.append(humans)
-            dog_number.append(dogs)
-            human_filenames.append(filename)
-            human_dates.append(date)
-            human_times.append(time)
+            row = (filename, ts, date, time, camera, humans, dogs)
+            self.human_writer.write_row(row)
+            if sort_image:
+                self.sorter.add(filename, 'Human', maybe)
+            self._write_decided(self.dog_reassigner.add_human(row))
+        elif animals > 0:
+            row = (filename, ts, date, time, camera, animals)
+            if not sort_image:
+                self.unsorted_animals.add(filename)
+            self._write_decided(self.dog_reassigner.add_animal(row))
+        elif sort_image:
+            self.sorter.add(filename, 'Empty', maybe)
 
-    # Changes animal detections to dogs if there was a human detected on the same camera close in time
-    i=0
-    while i in range(len(animal_filenames)):
-        dog = False
-        for j in range(len(human_filenames)): # Effective way to save time would be to change the range to only images around the image we check around
-            if (animal_cameras[i] == human_cameras[j] and 
-                abs((animal_timestamps[i]-human_timestamps[j]).total_seconds()) < 300): # Different timespan could be used
-                
-                dog = True
-                human_cameras.append(animal_cameras.pop(i))
-                human_timestamps.append(animal_timestamps.pop(i))
-                human_number.append(0)
-                dog_number.append(animal_number.pop(i))
-                human_filenames.append(animal_filenames.pop(i))
-                human_dates.append(animal_dates.pop(i))
-                human_times.append(animal_times.pop(i))
-                break
-        
-        if not dog:
-            i+=1
-    
-    #region
-    #### Saving detections in excel-sheets
-    animal_df = DataFrame({'Filename': animal_filenames, 'Timestamp': animal_timestamps, 'Date': animal_dates,
-                            'Time': animal_times, 'Camera': animal_cameras, 'Number': animal_number})
-    human_df = DataFrame({'Filename': human_filenames, 'Timestamp': human_timestamps, 'Date': human_dates,
-                            'Time': human_times, 'Camera': human_cameras, 'Number': human_number, 'Dogs': dog_number})
+    def flush(self):
+        """
+        Decides the pending dog reassignments and waits until the images written so far
+        are in their output folders. Images written later are not checked for dogs
+        against the ones before.
+        """
+        self._write_decided(self.dog_reassigner.flush())
+        self.sorter.flush()
 
-    animal_df.to_excel(OUTPUT_FOLDER+'wildlife.xlsx', sheet_name='sheet1', index=False)
-    human_df.to_excel(OUTPUT_FOLDER+'people.xlsx', sheet_name='sheet1', index=False)
-    #endregion
+    def close(self, sort_unseen=True):
+        """
+        Decides the pending dog reassignments and events and finishes the spreadsheets.
+        If sort_unseen is True, the files in IMG_FOLDER that had no result are sorted into
+        Empty first.
+        """
+        self._write_decided(self.dog_reassigner.flush())
+        for row in self.event_grouper.flush():
+            self.event_writer.write_row(row)
 
-    #region
+        if sort_unseen:
+            for filename in os.listdir(IMG_FOLDER):
+                if filename not in self.seen_filenames:
+                    self.sorter.add(filename, 'Empty')
 
-    # Could use either shutil.copy or shutil.move depending on if you want to keep to original folder
-    for filename in animal_filenames:
         try:
-            shutil.copy(IMG_FOLDER+filename, OUTPUT_FOLDER+'Animal/'+filename)
-        except:
-            print("Could not move " + filename +", is it in the image folder?")
-        
-    for filename in human_filenames:
+            self.sorter.close()
+        finally:
+            for writer in (self.animal_writer, self.human_writer, self.event_writer):
+                writer.close()
+
+        print('Sorted {} images'.format(self.n_images))
+        if self.n_failed > 0:
+            print('{} images could not be run by the detector and were sorted into Empty'.format(self.n_failed))
+        if len(self.missing_timestamps) > 0:
+            report_missing_timestamps(self.missing_timestamps)
+        if self.dog_reassigner.n_out_of_order > 0:
+            print('Warning: {} images were not in time order per camera, some dogs may have been '
+                  'counted as wildlife; run the detector with --sort_images, or run without '
+                  '--stream'.format(
+                      self.dog_reassigner.n_out_of_order))
+
+    def abort(self):
+        """
+        Stops after an error: finishes putting the images already handed to the folder
+        sorter into their folders and closes the spreadsheets with the rows written so
+        far. Unlike close(), the files in IMG_FOLDER without a result are not sorted into
+        Empty, and rows still waiting for their dog reassignment or event are left out.
+        """
         try:
-            shutil.copy(IMG_FOLDER+filename, OUTPUT_FOLDER+'Human/'+filename)
-        except:
-            print("Could not move " + filename +", is it in the image folder?")
+            self.sorter.close()
+        finally:
+            for writer in (self.animal_writer, self.human_writer, self.event_writer):
+                writer.close()
 
-    for filename in os.listdir(IMG_FOLDER):
-        if (not filename in animal_filenames and not filename in human_filenames):
-            shutil.copy(IMG_FOLDER+filename, OUTPUT_FOLDER+'Empty/'+filename)
-# Could add dog-folder
 
-    #endregion
+def main_streaming(mode=None, n_threads=None, output_format=None):
+    """
+    Like main(), but reads MD_OUTPUT one image at a time and sorts the images with a
+    StreamingSorter (see its differences to main()), so memory use stays bounded for very
+    large folders.
+    """
+    sorter = StreamingSorter(mode=mode, n_threads=n_threads, output_format=output_format)
+
+    try:
+        for img in iter_md_images(MD_OUTPUT):
+            sorter.write(img)
+
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+
+        msg = "ERROR : {}, moreInfo : {}\t{}\t{}".format(
+            e, exc_type, fname, exc_tb.tb_lineno)
+
+        print(msg)
+        try:
+            sorter.abort()
+        except Exception as e:
+            # e.g. the same error, if it came from the sort pool
+            print('ERROR while closing the output : {}'.format(e))
+        return False, msg
+
+    sorter.close()
+    return True, ''
+
+#endregion
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(
+        description='Sort images into output folders and spreadsheets based on MegaDetector output')
+    parser.add_argument('--mode', choices=SORT_MODES, default=SORT_MODE,
+                        help='How images are put in the output folders; default is ' + SORT_MODE)
+    parser.add_argument('--threads', type=int, default=N_FILE_THREADS,
+                        help='Number of threads doing file operations; default is {}'.format(N_FILE_THREADS))
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the MegaDetector output one image at a time, for folders too large to fit in memory')
+    parser.add_argument('--output_format', choices=sorted(ROW_WRITERS), default=OUTPUT_FORMAT,
+                        help='Spreadsheet format; default is ' + OUTPUT_FORMAT)
+    args = parser.parse_args()
+
+    if args.stream:
+        main_streaming(mode=args.mode, n_threads=args.threads, output_format=args.output_format)
+    else:
+        main(mode=args.mode, n_threads=args.threads, output_format=args.output_format)
 
@@ -0,0 +1,298 @@
+"""
+Watches the image folder and keeps the MegaDetector output and the sorted output folders
+up to date, without rerunning everything for each new batch of images.
+
+The detector is loaded once. Every poll, new or changed images (by modification time and
+size, compared to a file index saved next to the output JSON) are run through the
+detector. Their results are appended to a journal next to the output JSON (output.jsonl
+for output.json), and the changes to the file index to file_index.jsonl, so a poll only
+writes the new results. The new images are sorted into the output folders by the end of
+the poll, by an output_record.StreamingSorter that stays open while watching; its
+spreadsheets are finished when the watcher stops. Animals are only checked for dogs
+against the images up to their own poll. When it stops (or starts again after a crash), the
+journals are merged into the output JSON and the file index.
+
+Images the detector failed on are sorted into Empty and kept in the index, so they are
+only run again once their modification time or size changes. If images were changed or
+removed since the last poll, the spreadsheets are started over from the output JSON,
+since their old rows can't be taken out of a spreadsheet being written.
+
+Run from the repository root, with PYTHONPATH set as in run.cmd:
+
+python watch_folder.py ./md_v4.1.0.pb
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from detection.run_tf_detector import ImagePathUtils, TFDetector
+from detection.run_tf_detector_batch import (load_and_run_detector_batch, read_checkpoint_journal,
+                                             append_to_checkpoint_journal, ResultsFileWriter)
+
+import output_record
+
+#### GLOBAL CONSTANTS, CHANGE IF YOU CHANGE FOLDER NAMES #####
+FILE_INDEX = "output/file_index.json"
+##############################################################
+
+
+def journal_path(path):
+    """Returns the path of the journal that goes with the .json file at path."""
+    return os.path.splitext(path)[0] + '.jsonl'
+
+
+def load_file_index(index_path):
+    """
+    Returns the saved {path: [mtime, size]} index (an empty one if there is none), with
+    the changes in its journal applied, and the set of paths the journal removed.
+    """
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    removed = set()
+    if os.path.exists(journal_path(index_path)):
+        for path, stat in read_checkpoint_journal(journal_path(index_path), truncate_partial_line=True):
+            if stat is None:
+                index.pop(path, None)
+                removed.add(path)
+            else:
+                index[path] = stat
+                removed.discard(path)
+    return index, removed
+
+
+def save_file_index(index, index_path):
+    # Write to a temporary file first, so a crash never leaves a half-written index
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    if os.path.exists(journal_path(index_path)):
+        os.remove(journal_path(index_path))
+
+
+def scan_folder(image_folder, settle_time):
+    """
+    Returns the {path: [mtime, size]} index of the images in image_folder.
+    Images modified in the last settle_time seconds are left out, since they may still
+    be being copied in; they are picked up by a later scan.
+    """
+    now = time.time()
+    index = {}
+    for path in ImagePathUtils.find_images(image_folder):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if now - st.st_mtime < settle_time:
+            continue
+        index[path] = [st.st_mtime, st.st_size]
+    return index
+
+
+def merge_results(output_file, removed):
+    """
+    Merges the results in the journal of output_file into output_file, and deletes the
+    journal. A result in the journal replaces the result for the same image in place, or
+    else is added at the end; results of the images in removed are dropped.
+    """
+    results_journal = journal_path(output_file)
+    if not os.path.exists(results_journal):
+        return
+    new_results_by_file = {r['file']: r for r in read_checkpoint_journal(results_journal)}
+
+    # Write to a temporary file first, so a crash never leaves a half-written output file
+    with ResultsFileWriter(output_file + '.tmp') as writer:
+        if os.path.exists(output_file):
+            for r in output_record.iter_md_images(output_file):
+                r = new_results_by_file.pop(r['file'], r)
+                if r['file'] not in removed:
+                    writer.write(r)
+        for r in new_results_by_file.values():
+            if r['file'] not in removed:
+                writer.write(r)
+    os.replace(output_file + '.tmp', output_file)
+    os.remove(results_journal)
+
+
+class FolderWatcher:
+    """
+    Runs the detector on the new and changed images in image_folder on each update(), see
+    the module docstring. close() merges the journals and finishes the spreadsheets.
+    """
+
+    def __init__(self, tf_detector, image_folder, output_file, index_path, confidence_threshold,
+                 settle_time=5, sort=True):
+        self.tf_detector = tf_detector
+        self.image_folder = image_folder
+        self.output_file = output_file
+        self.index_path = index_path
+        self.confidence_threshold = confidence_threshold
+        self.settle_time = settle_time
+
+        # Finish what a crashed run left in the journals
+        self.index, removed = load_file_index(index_path)
+        merge_results(output_file, removed)
+        save_file_index(self.index, index_path)
+        if not os.path.exists(output_file):
+            # Without the output file the index is meaningless, so start over
+            self.index = {}
+
+        # Images removed since the journals were last merged
+        self.removed = set()
+
+        self.sorter = None
+        if sort:
+            self._open_sorter()
+
+    def _open_sorter(self, sort_filenames=()):
+        """
+        Opens the StreamingSorter, with the rows of the images in the output file; only
+        the images in sort_filenames are put in the output folders.
+        """
+        self.sorter = output_record.StreamingSorter()
+        if os.path.exists(self.output_file):
+            for img in output_record.iter_md_images(self.output_file):
+                filename = os.path.basename(img['file'])
+                self.sorter.write(img, sort_image=filename in sort_filenames)
+            self.sorter.flush()
+
+    def _merge_journals(self):
+        merge_results(self.output_file, self.removed)
+        save_file_index(self.index, self.index_path)
+        self.removed = set()
+
+    def update(self):
+        """
+        Runs the detector on new and changed images in image_folder, adds the results to
+        the journal and sorts the new images.
+
+        Returns the number of images that were run.
+        """
+        current = scan_folder(self.image_folder, self.settle_time)
+        changed = [path for path, stat in current.items() if self.index.get(path) != stat]
+        removed = [path for path in self.index if path not in current and not os.path.exists(path)]
+
+        if len(changed) == 0 and len(removed) == 0:
+            return 0
+
+        print('{} new or changed images, {} removed images'.format(len(changed), len(removed)))
+
+        new_results = load_and_run_detector_batch(self.tf_detector, sorted(changed),
+                                                  confidence_threshold=self.confidence_threshold)
+
+        # Results first, so a crash in between only means running some images again
+        with open(journal_path(self.output_file), 'a') as f:
+            append_to_checkpoint_journal(f, new_results, sync=True)
+        index_changes = [[path, current[path]] for path in changed] + [[path, None] for path in removed]
+        with open(journal_path(self.index_path), 'a') as f:
+            append_to_checkpoint_journal(f, index_changes, sync=True)
+
+        rerun = [path for path in changed if path in self.index]
+        for path in removed:
+            self.index.pop(path, None)
+            self.removed.add(path)
+        for path in changed:
+            self.index[path] = current[path]
+            self.removed.discard(path)
+
+        # Failed images are in the index like the others, so an unreadable image is not run
+        # on every poll; they are run again once they change
+        n_failed = sum('failure' in r for r in new_results)
+        if n_failed > 0:
+            print('{} images failed, they will be run again if they change'.format(n_failed))
+
+        if self.sorter is not None and len(rerun) == 0 and len(removed) == 0:
+            for r in new_results:
+                self.sorter.write(r)
+            self.sorter.flush()
+        elif self.sorter is not None:
+            # Start the spreadsheets over, without the old rows of these images
+            self.sorter.close(sort_unseen=False)
+            self.sorter = None
+            self._merge_journals()
+
+            # Changed images may be sorted differently now, so remove their old copies, and
+            # those of the removed images
+            changed_filenames = set(os.path.basename(path) for path in changed)
+            for filename in changed_filenames | set(os.path.basename(path) for path in removed):
+                for folder in output_record.SORT_FOLDERS + ['Maybe']:
+                    if os.path.lexists(output_record.OUTPUT_FOLDER + folder + '/' + filename):
+                        os.remove(output_record.OUTPUT_FOLDER + folder + '/' + filename)
+            self._open_sorter(sort_filenames=changed_filenames)
+
+        return len(changed)
+
+    def close(self):
+        """Finishes the spreadsheets and merges the journals into the output file and the index."""
+        try:
+            if self.sorter is not None:
+                self.sorter.close(sort_unseen=False)
+        finally:
+            self._merge_journals()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep MegaDetector output and sorted folders up to date as images are added')
+    parser.add_argument('detector_file', help='Path to .pb TensorFlow detector model file')
+    parser.add_argument('--image_folder', default=output_record.IMG_FOLDER,
+                        help='Folder to watch; default is ' + output_record.IMG_FOLDER)
+    parser.add_argument('--output_file', default=output_record.MD_OUTPUT,
+                        help='MegaDetector output JSON to keep up to date; default is ' + output_record.MD_OUTPUT)
+    parser.add_argument('--file_index', default=FILE_INDEX,
+                        help='Where to save the index of processed files; default is ' + FILE_INDEX)
+    parser.add_argument('--threshold', type=float, default=TFDetector.DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+                        help="Don't include boxes below this confidence in the output file; default is 0.1")
+    parser.add_argument('--poll_interval', type=float, default=30,
+                        help='Seconds between scans of the image folder; default is 30')
+    parser.add_argument('--settle_time', type=float, default=5,
+                        help='Ignore images modified less than this many seconds ago; default is 5')
+    parser.add_argument('--no_sort', action='store_true',
+                        help='Only update the output JSON, do not sort the images')
+    parser.add_argument('--once', action='store_true',
+                        help='Process new images once and exit instead of watching the folder')
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+
+    assert os.path.exists(args.detector_file), 'Specified detector_file does not exist'
+    assert os.path.isdir(args.image_folder), 'Specified image_folder does not exist'
+
+    # output_record.py works on its global folder and file names
+    output_record.IMG_FOLDER = os.path.join(args.image_folder, '')
+    output_record.MD_OUTPUT = args.output_file
+
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    tf_detector = TFDetector(args.detector_file)
+    watcher = FolderWatcher(tf_detector, args.image_folder, args.output_file, args.file_index,
+                            args.threshold, settle_time=args.settle_time, sort=not args.no_sort)
+
+    print('Watching {}, press Ctrl+C to stop'.format(args.image_folder))
+    try:
+        while True:
+            start_time = time.time()
+            n = watcher.update()
+            if n > 0:
+                elapsed = time.time() - start_time
+                print('Processed {} images in {:.1f} s ({:.2f} s per image)'.format(n, elapsed, elapsed / n))
+            if args.once:
+                break
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        watcher.close()
+
+
+if __name__ == '__main__':
+    main()